@@ -11,6 +11,9 @@ parser.add_option("--create-checked-logs", action='store_true', default=False, h
 parser.add_option("--tolerance-euler", type=float, default=3, help="tolerance for euler angles in degrees");
 parser.add_option("--tolerance-pos", type=float, default=2, help="tolerance for position angles in meters");
 parser.add_option("--tolerance-vel", type=float, default=2, help="tolerance for velocity in meters/second");
+parser.add_option("--jobs", "-j", type=int, default=None, help="replay this many logs at once")
+parser.add_option("--timeout", type=float, default=None, help="give up on replaying a log after this many seconds (with --jobs)")
+parser.add_option("--cache-file", type='string', default=None, help="reuse results of logs already replayed with the same Replay binary (with --jobs)")
 
 opts, args = parser.parse_args()
 
@@ -26,14 +29,17 @@ def run_cmd(cmd, dir=".", show=False, output=False, checkfail=True):
     else:
         return call(cmd, shell=True, cwd=dir)
 
+def replay_args(logfile):
+    '''arguments to Replay.elf to check one logfile'''
+    return ["--", "--check", logfile,
+            "--tolerance-euler=%f" % opts.tolerance_euler,
+            "--tolerance-pos=%f" % opts.tolerance_pos,
+            "--tolerance-vel=%f" % opts.tolerance_vel]
+
 def run_replay(logfile):
     '''run Replay on one logfile'''
     print("Processing %s" % logfile)
-    cmd = "./Replay.elf -- --check %s --tolerance-euler=%f --tolerance-pos=%f --tolerance-vel=%f " % (
-        logfile,
-        opts.tolerance_euler,
-        opts.tolerance_pos,
-        opts.tolerance_vel)
+    cmd = "./Replay.elf " + " ".join(replay_args(logfile)) + " "
     run_cmd(cmd, checkfail=False)
 
 def get_log_list():
@@ -98,7 +104,7 @@ Git version: %s
         error_in_this_log = False
         for i in range(1,6):
             tol = tolerances[i-1]
-            if a[i] == "FPE":
+            if a[i] in ("FPE", "TIMEOUT"):
                 bgcolor = "red"
                 error_count += 1
                 error_in_this_log = True
@@ -149,11 +155,51 @@ def check_logs():
     except Exception as ex:
         print(ex)
 
+    if opts.jobs is not None:
+        check_logs_in_parallel(log_list)
+        return
+
     for logfile in log_list:
         run_replay(logfile)
 
     create_html_results()
 
+def check_logs_in_parallel(log_list):
+    '''replay opts.jobs logs at once, updating the results as each
+    finishes'''
+    from replay_pool import ReplayPool, replay_results_lines
+
+    replay_binary = os.path.abspath("Replay.elf")
+    pool = ReplayPool(jobs=opts.jobs, cache_file=opts.cache_file)
+    tasks = []
+    for logfile in log_list:
+        args = replay_args(os.path.abspath(logfile))
+        # the key covers the tolerances but not where the log is:
+        key = pool.cache_key(replay_binary, logfile, *(args[:2] + args[3:]))
+        tasks.append((logfile, key, replay_results_lines, ([replay_binary] + args, opts.timeout)))
+
+    # start with an empty report, so it is valid while we run:
+    open("replay_results.txt", "w").close()
+    create_html_results()
+
+    def on_result(logfile, result):
+        print("%s: %s%s" % (logfile, result["status"], " (cached)" if result["cached"] else ""))
+        for message in result["messages"]:
+            print("  %s" % message)
+        lines = result.get("lines", [])
+        if result["status"] == "timeout" and len(lines) == 0:
+            lines = ["\t".join([logfile] + ["TIMEOUT"] * 5)]
+        with open("replay_results.txt", "a") as f:
+            for line in lines:
+                # Replay was given the absolute path; report the path we were given
+                a = line.split("\t")
+                if a[0] == os.path.abspath(logfile):
+                    a[0] = logfile
+                f.write("\t".join(a) + "\n")
+        create_html_results()
+
+    pool.run(tasks, on_result)
+
 def create_checked_logs():
     '''create a set of CHEK logs'''
     import glob, sys
@@ -185,8 +231,11 @@ def create_checked_logs():
         os.rename(outlog, newname)
         print("Created %s" % newname)
 
-if opts.create_checked_logs:
-    create_checked_logs()
-    sys.exit(0)
+# replay_pool's worker processes may import this file, so only run when
+# invoked directly:
+if __name__ == '__main__':
+    if opts.create_checked_logs:
+        create_checked_logs()
+        sys.exit(0)
 
-check_logs()
+    check_logs()
@@ -2,11 +2,113 @@
 
 '''
 check that replay produced identical results
+
+Replay writes the EKF messages it produces with core numbers (C) 100
+higher than those of the original log.  Each replayed message is
+compared with the most recent message from the original core before
+it in the log.  Messages are decoded a whole type at a time and
+compared a field at a time, and each field which differs is reported
+once, with the number of differences and where they started.
+
+AP_FLAKE8_CLEAN
 '''
 
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'autotest', 'pysim'))
+from columnar_dfreader import ColumnarDFReader  # noqa: E402
+
+EK2_LIST = ['NKF1', 'NKF2', 'NKF3', 'NKF4', 'NKF5', 'NKF0', 'NKQ', 'NKY0', 'NKY1']
+EK3_LIST = ['XKF1', 'XKF2', 'XKF3', 'XKF4', 'XKF0', 'XKFS', 'XKQ', 'XKFD', 'XKV1', 'XKV2', 'XKY0', 'XKY1']
+
+
+def values_match(v1, v2, accuracy):
+    '''returns a boolean array which is True where the values in v1 and
+    v2 are equal, or within accuracy percent of their average'''
+    ok = v1 == v2
+    if ok.ndim > 1:
+        # array fields must match exactly
+        return ok.all(axis=tuple(range(1, ok.ndim)))
+    if accuracy > 0 and v1.dtype.kind in "iuf":
+        v1 = v1.astype(numpy.float64)
+        v2 = v2.astype(numpy.float64)
+        margin = accuracy * 0.01 * (v1 + v2) * 0.5
+        with numpy.errstate(invalid='ignore'):
+            ok |= numpy.abs(v1 - v2) <= numpy.abs(margin)
+    return ok
+
+
+def value_str(value):
+    if isinstance(value, numpy.ndarray):
+        return str(value.tolist())
+    value = value.item()
+    if isinstance(value, bytes):
+        return value.decode('ascii', errors='replace')
+    return str(value)
+
+
+class FieldMismatch(object):
+    '''differences in one field of one replayed core'''
+    def __init__(self, mtype, field, core, count, total, offset, timestamp, replayed, original):
+        self.mtype = mtype
+        self.field = field
+        self.core = core
+        self.count = count
+        self.total = total
+        self.offset = offset
+        self.timestamp = timestamp
+        self.replayed = replayed
+        self.original = original
+
+    def __str__(self):
+        when = ""
+        if self.timestamp is not None:
+            when = " TimeUS=%u" % self.timestamp
+        return ("Mismatch in field %s.%s: C=%u %u/%u differ, first at%s: %s %s" %
+                (self.mtype, self.field, self.core, self.count, self.total, when,
+                 value_str(self.replayed), value_str(self.original)))
+
+
+def compare_core(mtype, columns, core, replayed, original, accuracy, ignores):
+    '''returns a list of FieldMismatch for replayed core against original'''
+    ret = []
+    if original is None:
+        index = numpy.full(len(replayed), -1)
+    else:
+        index = numpy.searchsorted(original.offsets, replayed.offsets) - 1
+    have_original = index >= 0
+    timestamps = None
+    if "TimeUS" in columns:
+        timestamps = replayed["TimeUS"]
+    if not have_original.all():
+        first = numpy.flatnonzero(~have_original)[0]
+        timestamp = None if timestamps is None else timestamps[first]
+        ret.append(FieldMismatch(mtype, "C", core, numpy.count_nonzero(~have_original), len(replayed),
+                                 replayed.offsets[first], timestamp, numpy.uint8(core), numpy.uint8(core - 100)))
+    replayed_index = numpy.flatnonzero(have_original)
+    index = index[have_original]
+    for field in columns:
+        if field == 'C':
+            continue
+        if "%s.%s" % (mtype, field) in ignores:
+            continue
+        v1 = replayed[field][replayed_index]
+        v2 = original[field][index]
+        bad = numpy.flatnonzero(~values_match(v1, v2, accuracy))
+        if len(bad) == 0:
+            continue
+        first = replayed_index[bad[0]]
+        timestamp = None if timestamps is None else timestamps[first]
+        ret.append(FieldMismatch(mtype, field, core, len(bad), len(replayed),
+                                 replayed.offsets[first], timestamp, v1[bad[0]], v2[bad[0]]))
+    return ret
+
+
 def check_log(logfile, progress=print, ekf2_only=False, ekf3_only=False, verbose=False, accuracy=0.0, ignores=set()):
     '''check replay log for matching output'''
-    from pymavlink import mavutil
     progress("Processing log %s" % logfile)
     failure = 0
     errors = 0
@@ -15,62 +117,46 @@ def check_log(logfile, progress=print, ekf2_only=False, ekf3_only=False, verbose
     counts = {}
     base_counts = {}
 
-    mlog = mavutil.mavlink_connection(logfile)
-
-    ek2_list = ['NKF1','NKF2','NKF3','NKF4','NKF5','NKF0','NKQ', 'NKY0', 'NKY1']
-    ek3_list = ['XKF1','XKF2','XKF3','XKF4','XKF0','XKFS','XKQ','XKFD','XKV1','XKV2','XKY0','XKY1']
-    
     if ekf2_only:
-        mlist = ek2_list
+        mlist = EK2_LIST
     elif ekf3_only:
-        mlist = ek3_list
+        mlist = EK3_LIST
     else:
-        mlist = ek2_list + ek3_list
-
-    base = {}
-    for m in mlist:
-        base[m] = {}
+        mlist = EK2_LIST + EK3_LIST
 
-    while True:
-        m = mlog.recv_match(type=mlist)
-        if m is None:
-            break
-        if not hasattr(m,'C'):
+    log = ColumnarDFReader(logfile)
+    mismatches = []
+    for mtype in mlist:
+        if mtype not in log:
             continue
-        mtype = m.get_type()
-        if mtype not in counts:
-            counts[mtype] = 0
-            base_counts[mtype] = 0
-        core = m.C
-        if core < 100:
-            base[mtype][core] = m
-            base_count += 1
-            base_counts[mtype] += 1
+        msgs = log[mtype]
+        if 'C' not in msgs.columns:
             continue
-        mb = base[mtype][core-100]
-        count += 1
-        counts[mtype] += 1
-        mismatch = False
-        for f in m._fieldnames:
-            if f == 'C':
-                continue
-            if "%s.%s" % (mtype, f) in ignores:
+        counts[mtype] = 0
+        base_counts[mtype] = 0
+        cores = msgs.split('C')
+        for (core, replayed) in sorted(cores.items()):
+            if core < 100:
+                base_counts[mtype] += len(replayed)
                 continue
-            v1 = getattr(m,f)
-            v2 = getattr(mb,f)
-            ok = v1 == v2
-            if not ok and accuracy > 0:
-                avg = (v1+v2)*0.5
-                margin = accuracy*0.01*avg
-                if abs(v1-v2) <= abs(margin):
-                    ok = True
-            if not ok:
-                mismatch = True
-                errors += 1
-                progress("Mismatch in field %s.%s: %s %s" % (mtype, f, str(v1), str(v2)))
-        if mismatch:
-            progress(mb)
-            progress(m)
+            counts[mtype] += len(replayed)
+            mismatches.extend(compare_core(mtype, msgs.columns, core, replayed, cores.get(core - 100), accuracy, ignores))
+        count += counts[mtype]
+        base_count += base_counts[mtype]
+    log.close()
+
+    # report in order of first divergence:
+    mismatches.sort(key=lambda x : x.offset)
+    for mismatch in mismatches:
+        progress(str(mismatch))
+        errors += mismatch.count
+    if len(mismatches):
+        first = mismatches[0]
+        progress("First divergence in %s.%s%s" % (
+            first.mtype,
+            first.field,
+            "" if first.timestamp is None else " at TimeUS=%u" % first.timestamp))
+
     progress("Processed %u/%u messages, %u errors" % (count, base_count, errors))
     if verbose:
         for mtype in counts.keys():
@@ -83,8 +169,8 @@ def check_log(logfile, progress=print, ekf2_only=False, ekf3_only=False, verbose
         return False
     return True
 
+
 if __name__ == '__main__':
-    import sys
     from argparse import ArgumentParser
     parser = ArgumentParser(description=__doc__)
     parser.add_argument("--ekf2-only", action='store_true', help="only check EKF2")
@@ -98,7 +184,8 @@ if __name__ == '__main__':
 
     failed = False
     for filename in args.logs:
-        if not check_log(filename, print, args.ekf2_only, args.ekf3_only, args.verbose, accuracy=args.accuracy, ignores=args.ignore_field):
+        if not check_log(filename, print, args.ekf2_only, args.ekf3_only, args.verbose,
+                         accuracy=args.accuracy, ignores=args.ignore_field):
             failed = True
 
     if failed:
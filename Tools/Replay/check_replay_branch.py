@@ -18,8 +18,11 @@ from pymavlink import DFReader
 import check_replay
 
 class CheckReplayBranch(object):
-    def __init__(self, master='remotes/origin/master'):
+    def __init__(self, master='remotes/origin/master', jobs=None, timeout=None, cache_file=None):
         self.master = master
+        self.jobs = jobs
+        self.timeout = timeout
+        self.cache_file = cache_file
 
     def find_topdir(self):
         here = os.getcwd()
@@ -97,6 +100,36 @@ class CheckReplayBranch(object):
     def run_replay_on_log(self, logfile_path):
         subprocess.check_call(["./build/sitl/tool/Replay", logfile_path])
 
+    def run_replay_on_logs_in_parallel(self, replay_logs):
+        '''replay self.jobs logs at once, each in its own directory, and
+        check the output of each as it finishes'''
+        from replay_pool import ReplayPool, replay_and_check
+
+        replay_binary = os.path.abspath("./build/sitl/tool/Replay")
+        pool = ReplayPool(jobs=self.jobs, cache_file=self.cache_file)
+        tasks = []
+        for log in replay_logs:
+            key = pool.cache_key(replay_binary, log)
+            tasks.append((log, key, replay_and_check, (replay_binary, os.path.abspath(log), self.timeout)))
+
+        results = {}
+
+        def on_result(log, result):
+            results[log] = result
+            for message in result["messages"]:
+                self.progress("  %s" % message)
+            if result["status"] != "ok":
+                outcome = "Replay %s" % result["status"]
+            elif result["ok"]:
+                outcome = "OK"
+            else:
+                outcome = "FAILED"
+            self.progress("check_replay.py of (%s): %s%s (%u/%u done)" %
+                          (log, outcome, " (cached)" if result["cached"] else "", len(results), len(replay_logs)))
+
+        pool.run(tasks, on_result)
+        return all([r["status"] == "ok" and r["ok"] for r in results.values()])
+
     def get_logs(self):
         return sorted(glob.glob("logs/*.BIN"))
 
@@ -152,23 +185,26 @@ class CheckReplayBranch(object):
         success = True
         if len(replay_logs) == 0:
             raise ValueError("Found no Replay logs")
-        for log in replay_logs:
-            self.progress("Running Replay on (%s)" % log)
-            old_logs = self.get_logs()
-            self.run_replay_on_log(log)
-            new_logs = self.get_logs()
-            delta = [x for x in new_logs if x not in old_logs]
-            if len(delta) != 1:
-                raise ValueError("Expected a single new log")
-            new_log = delta[0]
-            self.progress("Running check_replay.py on Replay output log: %s" % new_log)
-
-            # run check_replay across Replay log
-            if check_replay.check_log(new_log, verbose=True):
-                self.progress("check_replay.py of (%s): OK" % new_log)
-            else:
-                self.progress("check_replay.py of (%s): FAILED" % new_log)
-                success = False
+        if self.jobs is not None:
+            success = self.run_replay_on_logs_in_parallel(replay_logs)
+        else:
+            for log in replay_logs:
+                self.progress("Running Replay on (%s)" % log)
+                old_logs = self.get_logs()
+                self.run_replay_on_log(log)
+                new_logs = self.get_logs()
+                delta = [x for x in new_logs if x not in old_logs]
+                if len(delta) != 1:
+                    raise ValueError("Expected a single new log")
+                new_log = delta[0]
+                self.progress("Running check_replay.py on Replay output log: %s" % new_log)
+
+                # run check_replay across Replay log
+                if check_replay.check_log(new_log, verbose=True):
+                    self.progress("check_replay.py of (%s): OK" % new_log)
+                else:
+                    self.progress("check_replay.py of (%s): FAILED" % new_log)
+                    success = False
         if success:
             self.progress("All OK")
         else:
@@ -181,10 +217,13 @@ if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser(description=__doc__)
     parser.add_argument("--master", default='remotes/origin/master', help="branch to consider master branch")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="replay this many logs at once")
+    parser.add_argument("--timeout", type=float, default=None, help="give up on replaying a log after this many seconds (with --jobs)")
+    parser.add_argument("--cache-file", default=None, help="reuse results of logs already replayed with the same Replay binary (with --jobs)")
 
     args = parser.parse_args()
 
-    s = CheckReplayBranch(master=args.master)
+    s = CheckReplayBranch(master=args.master, jobs=args.jobs, timeout=args.timeout, cache_file=args.cache_file)
     if not s.run():
         sys.exit(1)
 
@@ -0,0 +1,211 @@
+'''
+run Replay over many logs at once
+
+Each log is replayed by its own Replay process in a temporary working
+directory (Replay writes its output log into logs/ under the current
+directory), with an optional timeout.  Results are passed back as each
+log finishes.  They are cached under a key built from hashes of the
+Replay binary and of the log, so a log which has already been checked
+with the same binary is not replayed again:
+
+    pool = ReplayPool(jobs=8, cache_file="replay-cache.json")
+    key = pool.cache_key(replay_binary, logfile)
+    pool.run([(logfile, key, replay_and_check, (replay_binary, logfile, 600))], on_result)
+
+Task functions run in worker processes, so they live here rather than
+in the scripts using them.
+
+AP_FLAKE8_CLEAN
+'''
+
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+def file_sha256(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if len(chunk) == 0:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def run_replay(cmd, workdir, timeout=None):
+    '''run the Replay command cmd in workdir.  Returns (status, output,
+    list of logs written), where status is "ok", "failed" or "timeout"'''
+    logdir = os.path.join(workdir, "logs")
+    old_logs = set(glob.glob(os.path.join(logdir, "*.BIN")))
+    try:
+        p = subprocess.run(cmd,
+                           cwd=workdir,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT,
+                           timeout=timeout)
+        output = p.stdout
+        status = "ok" if p.returncode == 0 else "failed"
+    except subprocess.TimeoutExpired as ex:
+        output = ex.stdout or b""
+        status = "timeout"
+    new_logs = sorted(set(glob.glob(os.path.join(logdir, "*.BIN"))) - old_logs)
+    return (status, output.decode('utf-8', errors='replace'), new_logs)
+
+
+def output_tail(output, lines=20):
+    return output.splitlines()[-lines:]
+
+
+def replay_and_check(replay_binary, logfile, timeout=None):
+    '''replay logfile and compare the EKF output with the original
+    using check_replay.py'''
+    import check_replay
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    try:
+        (status, output, new_logs) = run_replay([replay_binary, logfile], workdir, timeout=timeout)
+        result = {
+            "status": status,
+            "ok": False,
+            "messages": [],
+        }
+        if status != "ok":
+            result["messages"] = output_tail(output)
+            return result
+        if len(new_logs) != 1:
+            result["status"] = "failed"
+            result["messages"] = ["Expected a single new log, got %u" % len(new_logs)]
+            return result
+        messages = []
+        result["ok"] = check_replay.check_log(new_logs[0], progress=messages.append, verbose=True)
+        result["messages"] = messages
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def replay_results_lines(cmd, timeout=None):
+    '''run the Replay command cmd and return the lines it wrote to
+    replay_results.txt'''
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    try:
+        (status, output, new_logs) = run_replay(cmd, workdir, timeout=timeout)
+        result = {
+            "status": status,
+            "lines": [],
+            "messages": [],
+        }
+        if status != "ok":
+            result["messages"] = output_tail(output)
+        try:
+            with open(os.path.join(workdir, "replay_results.txt")) as f:
+                result["lines"] = [line.rstrip("\n") for line in f]
+        except OSError:
+            pass
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class ResultCache(object):
+    '''results of completed replays, stored as JSON'''
+
+    # change this when the format of results changes
+    version = 1
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries = {}
+        if filepath is None:
+            return
+        try:
+            with open(filepath) as f:
+                content = json.load(f)
+            if content.get("version") == self.version:
+                self.entries = content["entries"]
+        except (OSError, ValueError, KeyError):
+            # missing or unreadable cache; start again
+            pass
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, result):
+        self.entries[key] = result
+        self.save()
+
+    def save(self):
+        if self.filepath is None:
+            return
+        tmpname = "%s.%u.tmp" % (self.filepath, os.getpid())
+        with open(tmpname, "w") as f:
+            json.dump({"version": self.version, "entries": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmpname, self.filepath)
+
+
+class ReplayPool(object):
+    '''runs replay tasks in a pool of processes'''
+
+    def __init__(self, jobs=None, cache_file=None):
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        self.jobs = jobs
+        self.cache = ResultCache(cache_file)
+        self.hashes = {}
+
+    def file_hash(self, filepath):
+        filepath = os.path.abspath(filepath)
+        if filepath not in self.hashes:
+            self.hashes[filepath] = file_sha256(filepath)
+        return self.hashes[filepath]
+
+    def cache_key(self, replay_binary, logfile, *extra):
+        '''key for the result of replaying logfile with replay_binary;
+        extra should be anything else the result depends on'''
+        return ":".join([self.file_hash(replay_binary), self.file_hash(logfile)] + [str(x) for x in extra])
+
+    def run(self, tasks, on_result):
+        '''tasks is a list of (name, cache key, function, args).  Calls
+        on_result(name, result) for each task as its result becomes
+        available; cached results are passed back first and have
+        result["cached"] set.  Results are only cached if Replay ran to
+        completion (i.e. did not fail or time out)'''
+        to_run = []
+        for (name, key, function, args) in tasks:
+            result = None
+            if key is not None:
+                result = self.cache.get(key)
+            if result is None:
+                to_run.append((name, key, function, args))
+                continue
+            result = dict(result)
+            result["cached"] = True
+            on_result(name, result)
+
+        if len(to_run) == 0:
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {}
+            for (name, key, function, args) in to_run:
+                futures[executor.submit(function, *args)] = (name, key)
+            for future in concurrent.futures.as_completed(futures):
+                (name, key) = futures[future]
+                try:
+                    result = future.result()
+                except Exception as ex:
+                    result = {
+                        "status": "error",
+                        "messages": [str(ex)],
+                    }
+                if key is not None and result.get("status") == "ok":
+                    self.cache.put(key, result)
+                result = dict(result)
+                result["cached"] = False
+                on_result(name, result)
@@ -6321,22 +6321,15 @@ class AutoTestCopter(vehicle_test_suite.TestSuite):
         return freq, hover_throttle, peakdb
 
     def get_average_esc_frequency(self):
-        mlog = self.dfreader_for_current_onboard_log()
-        rpm_total = 0
-        rpm_count = 0
-        tho = 0
-        while True:
-            m = mlog.recv_match()
-            if m is None:
-                break
-            msg_type = m.get_type()
-            if msg_type == "CTUN":
-                tho = m.ThO
-            elif msg_type == "ESC" and tho > 0.1:
-                rpm_total += m.RPM
-                rpm_count += 1
-
-        esc_hz = rpm_total / (rpm_count * 60)
+        log = self.columnar_dfreader_for_current_onboard_log()
+        ctun = log["CTUN"]
+        esc = log["ESC"]
+        # throttle output from the most recent CTUN logged before each ESC message:
+        ctun_index = numpy.searchsorted(ctun.offsets, esc.offsets) - 1
+        tho = numpy.where(ctun_index >= 0, ctun["ThO"][ctun_index], 0)
+        rpm = esc["RPM"][tho > 0.1]
+
+        esc_hz = rpm.sum() / (len(rpm) * 60)
         return esc_hz
 
     def DynamicNotches(self):
@@ -13743,7 +13736,8 @@ class AutoTestCopter(vehicle_test_suite.TestSuite):
     def testcan(self):
         ret = ([
             self.CANGPSCopterMission,
-            self.TestLogDownloadMAVProxyCAN,
+            # the periph sends to a fixed port, see SITL_Periph_State.h:
+            Test(self.TestLogDownloadMAVProxyCAN, shardable=False),
         ])
         return ret
 
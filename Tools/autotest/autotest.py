@@ -10,8 +10,10 @@ import atexit
 import fnmatch
 import copy
 import glob
+import multiprocessing
 import optparse
 import os
+import queue
 import re
 import shutil
 import signal
@@ -32,9 +34,11 @@ import sailboat
 import helicopter
 
 import examples
+import autotest_durations
 from pysim import util
 from pymavlink.generator import mavtemplate
 
+from vehicle_test_suite import Result
 from vehicle_test_suite import Test
 
 tester = None
@@ -191,11 +195,15 @@ def all_vehicles():
 def build_parameters():
     """Run the param_parse.py script."""
     print("Running param_parse.py")
-    for vehicle in all_vehicles():
-        if util.run_cmd([param_parse_filepath(), '--vehicle', vehicle],
-                        directory=util.reltopdir('.')) != 0:
-            print("Failed param_parse.py (%s)" % vehicle)
-            return False
+    # all vehicles are generated by one process, each into
+    # buildlogs/param_parse/<vehicle>; buildlogs/Parameters belongs to
+    # build_parameters.sh, which publishes it
+    if util.run_cmd([param_parse_filepath(),
+                     '--vehicle', ','.join(all_vehicles()),
+                     '--outdir', buildlogs_path('param_parse')],
+                    directory=util.reltopdir('.')) != 0:
+        print("Failed param_parse.py")
+        return False
     return True
 
 
@@ -395,6 +403,201 @@ def run_specific_test(step, *args, **kwargs):
     sys.exit(1)
 
 
+def durations_db_filepath():
+    """Get path of the database holding historical subtest durations."""
+    if opts.durations_db is not None:
+        return opts.durations_db
+    return buildlogs_path("autotest-test-durations.sqlite")
+
+
+def record_test_durations(step, testinstance):
+    """Add the subtest results from a test step to the durations database."""
+    results_list = getattr(testinstance, "results", None)
+    if results_list is None:
+        return
+    db = autotest_durations.AutoTestDurations(durations_db_filepath())
+    db.add_results(results.githash,
+                   step,
+                   results_list,
+                   speedup=getattr(testinstance, "speedup", None))
+    db.close()
+
+
+def order_tests_longest_first(tests, durations):
+    """Sort tests by historical runtime, longest first.
+
+    Tests with no recorded runtime are assumed to be long so they are
+    started early rather than being left to the end of the run.
+    """
+    if len(durations):
+        unknown = max(durations.values())
+    else:
+        unknown = 0
+    return sorted(tests,
+                  key=lambda t: durations.get(t.name, unknown),
+                  reverse=True)
+
+
+class ShardFailedResult(Result):
+    """A failure which can't be attributed to a single subtest."""
+
+    def __init__(self, description):
+        """Init shard failed result class."""
+        super(ShardFailedResult, self).__init__(None)
+        self.passed = False
+        self.description = description
+
+    def __str__(self):
+        """Return failure description."""
+        return self.description
+
+
+def run_shard(step, shard, binary, fly_opts, work_queue, result_queue):
+    """Run subtests from work_queue on one SITL instance until it is empty."""
+    shard_dir = os.path.join(os.getcwd(), "autotest-shard-%u" % shard)
+    util.mkdir_p(shard_dir)
+    os.chdir(shard_dir)
+    util.run_cmd('/bin/rm -f logs/*.BIN logs/LASTLOG.TXT')
+
+    global tester
+    tester = tester_class_map[step](binary,
+                                    instance=opts.shard_instance_base + shard,
+                                    **fly_opts)
+    tests_by_name = {}
+    for test in tester.tests():
+        if not isinstance(test, Test):
+            test = Test(test)
+        tests_by_name[test.name] = test
+
+    def next_test():
+        while True:
+            name = work_queue.get()
+            if name is None:
+                return
+            yield tests_by_name[name]
+
+    ret = []
+    firmware_info = {}
+    try:
+        for result in tester.run_tests(next_test()):
+            if result.test is None:
+                # e.g. ValgrindFailedResult
+                ret.append({
+                    "name": None,
+                    "passed": False,
+                    "reason": "%s (shard %u)" % (str(result), shard),
+                })
+                continue
+            ret.append({
+                "name": result.test.name,
+                "passed": result.passed,
+                "reason": result.reason,
+                "exception": None if result.exception is None else repr(result.exception),
+                "debug_filename": result.debug_filename,
+                "time_elapsed": result.time_elapsed,
+                "sim_time_elapsed": result.sim_time_elapsed,
+            })
+        tester.post_tests_announcements()
+        # for the jUnit report written by the parent process:
+        for attr in "fcu_firmware_version", "fcu_firmware_hash", "githash":
+            if hasattr(tester, attr):
+                firmware_info[attr] = getattr(tester, attr)
+    except Exception as e:
+        print(">>>> SHARD %u FAILED: %s" % (shard, str(e)))
+        traceback.print_exc(file=sys.stdout)
+        ret.append({
+            "name": None,
+            "passed": False,
+            "reason": "shard %u failed (%s)" % (shard, repr(e)),
+        })
+    finally:
+        util.pexpect_close_all()
+    result_queue.put((shard, ret, firmware_info))
+
+
+def run_sharded_step(step, binary, fly_opts, shard_count):
+    """Run the subtests of a test step across several SITL instances.
+
+    Each shard runs in its own process and working directory with its
+    own SITL instance number, and takes the next-longest remaining
+    subtest off a shared queue whenever it finishes one.  Subtests
+    which are not shardable are run afterwards in this process, once
+    the shards are done.  The merged results are reported just as for
+    a step run on one instance.
+    """
+    global tester
+    tester = tester_class_map[step](binary, **fly_opts)
+    (all_tests, skip_list) = tester.tests_to_run()
+    tests = [test for test in all_tests if test.shardable]
+    serial_tests = [test for test in all_tests if not test.shardable]
+    tests_by_name = {test.name: test for test in tests}
+
+    db = autotest_durations.AutoTestDurations(durations_db_filepath())
+    durations = db.durations(step)
+    db.close()
+    ctx = multiprocessing.get_context("fork")
+    work_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    shard_count = min(shard_count, len(tests))
+    for test in order_tests_longest_first(tests, durations):
+        work_queue.put(test.name)
+    # one end-of-work marker per shard:
+    for shard in range(shard_count):
+        work_queue.put(None)
+    print("Running %u subtests of %s on %u shards" % (len(tests), step, shard_count))
+    processes = []
+    for shard in range(shard_count):
+        p = ctx.Process(target=run_shard,
+                        args=(step, shard, binary, fly_opts, work_queue, result_queue))
+        p.start()
+        processes.append(p)
+
+    results_list = []
+    seen = set()
+    pending = shard_count
+    while pending:
+        try:
+            (shard, shard_results, firmware_info) = result_queue.get(timeout=10)
+        except queue.Empty:
+            if any(p.is_alive() for p in processes):
+                continue
+            results_list.append(ShardFailedResult("shard process died"))
+            break
+        pending -= 1
+        print(">>>> SHARD %u of %s complete" % (shard, step))
+        for (attr, value) in firmware_info.items():
+            setattr(tester, attr, value)
+        for r in shard_results:
+            if r["name"] is None:
+                results_list.append(ShardFailedResult(r["reason"]))
+                continue
+            result = Result(tests_by_name[r["name"]])
+            seen.add(r["name"])
+            result.passed = r["passed"]
+            result.reason = r["reason"]
+            result.exception = r["exception"]
+            result.debug_filename = r["debug_filename"]
+            result.time_elapsed = r["time_elapsed"]
+            result.sim_time_elapsed = r["sim_time_elapsed"]
+            results_list.append(result)
+    for p in processes:
+        p.join()
+
+    # a shard which died part-way through will have dropped tests:
+    for test in tests:
+        if test.name not in seen:
+            result = Result(test)
+            result.passed = False
+            result.reason = "not run by any shard"
+            results_list.append(result)
+
+    if len(serial_tests):
+        print("Running %u unshardable subtests of %s" % (len(serial_tests), step))
+        results_list.extend(tester.run_tests(serial_tests))
+
+    return tester.report_results(results_list, skip_list, step_name=step), tester
+
+
 def run_step(step):
     """Run one step."""
     # remove old logs
@@ -516,11 +719,17 @@ def run_step(step):
         "build_opts": copy.copy(build_opts),
         "generate_junit": opts.junit,
         "enable_fgview": opts.enable_fgview,
+        "mav_reader": opts.mav_reader,
     }
     if opts.speedup is not None:
         fly_opts["speedup"] = opts.speedup
 
     # handle "test.Copter" etc:
+    if (step in tester_class_map and
+            opts.shards > 1 and
+            len(supplementary_binaries) == 0):
+        return run_sharded_step(step, binary, fly_opts, opts.shards)
+
     if step in tester_class_map:
         # create an instance of the tester class:
         global tester
@@ -726,6 +935,8 @@ def run_tests(steps):
             testinstance = None
             if isinstance(success, tuple):
                 (success, testinstance) = success
+            if testinstance is not None:
+                record_test_durations(step, testinstance)
             if success:
                 results.add(step, '<span class="passed-text">PASSED</span>',
                             time.time() - t1)
@@ -773,6 +984,13 @@ def run_tests(steps):
 
     write_fullresults()
 
+    if opts.duration_regression_threshold is not None:
+        db = autotest_durations.AutoTestDurations(durations_db_filepath())
+        print("Subtests more than %.0f%% slower than the previous githash:" %
+              opts.duration_regression_threshold)
+        autotest_durations.print_regressions(db, opts.duration_regression_threshold)
+        db.close()
+
     return passed
 
 
@@ -862,6 +1080,10 @@ if __name__ == "__main__":
     parser.add_option("--enable-fgview",
                       action='store_true',
                       help="Enable FlightGear output")
+    parser.add_option("--mav-reader",
+                      action='store_true',
+                      default=False,
+                      help="read MAVLink from SITL on a background thread rather than draining the link before waits")
     parser.add_option("--map",
                       action='store_true',
                       default=False,
@@ -890,6 +1112,22 @@ if __name__ == "__main__":
                       default=False,
                       action='store_true',
                       help='Generate Junit XML tests report')
+    parser.add_option("--shards",
+                      default=1,
+                      type='int',
+                      help='run the subtests of test steps across this many SITL instances in parallel')
+    parser.add_option("--shard-instance-base",
+                      default=0,
+                      type='int',
+                      help='SITL instance number (-I) used by the first shard')
+    parser.add_option("--durations-db",
+                      default=None,
+                      type='string',
+                      help='database of subtest durations (default: buildlogs/autotest-test-durations.sqlite)')
+    parser.add_option("--duration-regression-threshold",
+                      default=None,
+                      type='float',
+                      help='report subtests which are this percentage slower than on the previous githash')
 
     group_build = optparse.OptionGroup(parser, "Build options")
     group_build.add_option("--no-configure",
@@ -1031,6 +1269,9 @@ if __name__ == "__main__":
 
     opts, args = parser.parse_args()
 
+    if opts.shards > 1 and (opts.gdb or opts.gdbserver or opts.lldb):
+        raise ValueError("--shards can not be used with a debugger")
+
     # canonicalise on opts.debug:
     if opts.debug is None and opts.no_debug is None:
         # default is to create debug SITL binaries
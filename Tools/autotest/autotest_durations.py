@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+'''
+Persistent store of autotest subtest durations.
+
+Every subtest run by autotest.py is recorded along with the git hash
+it ran against, the wallclock and simulated time it took and the
+speedup requested.  The history is used to schedule the longest
+subtests first when running sharded, and to spot subtests which have
+become slower.
+
+e.g.
+  ./Tools/autotest/autotest_durations.py regressions --threshold=25
+  ./Tools/autotest/autotest_durations.py history test.Copter RTLSpeed
+
+AP_FLAKE8_CLEAN
+'''
+
+import optparse
+import os
+import sqlite3
+import time
+
+
+class AutoTestDurations(object):
+    '''wraps an append-only sqlite database of subtest runtimes'''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.db = sqlite3.connect(filepath)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS test_run (
+            timestamp REAL NOT NULL,
+            githash TEXT NOT NULL,
+            step TEXT NOT NULL,
+            test TEXT NOT NULL,
+            passed INTEGER NOT NULL,
+            wall_time REAL NOT NULL,
+            sim_time REAL,
+            speedup REAL
+        )''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS test_run_step_test
+            ON test_run (step, test)''')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def add_results(self, githash, step, results, speedup=None):
+        '''record a list of vehicle_test_suite.Result objects'''
+        now = time.time()
+        rows = []
+        for result in results:
+            if result.test is None:
+                # e.g. ValgrindFailedResult
+                continue
+            rows.append((
+                now,
+                githash,
+                step,
+                result.test.name,
+                1 if result.passed else 0,
+                float(result.time_elapsed),
+                getattr(result, "sim_time_elapsed", None),
+                speedup,
+            ))
+        self.db.executemany('''INSERT INTO test_run
+            (timestamp, githash, step, test, passed, wall_time, sim_time, speedup)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+        self.db.commit()
+
+    def durations(self, step, count=5):
+        '''return dict of test name -> mean wallclock time over the last
+        count passing runs of each subtest in step'''
+        ret = {}
+        for (test, wall_time) in self.db.execute('''
+                SELECT test, wall_time FROM test_run
+                WHERE step=? AND passed=1
+                ORDER BY timestamp DESC''', (step,)):
+            ret.setdefault(test, [])
+            if len(ret[test]) < count:
+                ret[test].append(wall_time)
+        return {test: sum(times)/len(times) for (test, times) in ret.items()}
+
+    def githashes(self):
+        '''return githashes in the order they were first seen'''
+        return [row[0] for row in self.db.execute('''
+            SELECT githash, MIN(timestamp) AS first_seen FROM test_run
+            GROUP BY githash ORDER BY first_seen''')]
+
+    def durations_for_githash(self, githash):
+        '''return dict of (step, test) -> mean wallclock time of the
+        passing runs at githash'''
+        ret = {}
+        for (step, test, wall_time) in self.db.execute('''
+                SELECT step, test, AVG(wall_time) FROM test_run
+                WHERE githash=? AND passed=1
+                GROUP BY step, test''', (githash,)):
+            ret[(step, test)] = wall_time
+        return ret
+
+    def regressions(self, threshold_percent, githash=None, baseline_githash=None):
+        '''return list of (step, test, baseline_time, time, percent)
+        for subtests which took more than threshold_percent longer at
+        githash than at baseline_githash.  By default the two most
+        recently-seen githashes are compared.'''
+        githashes = self.githashes()
+        if githash is None:
+            if len(githashes) == 0:
+                return []
+            githash = githashes[-1]
+        if baseline_githash is None:
+            older = [x for x in githashes if x != githash]
+            if len(older) == 0:
+                return []
+            baseline_githash = older[-1]
+        baseline = self.durations_for_githash(baseline_githash)
+        ret = []
+        for (key, wall_time) in self.durations_for_githash(githash).items():
+            if key not in baseline or baseline[key] <= 0:
+                continue
+            percent = (wall_time - baseline[key]) / baseline[key] * 100
+            if percent > threshold_percent:
+                (step, test) = key
+                ret.append((step, test, baseline[key], wall_time, percent))
+        return sorted(ret, key=lambda x: x[4], reverse=True)
+
+    def history(self, step, test=None):
+        '''return list of (githash, speedup, runs, wall_time, sim_time)
+        totals for step (or one subtest of it), oldest first'''
+        query = '''SELECT githash, speedup, COUNT(*), SUM(wall_time), SUM(sim_time), MIN(timestamp) AS first_seen
+            FROM test_run WHERE step=? AND passed=1'''
+        args = [step]
+        if test is not None:
+            query += ' AND test=?'
+            args.append(test)
+        query += ' GROUP BY githash, speedup ORDER BY first_seen'
+        return [row[:5] for row in self.db.execute(query, args)]
+
+
+def print_history(db, step, test=None):
+    print("%-40s %8s %5s %10s %10s %8s" %
+          ("githash", "speedup", "runs", "wall", "sim", "achieved"))
+    for (githash, speedup, runs, wall_time, sim_time) in db.history(step, test=test):
+        achieved = "-"
+        if sim_time is not None and wall_time > 0:
+            achieved = "%.1f" % (sim_time / wall_time)
+        print("%-40s %8s %5u %10.1f %10s %8s" % (
+            githash,
+            "-" if speedup is None else "%g" % speedup,
+            runs,
+            wall_time,
+            "-" if sim_time is None else "%.1f" % sim_time,
+            achieved))
+
+
+def print_regressions(db, threshold_percent, githash=None, baseline_githash=None):
+    regressions = db.regressions(threshold_percent,
+                                 githash=githash,
+                                 baseline_githash=baseline_githash)
+    for (step, test, baseline_time, wall_time, percent) in regressions:
+        print("%s.%s: %.1fs -> %.1fs (+%.0f%%)" %
+              (step, test, baseline_time, wall_time, percent))
+    return len(regressions)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(
+        "autotest_durations.py [options] regressions|history STEP [TEST]",
+    )
+    parser.add_option("--db",
+                      type='string',
+                      default=os.path.join(os.getenv("BUILDLOGS", "../buildlogs"), "autotest-test-durations.sqlite"),
+                      help='durations database to use')
+    parser.add_option("--threshold",
+                      type='float',
+                      default=20,
+                      help='percentage slowdown considered a regression')
+    parser.add_option("--githash",
+                      type='string',
+                      default=None,
+                      help='githash to check for regressions (default: most recent)')
+    parser.add_option("--baseline-githash",
+                      type='string',
+                      default=None,
+                      help='githash to compare against (default: the one before --githash)')
+
+    opts, args = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        raise SystemExit(1)
+
+    db = AutoTestDurations(opts.db)
+    if args[0] == "regressions":
+        if print_regressions(db, opts.threshold, opts.githash, opts.baseline_githash):
+            raise SystemExit(1)
+    elif args[0] == "history":
+        if len(args) not in (2, 3):
+            parser.print_help()
+            raise SystemExit(1)
+        print_history(db, *args[1:])
+    else:
+        parser.print_help()
+        raise SystemExit(1)
@@ -12,6 +12,8 @@ import re
 import subprocess
 import time
 
+import autotest_durations
+
 
 class CheckAutoTestSpeedup(object):
     def __init__(
@@ -21,7 +23,8 @@ class CheckAutoTestSpeedup(object):
             min_speedup=1,
             max_speedup=50,
             gdb=False,
-            debug=False
+            debug=False,
+            durations_db=None,
     ):
         self.build_target = build_target
         self.test_target = test_target
@@ -29,6 +32,7 @@ class CheckAutoTestSpeedup(object):
         self.max_speedup = max_speedup
         self.gdb = gdb
         self.debug = debug
+        self.durations_db = durations_db
 
     def progress(self, message):
         print("PROGRESS: %s" % (message,))
@@ -99,6 +103,18 @@ class CheckAutoTestSpeedup(object):
         for (speedup, t) in results.items():
             print("%u %f" % (speedup, t))
 
+        self.show_history()
+
+    def show_history(self):
+        '''show times recorded by autotest for the test target across
+        all githashes and speedups it has been run at'''
+        if self.durations_db is None or not os.path.exists(self.durations_db):
+            return
+        self.progress("History for %s:" % self.test_target)
+        db = autotest_durations.AutoTestDurations(self.durations_db)
+        autotest_durations.print_history(db, self.test_target)
+        db.close()
+
 
 if __name__ == '__main__':
     parser = optparse.OptionParser(
@@ -128,6 +144,14 @@ if __name__ == '__main__':
                       type='string',
                       default='test.QuadPlane',
                       help='test target (e.g. test.QuadPlane)')
+    parser.add_option("--durations-db",
+                      type='string',
+                      default=os.path.join(os.getenv("BUILDLOGS", "../buildlogs"), "autotest-test-durations.sqlite"),
+                      help='autotest durations database to show history from')
+    parser.add_option("--history",
+                      action='store_true',
+                      default=False,
+                      help='only show recorded history for the test target')
 
     opts, args = parser.parse_args()
 
@@ -137,7 +161,11 @@ if __name__ == '__main__':
         max_speedup=opts.max_speedup,
         min_speedup=opts.min_speedup,
         build_target=opts.build_target,
-        test_target=opts.test_target
+        test_target=opts.test_target,
+        durations_db=opts.durations_db,
     )
 
-    checker.run()
+    if opts.history:
+        checker.show_history()
+    else:
+        checker.run()
@@ -24,9 +24,14 @@ class EnumDocco(object):
         "Blimp": "Blimp",
     }
 
-    def __init__(self, vehicle):
+    # change this when enumerations_from_fileobj changes to invalidate
+    # cached results
+    cache_version = 1
+
+    def __init__(self, vehicle, source_cache=None):
         self.vehicle = vehicle
         self.enumerations = []
+        self.source_cache = source_cache
 
     class EnumEntry(object):
         def __init__(self, name, value, comment):
@@ -99,6 +104,20 @@ class EnumDocco(object):
             raise ValueError("Failed to match (%s)" % line)
 
     def enumerations_from_file(self, source_file):
+        if self.source_cache is None:
+            with open(source_file) as f:
+                found = self.enumerations_from_fileobj(f)
+        else:
+            found = self.source_cache.get("enum", source_file, self.enumerations_from_fileobj)
+        enumerations = []
+        for (enum_name, entries) in found:
+            entries = [EnumDocco.EnumEntry(name, value, comment) for (name, value, comment) in entries]
+            enumerations.append(EnumDocco.Enumeration(enum_name, entries))
+        return enumerations
+
+    def enumerations_from_fileobj(self, f):
+        '''return a list of (name, [(name, value, comment), ...]) for the
+        enumerations in an open source file'''
         def debug(x):
             pass
         # if source_file == "/home/pbarker/rc/ardupilot/libraries/AP_HAL/AnalogIn.h":
@@ -109,117 +128,114 @@ class EnumDocco(object):
         state = state_outside
 
         enumerations = []
-        with open(source_file) as f:
-            enum_name = None
-            in_class = None
-            while True:
-                line = f.readline()
-                #  debug(f"{state} line: {line}")
-                if line == "":
-                    break
-                line = line.rstrip()
-                #        print("state=%s line: %s" % (state, line))
-                # Skip single-line comments - unless they contain LoggerEnum tags
-                if re.match(r"\s*//.*", line) and "LoggerEnum" not in line:
+        enum_name = None
+        in_class = None
+        while True:
+            line = f.readline()
+            #  debug(f"{state} line: {line}")
+            if line == "":
+                break
+            line = line.rstrip()
+            #        print("state=%s line: %s" % (state, line))
+            # Skip single-line comments - unless they contain LoggerEnum tags
+            if re.match(r"\s*//.*", line) and "LoggerEnum" not in line:
+                continue
+            # Skip multi-line comments
+            if re.match(r"\s*/\*.*", line):
+                while "*/" not in line:
+                    line = f.readline()
+                continue
+            if state == "outside":
+                if re.match("class .*;", line) is not None:
+                    # forward-declaration of a class
+                    continue
+                m = re.match(r"class *([:\w]+)", line)
+                if m is not None:
+                    in_class = m.group(1)
+                    continue
+                m = re.match(r"namespace *(\w+)", line)
+                if m is not None:
+                    in_class = m.group(1)
+                    continue
+                m = re.match(r".*enum\s*(class)? *([\w]+)\s*(?::.*_t)? *{(.*)};", line)
+                if m is not None:
+                    # all one one line!  Thanks!
+                    enum_name = m.group(2)
+                    debug("ol: %s" % enum_name)
+                    entries_string = m.group(3)
+                    entry_names = [x.strip() for x in entries_string.split(",")]
+                    count = 0
+                    entries = []
+                    for entry in entry_names:
+                        entries.append((enum_name, count, None))
+                        count += 1
+                    enumerations.append((enum_name, entries))
+                    continue
+
+                m = re.match(r".*enum\s*(class)? *([\w]+)\s*(?::.*_t)? *{", line)
+                if m is not None:
+                    enum_name = m.group(2)
+                    debug("%s" % enum_name)
+                    entries = []
+                    last_value = None
+                    state = state_inside
+                    skip_enumeration = False
                     continue
-                # Skip multi-line comments
-                if re.match(r"\s*/\*.*", line):
-                    while "*/" not in line:
-                        line = f.readline()
+
+                # // @LoggerEnum: NAME  -  can be used around for #define sets
+                m = re.match(r".*@LoggerEnum: *([\w:]+)", line)
+                if m is not None:
+                    enum_name = m.group(1)
+                    debug("%s" % enum_name)
+                    entries = []
+                    last_value = None
+                    state = state_inside
+                    skip_enumeration = False
                     continue
-                if state == "outside":
-                    if re.match("class .*;", line) is not None:
-                        # forward-declaration of a class
-                        continue
-                    m = re.match(r"class *([:\w]+)", line)
-                    if m is not None:
-                        in_class = m.group(1)
-                        continue
-                    m = re.match(r"namespace *(\w+)", line)
-                    if m is not None:
-                        in_class = m.group(1)
-                        continue
-                    m = re.match(r".*enum\s*(class)? *([\w]+)\s*(?::.*_t)? *{(.*)};", line)
-                    if m is not None:
-                        # all one one line!  Thanks!
-                        enum_name = m.group(2)
-                        debug("ol: %s: %s" % (source_file, enum_name))
-                        entries_string = m.group(3)
-                        entry_names = [x.strip() for x in entries_string.split(",")]
-                        count = 0
-                        entries = []
-                        for entry in entry_names:
-                            entries.append(EnumDocco.EnumEntry(enum_name, count, None))
-                            count += 1
-                        new_enumeration = EnumDocco.Enumeration(enum_name, entries)
-                        enumerations.append(new_enumeration)
-                        continue
-
-                    m = re.match(r".*enum\s*(class)? *([\w]+)\s*(?::.*_t)? *{", line)
-                    if m is not None:
-                        enum_name = m.group(2)
-                        debug("%s: %s" % (source_file, enum_name))
-                        entries = []
-                        last_value = None
-                        state = state_inside
-                        skip_enumeration = False
-                        continue
-
-                    # // @LoggerEnum: NAME  -  can be used around for #define sets
-                    m = re.match(r".*@LoggerEnum: *([\w:]+)", line)
-                    if m is not None:
-                        enum_name = m.group(1)
-                        debug("%s: %s" % (source_file, enum_name))
-                        entries = []
-                        last_value = None
-                        state = state_inside
-                        skip_enumeration = False
-                        continue
 
+                continue
+            if state == "inside":
+                if re.match(r"\s*enum.*$", line):
+                    # Allow @LoggerEnum around Enum for name override
+                    continue
+                if re.match(r"\s*$", line):
+                    continue
+                if re.match(r"#if", line):
+                    continue
+                if re.match(r"#endif", line):
+                    continue
+                if re.match(r"#else", line):
+                    continue
+                if re.match(r".*}\s*\w*(\s*=\s*[\w:]+)?;", line) or "@LoggerEnumEnd" in line:
+                    # potential end of enumeration
+                    if not skip_enumeration:
+                        if enum_name is None:
+                            raise Exception("WT??")
+                        if in_class is not None:
+                            enum_name = "::".join([in_class, enum_name])
+                        enumerations.append((enum_name, entries))
+                        # print("Got enum (%s)" % enum_name)
+                        #                        for entry in new_enumeration.entries:
+                        #                            print("   %s: %u (%s)" % (entry.name, entry.value, entry.comment))
+                    state = state_outside
+                    continue
+                (name, value, comment) = self.match_enum_line(line)
+                if name is None:
+                    skip_enumeration = True
                     continue
-                if state == "inside":
-                    if re.match(r"\s*enum.*$", line):
-                        # Allow @LoggerEnum around Enum for name override
-                        continue
-                    if re.match(r"\s*$", line):
-                        continue
-                    if re.match(r"#if", line):
-                        continue
-                    if re.match(r"#endif", line):
-                        continue
-                    if re.match(r"#else", line):
-                        continue
-                    if re.match(r".*}\s*\w*(\s*=\s*[\w:]+)?;", line) or "@LoggerEnumEnd" in line:
-                        # potential end of enumeration
-                        if not skip_enumeration:
-                            if enum_name is None:
-                                raise Exception("WT??")
-                            if in_class is not None:
-                                enum_name = "::".join([in_class, enum_name])
-                            new_enumeration = EnumDocco.Enumeration(enum_name, entries)
-                            enumerations.append(new_enumeration)
-                            # print("Got enum (%s)" % enum_name)
-                            #                        for entry in new_enumeration.entries:
-                            #                            print("   %s: %u (%s)" % (entry.name, entry.value, entry.comment))
-                        state = state_outside
-                        continue
-                    (name, value, comment) = self.match_enum_line(line)
-                    if name is None:
-                        skip_enumeration = True
-                        continue
-                    debug(" name=(%s) value=(%s) comment=(%s)\n" % (name, value, comment))
-                    if value is None:
-                        if last_value is None:
-                            value = 0
-                            last_value = 0
-                        else:
-                            last_value += 1
-                            value = last_value
+                debug(" name=(%s) value=(%s) comment=(%s)\n" % (name, value, comment))
+                if value is None:
+                    if last_value is None:
+                        value = 0
+                        last_value = 0
                     else:
-                        value = int(value)
-                        last_value = value
-                        # print("entry=%s value=%s comment=%s" % (name, value, comment))
-                    entries.append(EnumDocco.EnumEntry(name, value, comment))
+                        last_value += 1
+                        value = last_value
+                else:
+                    value = int(value)
+                    last_value = value
+                    # print("entry=%s value=%s comment=%s" % (name, value, comment))
+                entries.append((name, value, comment))
         return enumerations
 
     class Enumeration(object):
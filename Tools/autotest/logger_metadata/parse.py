@@ -17,6 +17,7 @@ import emit_md
 
 import enum_parse
 from enum_parse import EnumDocco
+from source_cache import SourceCache
 
 topdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../../')
 topdir = os.path.realpath(topdir)
@@ -73,6 +74,171 @@ mult_prefix_lookup = {
 }
 
 
+class FileScanner(object):
+    '''
+    finds the message definitions and docco blocks in one source file.
+    Nothing here depends on the vehicle, so the results can be cached
+    and shared between vehicles; they are a list of events which
+    LoggerDocco.apply_events replays in file order:
+
+      ("fmt"|"units"|"mults", name, value)
+      ("write", name, fmts, units, mults)
+      ("docco", name, [(Docco method name, args), ...])
+    '''
+
+    def __init__(self):
+        self.events = []
+
+    def parse_messagedef(self, messagedef):
+        # Merge concatenated strings and remove comments
+        messagedef = re.sub(r'"\s+"', '', messagedef)
+        messagedef = re.sub(r'//[^\n]*', '', messagedef)
+        # Extract details from a structure definition
+        d = re_full_messagedef.search(messagedef)
+        if d is not None:
+            self.events.append(("fmt", d.group(1), d.group(2)))
+            self.events.append(("units", d.group(1), d.group(4)))
+            self.events.append(("mults", d.group(1), d.group(5)))
+            return
+        # Extract details from a WriteStreaming call
+        d = re_full_writecall.search(messagedef)
+        if d is not None:
+            if d.group(5) is None:
+                self.events.append(("write", d.group(1), d.group(3), None, None))
+            else:
+                self.events.append(("write", d.group(1), d.group(6), d.group(3), d.group(5)))
+            return
+        # Didn't parse
+        # print(f"Unable to parse: {messagedef}")
+
+    def search_messagedef_start(self, line, prevmessagedef=""):
+        # Look for the start of a structure definition
+        d = re_start_messagedef.search(line)
+        if d is not None:
+            messagedef = line
+            if "}" in line:
+                self.parse_messagedef(messagedef)
+                return ""
+            else:
+                return messagedef
+        # Look for a new call to WriteStreaming
+        d = re_start_writecall.search(line)
+        if d is not None:
+            messagedef = line
+            if ";" in line:
+                self.parse_messagedef(messagedef)
+                return ""
+            else:
+                return messagedef
+        # If we didn't find a new one, continue with any previous state
+        return prevmessagedef
+
+    def scan(self, f):
+        lines = f.readlines()
+
+        def debug(x):
+            pass
+        state_outside = "outside"
+        state_inside = "inside"
+        messagedef = ""
+        state = state_outside
+        docco = None
+        for line in lines:
+            debug(f"{state}: {line}")
+            if messagedef:
+                messagedef = messagedef + line
+                if "}" in line or ";" in line:
+                    self.parse_messagedef(messagedef)
+                    messagedef = ""
+            if state == state_outside:
+                # Check for start of a message definition
+                messagedef = self.search_messagedef_start(line, messagedef)
+
+                # Check for fmt/unit/mult #define
+                u = re_fmt_define.search(line)
+                if u is not None:
+                    self.events.append(("fmt", u.group(1), u.group(2)))
+                u = re_units_define.search(line)
+                if u is not None:
+                    self.events.append(("units", u.group(1), u.group(2)))
+                u = re_mults_define.search(line)
+                if u is not None:
+                    self.events.append(("mults", u.group(1), u.group(2)))
+
+                # Check for the @LoggerMessage tag indicating the start of the docco block
+                m = re_loggermessage.search(line)
+                if m is None:
+                    continue
+                name = m.group(1)
+                if "," in name:
+                    name = name.split(",")
+                state = state_inside
+                docco = (name, [])
+            elif state == state_inside:
+                # If this line is not a comment, then this is the end of the docco block
+                if not re_commentline.match(line):
+                    state = state_outside
+                    self.events.append(("docco",) + docco)
+                    messagedef = self.search_messagedef_start(line)
+                    continue
+                calls = docco[1]
+                # Check for an multiple @LoggerMessage lines in this docco block
+                m = re_loggermessage.search(line)
+                if m is not None:
+                    name = m.group(1)
+                    if "," in name:
+                        name = name.split(",")
+                    calls.append(("add_name", (name,)))
+                    continue
+                # Find and extract data from the various docco fields
+                m = re_description.match(line)
+                if m is not None:
+                    calls.append(("set_description", (m.group(1),)))
+                    continue
+                m = re_url.match(line)
+                if m is not None:
+                    calls.append(("set_url", (m.group(1),)))
+                    continue
+                m = re_field.match(line)
+                if m is not None:
+                    calls.append(("set_field_description", (m.group(1), m.group(2))))
+                    continue
+                m = re_fieldbits.match(line)
+                if m is not None:
+                    calls.append(("set_field_bits", (m.group(1), m.group(2))))
+                    continue
+                m = re_fieldbitmaskenum.match(line)
+                if m is not None:
+                    calls.append(("set_fieldbitmaskenum", (m.group(1), m.group(2))))
+                    continue
+                m = re_fieldvalueenum.match(line)
+                if m is not None:
+                    calls.append(("set_fieldvalueenum", (m.group(1), m.group(2))))
+                    continue
+                m = re_vehicles.match(line)
+                if m is not None:
+                    calls.append(("set_vehicles", ([x.strip() for x in m.group(1).split(',')],)))
+                    continue
+                print("Unknown field (%s)" % str(line))
+                sys.exit(1)
+        return self.events
+
+
+def scan_file(f):
+    '''return the events for an open source file; see FileScanner'''
+    return FileScanner().scan(f)
+
+
+def cache_signature():
+    '''anything which changes what the scanners return'''
+    patterns = [x.pattern for x in [
+        re_loggermessage, re_commentline, re_description, re_url, re_field,
+        re_fieldbits, re_fieldbitmaskenum, re_fieldvalueenum, re_vehicles,
+        re_start_messagedef, re_full_messagedef, re_fmt_define, re_units_define,
+        re_mults_define, re_start_writecall, re_full_writecall]]
+    return (EnumDocco.cache_version, patterns)
+
+
 class LoggerDocco(object):
 
     vehicle_map = {
@@ -84,8 +250,9 @@ class LoggerDocco(object):
         "Blimp": "Blimp",
     }
 
-    def __init__(self, vehicle):
+    def __init__(self, vehicle, source_cache=None):
         self.vehicle = vehicle
+        self.source_cache = source_cache
         self.doccos = []
         self.emitters = [
             emit_html.HTMLEmitter(),
@@ -284,147 +451,41 @@ class LoggerDocco(object):
         if len(_next):
             self.search_for_files(_next)
 
-    def parse_messagedef(self, messagedef):
-        # Merge concatenated strings and remove comments
-        messagedef = re.sub(r'"\s+"', '', messagedef)
-        messagedef = re.sub(r'//[^\n]*', '', messagedef)
-        # Extract details from a structure definition
-        d = re_full_messagedef.search(messagedef)
-        if d is not None:
-            self.msg_fmts_list[d.group(1)] = d.group(2)
-            self.msg_units_list[d.group(1)] = d.group(4)
-            self.msg_mults_list[d.group(1)] = d.group(5)
-            return
-        # Extract details from a WriteStreaming call
-        d = re_full_writecall.search(messagedef)
-        if d is not None:
-            if d.group(1) in self.msg_fmts_list:
-                return
-            if d.group(5) is None:
-                self.msg_fmts_list[d.group(1)] = d.group(3)
-            else:
-                self.msg_fmts_list[d.group(1)] = d.group(6)
-                self.msg_units_list[d.group(1)] = d.group(3)
-                self.msg_mults_list[d.group(1)] = d.group(5)
-            return
-        # Didn't parse
-        # print(f"Unable to parse: {messagedef}")
-
-    def search_messagedef_start(self, line, prevmessagedef=""):
-        # Look for the start of a structure definition
-        d = re_start_messagedef.search(line)
-        if d is not None:
-            messagedef = line
-            if "}" in line:
-                self.parse_messagedef(messagedef)
-                return ""
-            else:
-                return messagedef
-        # Look for a new call to WriteStreaming
-        d = re_start_writecall.search(line)
-        if d is not None:
-            messagedef = line
-            if ";" in line:
-                self.parse_messagedef(messagedef)
-                return ""
-            else:
-                return messagedef
-        # If we didn't find a new one, continue with any previous state
-        return prevmessagedef
-
     def parse_file(self, filepath):
-        with open(filepath) as f:
-            # print("Opened (%s)" % filepath)
-            lines = f.readlines()
-            f.close()
-
-        def debug(x):
-            pass
-        #        if filepath == "/home/pbarker/rc/ardupilot/libraries/AP_HAL/AnalogIn.h":
-        #            debug = print
-        state_outside = "outside"
-        state_inside = "inside"
-        messagedef = ""
-        state = state_outside
-        docco = None
-        for line in lines:
-            debug(f"{state}: {line}")
-            if messagedef:
-                messagedef = messagedef + line
-                if "}" in line or ";" in line:
-                    self.parse_messagedef(messagedef)
-                    messagedef = ""
-            if state == state_outside:
-                # Check for start of a message definition
-                messagedef = self.search_messagedef_start(line, messagedef)
-
-                # Check for fmt/unit/mult #define
-                u = re_fmt_define.search(line)
-                if u is not None:
-                    self.msg_fmts_list[u.group(1)] = u.group(2)
-                u = re_units_define.search(line)
-                if u is not None:
-                    self.msg_units_list[u.group(1)] = u.group(2)
-                u = re_mults_define.search(line)
-                if u is not None:
-                    self.msg_mults_list[u.group(1)] = u.group(2)
-
-                # Check for the @LoggerMessage tag indicating the start of the docco block
-                m = re_loggermessage.search(line)
-                if m is None:
+        if self.source_cache is None:
+            with open(filepath) as f:
+                events = scan_file(f)
+        else:
+            events = self.source_cache.get("logger", filepath, scan_file)
+        self.apply_events(events)
+
+    def apply_events(self, events):
+        '''apply the results of scan_file for this vehicle'''
+        for event in events:
+            kind = event[0]
+            if kind == "fmt":
+                self.msg_fmts_list[event[1]] = event[2]
+            elif kind == "units":
+                self.msg_units_list[event[1]] = event[2]
+            elif kind == "mults":
+                self.msg_mults_list[event[1]] = event[2]
+            elif kind == "write":
+                # a Write call never overrides a structure definition
+                (name, fmts, units, mults) = event[1:]
+                if name in self.msg_fmts_list:
                     continue
-                name = m.group(1)
-                if "," in name:
-                    name = name.split(",")
-                state = state_inside
+                self.msg_fmts_list[name] = fmts
+                if units is not None:
+                    self.msg_units_list[name] = units
+                    self.msg_mults_list[name] = mults
+            elif kind == "docco":
+                # copy the arguments as Docco modifies lists in place
+                (name, calls) = copy.deepcopy(event[1:])
                 docco = LoggerDocco.Docco(name)
-            elif state == state_inside:
-                # If this line is not a comment, then this is the end of the docco block
-                if not re_commentline.match(line):
-                    state = state_outside
-                    if docco.vehicles is None or self.vehicle in docco.vehicles:
-                        self.finalise_docco(docco)
-                    messagedef = self.search_messagedef_start(line)
-                    continue
-                # Check for an multiple @LoggerMessage lines in this docco block
-                m = re_loggermessage.search(line)
-                if m is not None:
-                    name = m.group(1)
-                    if "," in name:
-                        name = name.split(",")
-                    docco.add_name(name)
-                    continue
-                # Find and extract data from the various docco fields
-                m = re_description.match(line)
-                if m is not None:
-                    docco.set_description(m.group(1))
-                    continue
-                m = re_url.match(line)
-                if m is not None:
-                    docco.set_url(m.group(1))
-                    continue
-                m = re_field.match(line)
-                if m is not None:
-                    docco.set_field_description(m.group(1), m.group(2))
-                    continue
-                m = re_fieldbits.match(line)
-                if m is not None:
-                    docco.set_field_bits(m.group(1), m.group(2))
-                    continue
-                m = re_fieldbitmaskenum.match(line)
-                if m is not None:
-                    docco.set_fieldbitmaskenum(m.group(1), m.group(2))
-                    continue
-                m = re_fieldvalueenum.match(line)
-                if m is not None:
-                    docco.set_fieldvalueenum(m.group(1), m.group(2))
-                    continue
-                m = re_vehicles.match(line)
-                if m is not None:
-                    docco.set_vehicles([x.strip() for x in m.group(1).split(',')])
-                    continue
-                print("Unknown field (%s)" % str(line))
-                sys.exit(1)
+                for (method, args) in calls:
+                    getattr(docco, method)(*args)
+                if docco.vehicles is None or self.vehicle in docco.vehicles:
+                    self.finalise_docco(docco)
 
     def parse_files(self):
         for _file in self.files:
@@ -485,10 +546,12 @@ class LoggerDocco(object):
 
     def run(self):
         self.populate_lookups()
-        self.enumerations = enum_parse.EnumDocco(self.vehicle).get_enumerations()
+        self.enumerations = enum_parse.EnumDocco(self.vehicle, source_cache=self.source_cache).get_enumerations()
         self.files = []
         self.search_for_files([self.vehicle_map[self.vehicle], "libraries"])
         self.parse_files()
+        if self.source_cache is not None:
+            self.source_cache.save()
         self.emit_output()
 
     def finalise_docco(self, docco):
@@ -500,10 +563,18 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Parse parameters.")
     parser.add_argument("-v", "--verbose", dest='verbose', action='store_true', default=False, help="show debugging output")
     parser.add_argument("--vehicle", required=True, help="Vehicle type to generate for")
+    parser.add_argument("--cache-file",
+                        default=os.path.join(topdir, "build", "logger_metadata.cache"),
+                        help="file to cache scanned source files in (default build/logger_metadata.cache)")
+    parser.add_argument("--no-cache", action='store_true', default=False, help="don't cache scanned source files")
 
     args = parser.parse_args()
 
-    s = LoggerDocco(args.vehicle)
+    source_cache = None
+    if not args.no_cache:
+        source_cache = SourceCache(args.cache_file, signature=cache_signature())
+
+    s = LoggerDocco(args.vehicle, source_cache=source_cache)
 
     if args.vehicle not in s.vehicle_map:
         print("Invalid vehicle (choose from: %s)" % str(s.vehicle_map.keys()))
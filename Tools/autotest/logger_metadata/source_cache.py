@@ -0,0 +1,78 @@
+'''
+cache of per-file scan results for the logger metadata parsers.
+
+Scanning every source file in the tree for @LoggerMessage blocks and
+enumerations takes most of the time parse.py runs for, and the
+results for a file do not depend on the vehicle being documented.
+Entries are keyed by path and reused while the file's mtime and size
+are unchanged; if those change the contents are hashed, so touching a
+file (e.g. by a checkout) does not force a rescan.
+
+AP_FLAKE8_CLEAN
+'''
+
+import hashlib
+import io
+import os
+import pickle
+
+
+class SourceCache(object):
+
+    # change this when the format of the cache changes
+    version = 1
+
+    def __init__(self, filepath, signature=None):
+        '''signature should change whenever the scanners' results would
+        change; a cache with a different signature is discarded'''
+        self.filepath = filepath
+        self.signature = signature
+        self.entries = {}
+        self.dirty = False
+        if filepath is None:
+            return
+        try:
+            with open(filepath, 'rb') as f:
+                (version, signature, entries) = pickle.load(f)
+            if version == self.version and signature == self.signature:
+                self.entries = entries
+        except Exception:
+            # missing or unreadable cache; start again
+            pass
+
+    def get(self, kind, filepath, scanner):
+        '''return scanner(f) for an open text file f, from the cache if
+        the file is unchanged since it was last scanned for kind'''
+        key = (kind, filepath)
+        st = os.stat(filepath)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[3]
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if entry is not None and entry[2] == digest:
+            result = entry[3]
+        else:
+            # decode exactly as open(filepath) would have
+            result = scanner(io.TextIOWrapper(io.BytesIO(data)))
+        self.entries[key] = (st.st_mtime_ns, st.st_size, digest, result)
+        self.dirty = True
+        return result
+
+    def save(self):
+        if self.filepath is None or not self.dirty:
+            return
+        # forget files which have been removed
+        self.entries = {k: v for (k, v) in self.entries.items() if os.path.exists(k[1])}
+        try:
+            directory = os.path.dirname(self.filepath)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            # write via a temporary file as vehicles may be running in parallel
+            tmpname = "%s.%u.tmp" % (self.filepath, os.getpid())
+            with open(tmpname, 'wb') as f:
+                pickle.dump((self.version, self.signature, self.entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self.filepath)
+        except OSError as e:
+            print("Failed to save source cache: %s" % str(e))
@@ -3,14 +3,27 @@
 '''Generates parameter metadata files suitable for consumption by
   ground control stations and various web services
 
+  Several vehicles may be given as a comma-separated list. They are
+  parsed one after another in this process, sharing the parsed source
+  files, while the emitters run in a pool of worker processes. Each
+  emitter writes into a scratch directory, and files whose contents
+  are unchanged are left untouched. The parse cache also records a
+  hash of each emitter's input and output, so an emitter is not run
+  again when its input and output files are unchanged.
+
   AP_FLAKE8_CLEAN
 
 '''
 
+import concurrent.futures
 import copy
+import hashlib
 import os
+import pickle
 import re
+import shutil
 import sys
+import tempfile
 from argparse import ArgumentParser
 
 from param import (Library, Parameter, Vehicle, known_group_fields,
@@ -22,24 +35,6 @@ from xmlemit import XmlEmit
 from mdemit import MDEmit
 from jsonemit import JSONEmit
 
-parser = ArgumentParser(description="Parse ArduPilot parameters.")
-parser.add_argument("-v", "--verbose", dest='verbose', action='store_true', default=False, help="show debugging output")
-parser.add_argument("--vehicle", required=True, help="Vehicle type to generate for")
-parser.add_argument("--no-emit",
-                    dest='emit_params',
-                    action='store_false',
-                    default=True,
-                    help="don't emit parameter documentation, just validate")
-parser.add_argument("--format",
-                    dest='output_format',
-                    action='store',
-                    default='all',
-                    choices=['all', 'html', 'rst', 'rstlatexpdf', 'wiki', 'xml', 'json', 'edn', 'md'],
-                    help="what output format to use")
-
-args = parser.parse_args()
-
-
 # Regular expressions for parsing the parameter metadata
 
 prog_param = re.compile(r"@Param(?:{([^}]+)})?: (\w+).*((?:\n[ \t]*// @(\w+)(?:{([^}]+)})?: ?(.*))+)(?:\n[ \t\r]*\n|\n[ \t]+[A-Z]|\n\-\-\]\])", re.MULTILINE)  # noqa
@@ -54,6 +49,139 @@ prog_groups = re.compile(r"@Group: *(\w+).*((?:\n[ \t]*// @(Path): (\S+))+)", re
 apm_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../../')
 
 
+class ParseCache(object):
+    '''
+    cache of the regex matches for each source file, keyed by a hash of
+    the file contents. Only the raw matches are stored; turning them
+    into Parameter and Library objects depends on the vehicle and
+    library prefix, so that is done every run.
+
+    It also records the outputs of each emitter for each output
+    directory, with a hash of what the emitter was given, so emitters
+    whose input and output files are unchanged can be skipped
+    '''
+    # change this when the parsing changes to invalidate old caches
+    version = 2
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries = {}
+        # (output directory, emitter name) => (input hash, {filename: hash})
+        self.outputs = {}
+        # source file path => (params, groups) for this run
+        self.files = {}
+        self.used = set()
+        self.dirty = False
+        if filepath is None:
+            return
+        try:
+            with open(filepath, 'rb') as f:
+                (version, patterns, entries, outputs) = pickle.load(f)
+            if version == self.version and patterns == self.patterns():
+                self.entries = entries
+                self.outputs = outputs
+        except Exception:
+            # missing or unreadable cache; start again
+            pass
+
+    @staticmethod
+    def patterns():
+        return (prog_param.pattern, prog_param_fields.pattern,
+                prog_param_tagged_fields.pattern, prog_groups.pattern)
+
+    @staticmethod
+    def parse_text(p_text):
+        '''return the parameter and group matches in a source file'''
+        params = []
+        for (only_vehicles, param_name, field_text) in [m[:3] for m in prog_param.findall(p_text)]:
+            params.append((only_vehicles,
+                           param_name,
+                           field_text,
+                           prog_param_fields.findall(field_text),
+                           prog_param_tagged_fields.findall(field_text)))
+        groups = []
+        for group_match in prog_groups.findall(p_text):
+            groups.append((group_match[0], prog_param_fields.findall(group_match[1])))
+        return (params, groups)
+
+    def parse(self, filepath):
+        '''return (params, groups) for a file, from the cache if the file
+        is unchanged. Each file is only read once per run, however many
+        vehicles use it'''
+        filepath = os.path.normpath(filepath)
+        if filepath in self.files:
+            return self.files[filepath]
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        key = hashlib.sha1(data).hexdigest()
+        self.used.add(key)
+        if key not in self.entries:
+            # match the universal newline handling of reading in text mode
+            text = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+            self.entries[key] = self.parse_text(text)
+            self.dirty = True
+        self.files[filepath] = self.entries[key]
+        return self.files[filepath]
+
+    def outputs_unchanged(self, outdir, emitter_name, input_hash):
+        '''return True if the emitter was last run in outdir with the same
+        input, and the files it wrote are still there and unchanged'''
+        entry = self.outputs.get((outdir, emitter_name))
+        if entry is None or entry[0] != input_hash:
+            return False
+        for (fname, file_hash) in entry[1].items():
+            fpath = os.path.join(outdir, fname)
+            if not os.path.exists(fpath) or file_sha1(fpath) != file_hash:
+                return False
+        return True
+
+    def recorded_outputs(self, outdir, emitter_name):
+        '''return filename => hash of the files the emitter last wrote
+        into outdir'''
+        entry = self.outputs.get((outdir, emitter_name))
+        if entry is None:
+            return {}
+        return entry[1]
+
+    def set_outputs(self, outdir, emitter_name, input_hash, hashes):
+        if self.outputs.get((outdir, emitter_name)) != (input_hash, hashes):
+            self.outputs[(outdir, emitter_name)] = (input_hash, hashes)
+            self.dirty = True
+
+    def save(self):
+        if self.filepath is None:
+            return
+        # runs for a single vehicle share the cache, so only drop
+        # entries when it has grown well beyond what one run needs
+        if len(self.entries) > 4 * len(self.used) + 1000:
+            self.entries = {k: v for (k, v) in self.entries.items() if k in self.used}
+            self.dirty = True
+        if not self.dirty:
+            return
+        try:
+            directory = os.path.dirname(self.filepath)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            # write via a temporary file as vehicles may be running in parallel
+            tmpname = "%s.%u.tmp" % (self.filepath, os.getpid())
+            with open(tmpname, 'wb') as f:
+                pickle.dump((self.version, self.patterns(), self.entries, self.outputs), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self.filepath)
+            self.dirty = False
+        except OSError as e:
+            print("Failed to save parse cache: %s" % str(e))
+
+
+def file_sha1(filepath):
+    with open(filepath, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# replaced in main() once the arguments are known
+parse_cache = ParseCache(None)
+verbose = False
+
+
 def find_vehicle_parameter_filepath(vehicle_name):
     apm_tools_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../../Tools/')
 
@@ -81,7 +209,7 @@ def find_vehicle_parameter_filepath(vehicle_name):
 
 def debug(str_to_print):
     """Debug output if verbose is set."""
-    if args.verbose:
+    if verbose:
         print(str_to_print)
 
 
@@ -105,17 +233,9 @@ def lua_applets():
     return lua_lib
 
 
+# state for the vehicle being parsed, set up by parse_vehicle()
 libraries = []
-
-if args.vehicle != "AP_Periph":
-    # AP_Vehicle also has parameters rooted at "", but isn't referenced
-    # from the vehicle in any way:
-    ap_vehicle_lib = Library("", reference="VEHICLE") # the "" is tacked onto the front of param name
-    setattr(ap_vehicle_lib, "Path", os.path.join('..', 'libraries', 'AP_Vehicle', 'AP_Vehicle.cpp'))
-    libraries.append(ap_vehicle_lib)
-
-libraries.append(lua_applets())
-
+alllibs = []
 error_count = 0
 current_param = None
 current_file = None
@@ -142,35 +262,22 @@ truename_map = {
     "Blimp": "Blimp",
 }
 valid_truenames = frozenset(truename_map.values())
-truename = truename_map.get(args.vehicle, args.vehicle)
 
 documentation_tags_which_are_comma_separated_nv_pairs = frozenset([
     'Values',
     'Bitmask',
 ])
 
-vehicle_path = find_vehicle_parameter_filepath(args.vehicle)
-
-basename = os.path.basename(os.path.dirname(vehicle_path))
-path = os.path.normpath(os.path.dirname(vehicle_path))
-reference = basename  # so links don't break we use ArduCopter
-vehicle = Vehicle(truename, path, reference=reference)
-debug('Found vehicle type %s' % vehicle.name)
-
 
 def process_vehicle(vehicle):
     debug("===\n\n\nProcessing %s" % vehicle.name)
     current_file = vehicle.path+'/Parameters.cpp'
 
-    f = open(current_file)
-    p_text = f.read()
-    f.close()
-    group_matches = prog_groups.findall(p_text)
+    (param_matches, group_matches) = parse_cache.parse(current_file)
 
     debug(group_matches)
-    for group_match in group_matches:
-        lib = Library(group_match[0])
-        fields = prog_param_fields.findall(group_match[1])
+    for (group_name, fields) in group_matches:
+        lib = Library(group_name)
         for field in fields:
             if field[0] in known_group_fields:
                 setattr(lib, field[0], field[1])
@@ -179,13 +286,7 @@ def process_vehicle(vehicle):
         if not any(lib.name == parsed_l.name for parsed_l in libraries):
             libraries.append(lib)
 
-    param_matches = []
-    param_matches = prog_param.findall(p_text)
-
-    for param_match in param_matches:
-        (only_vehicles, param_name, field_text) = (param_match[0],
-                                                   param_match[1],
-                                                   param_match[2])
+    for (only_vehicles, param_name, field_text, fields, tagged_fields) in param_matches:
         if len(only_vehicles):
             only_vehicles_list = [x.strip() for x in only_vehicles.split(",")]
             for only_vehicle in only_vehicles_list:
@@ -197,7 +298,6 @@ def process_vehicle(vehicle):
         debug(p.name + ' ')
         global current_param
         current_param = p.name
-        fields = prog_param_fields.findall(field_text)
         p.__field_text = field_text
         field_list = []
         for field in fields:
@@ -229,15 +329,6 @@ def process_vehicle(vehicle):
     debug("Processed %u params" % len(vehicle.params))
 
 
-process_vehicle(vehicle)
-
-debug("Found %u documented libraries" % len(libraries))
-
-libraries = list(libraries)
-
-alllibs = libraries[:]
-
-
 def process_library(vehicle, library, pathprefix=None):
     '''process one library'''
     paths = library.Path.split(',')
@@ -253,19 +344,13 @@ def process_library(vehicle, library, pathprefix=None):
         else:
             libraryfname = os.path.normpath(os.path.join(apm_path + '/libraries/' + path))
         if path and os.path.exists(libraryfname):
-            f = open(libraryfname)
-            p_text = f.read()
-            f.close()
+            (param_matches, group_matches) = parse_cache.parse(libraryfname)
         else:
             error("Path %s not found for library %s (fname=%s)" % (path, library.name, libraryfname))
             continue
 
-        param_matches = prog_param.findall(p_text)
         debug("Found %u documented parameters" % len(param_matches))
-        for param_match in param_matches:
-            (only_vehicles, param_name, field_text) = (param_match[0],
-                                                       param_match[1],
-                                                       param_match[2])
+        for (only_vehicles, param_name, field_text, fields, tagged_fields) in param_matches:
             if len(only_vehicles):
                 only_vehicles_list = [x.strip() for x in only_vehicles.split(",")]
                 for only_vehicle in only_vehicles_list:
@@ -277,7 +362,6 @@ def process_library(vehicle, library, pathprefix=None):
             debug(p.name + ' ')
             global current_param
             current_param = p.name
-            fields = prog_param_fields.findall(field_text)
             p.__field_text = field_text
             field_list = []
             for field in fields:
@@ -301,7 +385,7 @@ def process_library(vehicle, library, pathprefix=None):
                     error("param: unknown parameter metadata field %s" % field[0])
 
             debug("matching %s" % field_text)
-            fields = prog_param_tagged_fields.findall(field_text)
+            fields = tagged_fields
             # a parameter is considered to be vehicle-specific if
             # there does not exist a Values: or Values{VehicleName}
             # for that vehicle but @Values{OtherVehicle} exists.
@@ -375,12 +459,10 @@ def process_library(vehicle, library, pathprefix=None):
                     continue
                 library.params.append(p)
 
-        group_matches = prog_groups.findall(p_text)
         debug("Found %u groups" % len(group_matches))
         debug(group_matches)
         done_groups = dict()
-        for group_match in group_matches:
-            group = group_match[0]
+        for (group, fields) in group_matches:
             debug("Group: %s" % group)
             do_append = True
             if group in done_groups:
@@ -393,7 +475,6 @@ def process_library(vehicle, library, pathprefix=None):
                 lib = Library(group)
                 done_groups[group] = lib
 
-            fields = prog_param_fields.findall(group_match[1])
             for field in fields:
                 if field[0] in known_group_fields:
                     setattr(lib, field[0], field[1])
@@ -412,22 +493,6 @@ def process_library(vehicle, library, pathprefix=None):
     current_file = None
 
 
-for library in libraries:
-    debug("===\n\n\nProcessing library %s" % library.name)
-
-    if hasattr(library, 'Path'):
-        process_library(vehicle, library)
-    else:
-        error("Skipped: no Path found")
-
-    debug("Processed %u documented parameters" % len(library.params))
-
-# sort libraries by name
-alllibs = sorted(alllibs, key=lambda x: x.name)
-
-libraries = alllibs
-
-
 def is_number(numberString):
     try:
         float(numberString)
@@ -585,46 +650,96 @@ def validate(param, is_library=False):
             error("missing parameter metadata field '%s' in %s" % (req_field, param.__field_text))
 
 
-# handle CopyFieldsFrom and CopyValuesFrom:
-for param in vehicle.params:
-    do_copy_fields(vehicle.params, libraries, param)
-for library in libraries:
-    for param in library.params:
-        do_copy_fields(vehicle.params, libraries, param)
+def parse_vehicle(vehicle_name):
+    '''parse the parameter documentation for a vehicle. Returns
+    (vehicle, libraries, error count)'''
+    global libraries, alllibs, error_count, current_param, current_file
+    error_count = 0
+    current_param = None
+    current_file = None
+
+    libraries = []
+    if vehicle_name != "AP_Periph":
+        # AP_Vehicle also has parameters rooted at "", but isn't referenced
+        # from the vehicle in any way:
+        ap_vehicle_lib = Library("", reference="VEHICLE") # the "" is tacked onto the front of param name
+        setattr(ap_vehicle_lib, "Path", os.path.join('..', 'libraries', 'AP_Vehicle', 'AP_Vehicle.cpp'))
+        libraries.append(ap_vehicle_lib)
+
+    libraries.append(lua_applets())
+
+    truename = truename_map.get(vehicle_name, vehicle_name)
+    vehicle_path = find_vehicle_parameter_filepath(vehicle_name)
+
+    basename = os.path.basename(os.path.dirname(vehicle_path))
+    path = os.path.normpath(os.path.dirname(vehicle_path))
+    reference = basename  # so links don't break we use ArduCopter
+    vehicle = Vehicle(truename, path, reference=reference)
+    debug('Found vehicle type %s' % vehicle.name)
 
-for param in vehicle.params:
-    clean_param(param)
-
-for param in vehicle.params:
-    validate(param)
-
-# Find duplicate names in library and fix up path
-for library in libraries:
-    param_names_seen = set()
-    param_names_duplicate = set()
-    # Find duplicates:
-    for param in library.params:
-        if param.name in param_names_seen:  # is duplicate
-            param_names_duplicate.add(param.name)
-        param_names_seen.add(param.name)
-    # Fix up path for duplicates
-    for param in library.params:
-        if param.name in param_names_duplicate:
-            param.path = param.path.rsplit('/')[-1].rsplit('.')[0]
+    process_vehicle(vehicle)
+
+    debug("Found %u documented libraries" % len(libraries))
+
+    libraries = list(libraries)
+
+    alllibs = libraries[:]
+
+    for library in libraries:
+        debug("===\n\n\nProcessing library %s" % library.name)
+
+        if hasattr(library, 'Path'):
+            process_library(vehicle, library)
         else:
-            # not a duplicate, so delete attribute.
-            delattr(param, "path")
+            error("Skipped: no Path found")
+
+        debug("Processed %u documented parameters" % len(library.params))
+
+    # sort libraries by name
+    alllibs = sorted(alllibs, key=lambda x: x.name)
+
+    libraries = alllibs
+
+    # handle CopyFieldsFrom and CopyValuesFrom:
+    for param in vehicle.params:
+        do_copy_fields(vehicle.params, libraries, param)
+    for library in libraries:
+        for param in library.params:
+            do_copy_fields(vehicle.params, libraries, param)
 
-for library in libraries:
-    for param in library.params:
+    for param in vehicle.params:
         clean_param(param)
 
-for library in libraries:
-    for param in library.params:
-        validate(param, is_library=True)
+    for param in vehicle.params:
+        validate(param)
+
+    # Find duplicate names in library and fix up path
+    for library in libraries:
+        param_names_seen = set()
+        param_names_duplicate = set()
+        # Find duplicates:
+        for param in library.params:
+            if param.name in param_names_seen:  # is duplicate
+                param_names_duplicate.add(param.name)
+            param_names_seen.add(param.name)
+        # Fix up path for duplicates
+        for param in library.params:
+            if param.name in param_names_duplicate:
+                param.path = param.path.rsplit('/')[-1].rsplit('.')[0]
+            else:
+                # not a duplicate, so delete attribute.
+                delattr(param, "path")
+
+    for library in libraries:
+        for param in library.params:
+            clean_param(param)
+
+    for library in libraries:
+        for param in library.params:
+            validate(param, is_library=True)
+
+    return (vehicle, libraries, error_count)
 
-if not args.emit_params:
-    sys.exit(error_count)
 
 all_emitters = {
     'json': JSONEmit,
@@ -639,21 +754,15 @@ try:
     from ednemit import EDNEmit
     all_emitters['edn'] = EDNEmit
 except ImportError:
-    # if the user wanted edn only then don't hide any errors
-    if args.output_format == 'edn':
-        raise
+    pass
 
-    if args.verbose:
-        print("Unable to emit EDN, install edn_format and pytz if edn is desired")
+# emitters whose output changes from run to run (the EDN output
+# includes the time and git hash), so are always run
+unstable_emitters = frozenset(['edn'])
 
-# filter to just the ones we want to emit:
-emitters_to_use = []
-for emitter_name in all_emitters.keys():
-    if args.output_format == 'all' or args.output_format == emitter_name:
-        emitters_to_use.append(emitter_name)
 
-# actually invoke each emitter:
-for emitter_name in emitters_to_use:
+def emit_vehicle(vehicle, libraries, emitter_name):
+    '''run one emitter for a vehicle, writing into the current directory'''
     emit = all_emitters[emitter_name]()
 
     emit.emit(vehicle)
@@ -684,4 +793,166 @@ for emitter_name in emitters_to_use:
 
     emit.close()
 
-sys.exit(error_count)
+
+def emit_outputs(outdir, vehicle, libraries, emitter_name):
+    '''run one emitter for a vehicle in a scratch directory, then move the
+    files it wrote into outdir, leaving any whose contents are unchanged
+    untouched. Returns a dictionary of filename => hash of the files
+    written'''
+    tmpdir = tempfile.mkdtemp(prefix=".param_parse-", dir=outdir)
+    try:
+        old_dir = os.getcwd()
+        os.chdir(tmpdir)
+        try:
+            emit_vehicle(vehicle, libraries, emitter_name)
+        finally:
+            os.chdir(old_dir)
+        hashes = {}
+        for fname in sorted(os.listdir(tmpdir)):
+            tmppath = os.path.join(tmpdir, fname)
+            hashes[fname] = file_sha1(tmppath)
+            outpath = os.path.join(outdir, fname)
+            if os.path.exists(outpath) and file_sha1(outpath) == hashes[fname]:
+                continue
+            os.replace(tmppath, outpath)
+        return hashes
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def record_outputs(outdir, emitter_name, input_hash, hashes):
+    '''record the files an emitter wrote, removing any it wrote last time
+    but not this time (if they are still as it left them)'''
+    for (fname, file_hash) in parse_cache.recorded_outputs(outdir, emitter_name).items():
+        if fname in hashes:
+            continue
+        fpath = os.path.join(outdir, fname)
+        if os.path.exists(fpath) and file_sha1(fpath) == file_hash:
+            debug("Removing stale %s" % fpath)
+            os.unlink(fpath)
+    parse_cache.set_outputs(outdir, emitter_name, input_hash, hashes)
+
+
+def emitter_input_hash(model_hash, emitter_name):
+    '''hash of everything the output of an emitter depends on'''
+    h = hashlib.sha1()
+    h.update(model_hash.encode('ascii'))
+    h.update(emitter_name.encode('ascii'))
+    # the emitters, and the Parameter and Library classes they are given
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    for fname in sorted(os.listdir(script_dir)):
+        if fname.endswith(".py"):
+            h.update(fname.encode('utf-8'))
+            h.update(file_sha1(os.path.join(script_dir, fname)).encode('ascii'))
+    # the markdown emitter's output depends on this
+    h.update(repr(os.getenv('BRDOC')).encode('utf-8'))
+    return h.hexdigest()
+
+
+def generate(vehicle_names, outdirs, emitter_names, emit_params=True, jobs=None):
+    '''parse each vehicle in turn, writing its output into the matching
+    entry of outdirs. Returns the total error count'''
+    errors = 0
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    executor = None
+    if emit_params and jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    futures = {}
+    try:
+        for (vehicle_name, outdir) in zip(vehicle_names, outdirs):
+            if len(vehicle_names) > 1:
+                print("==== %s" % vehicle_name)
+            (vehicle, libraries, vehicle_errors) = parse_vehicle(vehicle_name)
+            errors += vehicle_errors
+            if not emit_params:
+                continue
+            outdir = os.path.abspath(outdir)
+            if not os.path.exists(outdir):
+                os.makedirs(outdir)
+            model_hash = hashlib.sha1(pickle.dumps((vehicle, libraries), protocol=4)).hexdigest()
+            for emitter_name in emitter_names:
+                input_hash = emitter_input_hash(model_hash, emitter_name)
+                if (emitter_name not in unstable_emitters and
+                        parse_cache.outputs_unchanged(outdir, emitter_name, input_hash)):
+                    debug("%s output for %s is up to date" % (emitter_name, vehicle_name))
+                    continue
+                if executor is None:
+                    hashes = emit_outputs(outdir, vehicle, libraries, emitter_name)
+                    record_outputs(outdir, emitter_name, input_hash, hashes)
+                    continue
+                future = executor.submit(emit_outputs, outdir, vehicle, libraries, emitter_name)
+                futures[future] = (outdir, emitter_name, input_hash)
+        for future in concurrent.futures.as_completed(futures):
+            (outdir, emitter_name, input_hash) = futures[future]
+            record_outputs(outdir, emitter_name, input_hash, future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        parse_cache.save()
+    return errors
+
+
+def main():
+    global parse_cache, verbose
+
+    parser = ArgumentParser(description="Parse ArduPilot parameters.")
+    parser.add_argument("-v", "--verbose", dest='verbose', action='store_true', default=False, help="show debugging output")
+    parser.add_argument("--vehicle", required=True,
+                        help="Vehicle type to generate for. A comma-separated list generates each vehicle into a "
+                        "subdirectory of the same name")
+    parser.add_argument("--no-emit",
+                        dest='emit_params',
+                        action='store_false',
+                        default=True,
+                        help="don't emit parameter documentation, just validate")
+    parser.add_argument("--format",
+                        dest='output_format',
+                        action='store',
+                        default='all',
+                        choices=['all', 'html', 'rst', 'rstlatexpdf', 'wiki', 'xml', 'json', 'edn', 'md'],
+                        help="what output format to use")
+    parser.add_argument("--outdir",
+                        default='.',
+                        help="directory to write into (default the current directory)")
+    parser.add_argument("--cache-file",
+                        default=None,
+                        help="file to cache parsed source files in (default build/param_parse.cache)")
+    parser.add_argument("--no-cache", action='store_true', default=False, help="don't cache parsed source files")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of emitters to run at once")
+
+    args = parser.parse_args()
+
+    verbose = args.verbose
+    if args.no_cache:
+        parse_cache = ParseCache(None)
+    elif args.cache_file is not None:
+        parse_cache = ParseCache(args.cache_file)
+    else:
+        parse_cache = ParseCache(os.path.join(apm_path, "build", "param_parse.cache"))
+
+    if 'edn' not in all_emitters:
+        # if the user wanted edn only then don't hide any errors
+        if args.output_format == 'edn':
+            from ednemit import EDNEmit  # noqa: F401
+
+        if args.verbose:
+            print("Unable to emit EDN, install edn_format and pytz if edn is desired")
+
+    # filter to just the ones we want to emit:
+    emitters_to_use = []
+    for emitter_name in all_emitters.keys():
+        if args.output_format == 'all' or args.output_format == emitter_name:
+            emitters_to_use.append(emitter_name)
+
+    vehicle_names = [v.strip() for v in args.vehicle.split(",")]
+    if len(vehicle_names) > 1:
+        outdirs = [os.path.join(args.outdir, v) for v in vehicle_names]
+    else:
+        outdirs = [args.outdir]
+
+    return generate(vehicle_names, outdirs, emitters_to_use, emit_params=args.emit_params, jobs=args.jobs)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
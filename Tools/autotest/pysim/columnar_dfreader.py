@@ -0,0 +1,244 @@
+'''
+Columnar reader for binary DataFlash (.BIN) logs.
+
+pymavlink's DFReader decodes a log one message at a time into Python
+objects.  That is convenient but very slow when a test only wants to
+know (e.g.) the maximum ATT.Roll over a time window of a large log.
+
+ColumnarDFReader memory-maps the log, scans it once to learn the FMT
+table and where each message lives, and then decodes all messages of
+a type into a NumPy structured array the first time that type is
+asked for:
+
+    log = ColumnarDFReader("00000001.BIN")
+    att = log["ATT"]
+    roll = att["Roll"][att.between(tstart_us, tend_us)]
+    print(roll.max())
+
+Field scaling follows DFReader (e.g. 'L' fields are degrees, 'c'
+fields are divided by 100).  Each message type also carries the file
+offsets of its messages, so the relative order of messages of
+different types can be recovered with numpy.searchsorted.
+
+AP_FLAKE8_CLEAN
+'''
+
+import mmap
+import struct
+
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+HEAD1 = 0xA3
+HEAD2 = 0x95
+FMT_ID = 128
+FMT_STRUCT = struct.Struct("<BB4s16s64s")
+
+# format character -> (numpy dtype, multiplier); mirrors
+# DFReader.FORMAT_TO_STRUCT
+FORMAT_TO_DTYPE = {
+    "a": (("<i2", (32,)), None),
+    "b": ("<i1", None),
+    "B": ("<u1", None),
+    "g": ("<f2", None),
+    "h": ("<i2", None),
+    "H": ("<u2", None),
+    "i": ("<i4", None),
+    "I": ("<u4", None),
+    "f": ("<f4", None),
+    "n": ("S4", None),
+    "N": ("S16", None),
+    "Z": ("S64", None),
+    "c": ("<i2", 0.01),
+    "C": ("<u2", 0.01),
+    "e": ("<i4", 0.01),
+    "E": ("<u4", 0.01),
+    "L": ("<i4", 1.0e-7),
+    "d": ("<f8", None),
+    "M": ("<i1", None),
+    "q": ("<i8", None),
+    "Q": ("<u8", None),
+}
+
+
+def null_term(b):
+    '''decode a NUL-padded bytes field'''
+    return b.split(b"\0", 1)[0].decode("ascii", errors="replace")
+
+
+class DFFormat(object):
+    '''one FMT message'''
+    def __init__(self, type, name, length, format, columns):
+        self.type = type
+        self.name = name
+        self.length = length
+        self.format = format
+        self.columns = columns
+        self.multipliers = {}
+        fields = []
+        for (col, fmtchar) in zip(columns, format):
+            (dtype, mult) = FORMAT_TO_DTYPE[fmtchar]
+            fields.append((col, dtype))
+            if mult is not None:
+                self.multipliers[col] = mult
+        self.dtype = numpy.dtype(fields)
+        if self.dtype.itemsize != length - 3:
+            raise ValueError("FMT %s: format %s has size %u, FMT says %u" %
+                             (name, format, self.dtype.itemsize, length - 3))
+
+
+class DFMessageColumns(object):
+    '''all messages of one type, decoded into arrays'''
+    def __init__(self, fmt, offsets, raw):
+        self.fmt = fmt
+        self.name = fmt.name
+        self.columns = fmt.columns
+        self.offsets = offsets
+        self.raw = raw
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, column):
+        '''return the (scaled) values of column as a numpy array'''
+        if column not in self._cache:
+            values = self.raw[column]
+            mult = self.fmt.multipliers.get(column)
+            if mult is not None:
+                values = values * mult
+            self._cache[column] = values
+        return self._cache[column]
+
+    def between(self, tstart_us=None, tend_us=None, column="TimeUS"):
+        '''return a boolean mask of messages with tstart_us <= column < tend_us'''
+        t = self[column]
+        mask = numpy.ones(len(t), dtype=bool)
+        if tstart_us is not None:
+            mask &= t >= tstart_us
+        if tend_us is not None:
+            mask &= t < tend_us
+        return mask
+
+    def split(self, column):
+        '''return dict of value -> DFMessageColumns, e.g. split("C")
+        to separate EKF cores or split("I") for IMU instances'''
+        ret = {}
+        values = self.raw[column]
+        for value in numpy.unique(values):
+            mask = values == value
+            ret[value.item()] = DFMessageColumns(self.fmt, self.offsets[mask], self.raw[mask])
+        return ret
+
+
+class ColumnarDFReader(object):
+    '''memory-mapped, lazily-decoded DataFlash log'''
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.formats = {}         # type id -> DFFormat
+        self.formats_by_name = {}  # name -> DFFormat
+        self.skipped_bytes = 0
+        self._offsets = {}        # type id -> list of file offsets
+        # type id -> length of messages whose FMT we can't decode
+        self.undecodable_lengths = {}
+        self._columns = {}        # name -> DFMessageColumns
+        with open(filepath, "rb") as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # mmap refuses zero-length files
+                self.data = b""
+        self.buf = numpy.frombuffer(self.data, dtype=numpy.uint8)
+        self._scan()
+
+    def _scan(self):
+        '''walk the log once, recording the FMT table and the offset of
+        every message'''
+        data = self.data
+        size = len(data)
+        formats = self.formats
+        offsets = self._offsets
+        ofs = 0
+        while ofs + 3 <= size:
+            if data[ofs] != HEAD1 or data[ofs+1] != HEAD2:
+                ofs += 1
+                self.skipped_bytes += 1
+                continue
+            msgid = data[ofs+2]
+            if msgid == FMT_ID:
+                if ofs + 3 + FMT_STRUCT.size > size:
+                    break
+                (mtype, length, name, fmt, columns) = FMT_STRUCT.unpack_from(data, ofs+3)
+                name = null_term(name)
+                try:
+                    f = DFFormat(mtype,
+                                 name,
+                                 length,
+                                 null_term(fmt),
+                                 null_term(columns).split(","))
+                    formats[mtype] = f
+                    self.formats_by_name[name] = f
+                except (KeyError, ValueError) as e:
+                    print("WARNING: %s: can't decode FMT %s (%s); skipping its messages" %
+                          (self.filepath, name, str(e)))
+                    if length >= 3:
+                        self.undecodable_lengths[mtype] = length
+                ofs += 3 + FMT_STRUCT.size
+                continue
+            fmt = formats.get(msgid)
+            if fmt is None and msgid in self.undecodable_lengths:
+                # step over messages we can't decode rather than
+                # resyncing through them
+                ofs += self.undecodable_lengths[msgid]
+                continue
+            if fmt is None:
+                # not a message we know; resync on the next header
+                ofs += 1
+                self.skipped_bytes += 1
+                continue
+            if ofs + fmt.length > size:
+                # truncated final message
+                break
+            try:
+                offsets[msgid].append(ofs)
+            except KeyError:
+                offsets[msgid] = [ofs]
+            ofs += fmt.length
+
+    def message_types(self):
+        '''return names of message types present in the log'''
+        return sorted([self.formats[t].name for t in self._offsets.keys()])
+
+    def __contains__(self, name):
+        fmt = self.formats_by_name.get(name)
+        return fmt is not None and fmt.type in self._offsets
+
+    def __getitem__(self, name):
+        '''return DFMessageColumns for all messages of type name'''
+        if name not in self._columns:
+            self._columns[name] = self._decode(name)
+        return self._columns[name]
+
+    def _decode(self, name):
+        fmt = self.formats_by_name.get(name)
+        if fmt is None:
+            raise KeyError("No FMT for %s in %s" % (name, self.filepath))
+        offsets = numpy.array(self._offsets.get(fmt.type, []), dtype=numpy.int64)
+        payload_length = fmt.length - 3
+        if len(offsets) == 0 or payload_length == 0:
+            raw = numpy.empty(len(offsets), dtype=fmt.dtype)
+            return DFMessageColumns(fmt, offsets, raw)
+        # view the log, without copying it, as an (overlapping) row of
+        # payload_length bytes starting at each byte.  Indexing that by
+        # message gathers the payloads into one contiguous block with
+        # an index of one entry per message rather than one per byte:
+        rows = sliding_window_view(self.buf, payload_length)
+        block = rows[offsets + 3]
+        raw = block.view(fmt.dtype).reshape(len(offsets))
+        return DFMessageColumns(fmt, offsets, raw)
+
+    def close(self):
+        self._columns = {}
+        self.buf = None
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
@@ -0,0 +1,229 @@
+'''
+Background reader for the autotest MAVLink connection.
+
+Normally messages only leave the socket when the test calls
+recv_match(), so before waiting for something fresh the test suite
+has to "drain" the link: stop SITL with SIGSTOP, spin on recv() until
+the socket is empty and then let SITL run again.  At high speedups
+that is a noticeable part of every wait.
+
+MAVReader moves the socket onto a thread which reads and decodes
+messages as they arrive and queues them in a bounded buffer.  The
+connection's recv_msg() and select() are replaced so that everything
+built on them (recv_match, the wait_* helpers) consumes from that
+buffer; message hooks and mav.messages are still updated on the
+caller's thread, in arrival order, as each message is consumed.
+
+    mav = mavutil.mavlink_connection("tcp:127.0.0.1:5760", ...)
+    reader = MAVReader(mav)
+    reader.start()
+    ...
+    reader.sync()      # everything sent so far is now in the buffer
+    reader.discard()   # throw it away unparsed
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import os
+import select
+import struct
+import threading
+import time
+
+
+class MAVReader(object):
+    '''reads and decodes messages from a mavutil TCP connection in a
+    background thread'''
+
+    def __init__(self, mav, maxlen=100000):
+        self.mav = mav
+        self.maxlen = maxlen
+        self.queue = collections.deque()
+        # number of messages thrown away because the buffer was full
+        self.dropped = 0
+        # protects the queue and the counters below:
+        self.cond = threading.Condition()
+        # held while the socket is being used or replaced:
+        self.socket_lock = threading.RLock()
+        # incremented each time the thread finds the socket empty:
+        self.empty_count = 0
+        self.error = None
+        self.paused = False
+        self.should_quit = False
+        self.thread = None
+        # writing to this wakes the thread up for sync():
+        (self.wakeup_r, self.wakeup_w) = os.pipe()
+
+        self._recv = mav.recv
+        self._write = mav.write
+        self._close = mav.close
+        self._do_connect = mav.do_connect
+
+        mav.recv_msg = self.recv_msg
+        mav.select = self.select
+        mav.write = self.write
+        mav.close = self.close
+        mav.do_connect = self.do_connect
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='MAVReader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''stop the thread and give the connection back its own methods'''
+        self.should_quit = True
+        os.write(self.wakeup_w, b'x')
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for name in ["recv_msg", "select", "write", "close", "do_connect"]:
+            delattr(self.mav, name)
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    # methods replacing those of the connection:
+
+    def recv_msg(self):
+        '''return the next buffered message, or None if there is none'''
+        with self.cond:
+            if self.error is not None:
+                error = self.error
+                self.error = None
+                raise error
+            if len(self.queue) == 0:
+                return None
+            msg = self.queue.popleft()
+        self.mav.post_message(msg)
+        return msg
+
+    def select(self, timeout):
+        '''wait for up to timeout seconds for a message to be buffered'''
+        with self.cond:
+            if len(self.queue) == 0 and self.error is None:
+                self.cond.wait(timeout)
+            return len(self.queue) != 0 or self.error is not None
+
+    def write(self, buf):
+        with self.socket_lock:
+            return self._write(buf)
+
+    def close(self):
+        with self.socket_lock:
+            self.paused = True
+            return self._close()
+
+    def do_connect(self):
+        with self.socket_lock:
+            ret = self._do_connect()
+            self.mav.fd = self.mav.port.fileno()
+            self.paused = False
+            return ret
+
+    # draining:
+
+    def pending(self):
+        '''number of messages waiting in the buffer'''
+        with self.cond:
+            return len(self.queue)
+
+    def sync(self, timeout=10):
+        '''wait until everything received on the socket before this call
+        is in the buffer.  Returns False if that did not happen in time
+        (e.g. the connection is closed)'''
+        with self.cond:
+            # the next empty check may have started before we were
+            # called, so wait for the one after that:
+            target = self.empty_count + 2
+            os.write(self.wakeup_w, b'x')
+            tstart = time.time()
+            while self.empty_count < target:
+                remaining = timeout - (time.time() - tstart)
+                if remaining <= 0 or self.paused:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def discard(self):
+        '''throw away all buffered messages without processing them;
+        returns the number discarded'''
+        with self.cond:
+            count = len(self.queue)
+            self.queue.clear()
+        return count
+
+    # the thread:
+
+    def queue_messages(self, msgs):
+        with self.cond:
+            for msg in msgs:
+                if len(self.queue) >= self.maxlen:
+                    self.queue.popleft()
+                    self.dropped += 1
+                self.queue.append(msg)
+            self.cond.notify_all()
+
+    def note_empty(self):
+        with self.cond:
+            self.empty_count += 1
+            self.cond.notify_all()
+
+    def read_available(self):
+        '''read and decode whatever is on the socket.  Returns False if
+        there was nothing to read'''
+        mav = self.mav
+        with self.socket_lock:
+            if self.paused or mav.port is None:
+                return False
+            (rin, win, xin) = select.select([mav.port], [], [], 0)
+            if len(rin) == 0:
+                return False
+            port = mav.port
+            data = self._recv(65536)
+            if len(data) == 0:
+                if mav.port is port:
+                    # closed by the other end and not reconnected;
+                    # wait for do_connect()
+                    self.paused = True
+                return False
+        if mav.logfile_raw:
+            mav.logfile_raw.write(data)
+        if mav.first_byte:
+            mav.auto_mavlink_version(data)
+        msgs = mav.mav.parse_buffer(data)
+        if msgs is None:
+            return True
+        if mav.logfile:
+            for msg in msgs:
+                if msg.get_type() != 'BAD_DATA':
+                    usec = int(time.time() * 1.0e6) & ~3
+                    mav.logfile.write(struct.pack('>Q', usec) + msg.get_msgbuf())
+        self.queue_messages(msgs)
+        return True
+
+    def run(self):
+        while not self.should_quit:
+            try:
+                while self.read_available():
+                    pass
+            except Exception as e:
+                # hand the failure to whoever reads next, and stop
+                # reading until the connection is re-established
+                with self.cond:
+                    self.error = e
+                    self.paused = True
+                    self.cond.notify_all()
+                continue
+            self.note_empty()
+            fds = [self.wakeup_r]
+            with self.socket_lock:
+                if not self.paused and self.mav.port is not None:
+                    fds.append(self.mav.port)
+            try:
+                (rin, win, xin) = select.select(fds, [], [], 0.1)
+            except (OSError, ValueError):
+                # socket closed while we were waiting
+                continue
+            if self.wakeup_r in rin:
+                os.read(self.wakeup_r, 4096)
@@ -20,6 +20,7 @@ from pysim import util
 from vehicle_test_suite import AutoTestTimeoutException
 from vehicle_test_suite import NotAchievedException
 from vehicle_test_suite import PreconditionFailedException
+from vehicle_test_suite import Test
 
 from pymavlink import mavextra
 from pymavlink import mavutil
@@ -3126,7 +3127,7 @@ Brakes have negligible effect (with=%0.2fm without=%0.2fm delta=%0.2fm)
             self.progress("ensure a mavlink1 connection can't do anything useful with new item types")
             self.set_parameter("SERIAL2_PROTOCOL", 1)
             self.reboot_sitl()
-            mav2 = mavutil.mavlink_connection("tcp:localhost:5763",
+            mav2 = mavutil.mavlink_connection("tcp:localhost:%u" % self.adjust_ardupilot_port(5763),
                                               robust_parsing=True,
                                               source_system=7,
                                               source_component=7)
@@ -3550,7 +3551,7 @@ Brakes have negligible effect (with=%0.2fm without=%0.2fm delta=%0.2fm)
         self.drain_mav()
 
         self.start_subtest("No clear mission while it is being uploaded by a different node")
-        mav2 = mavutil.mavlink_connection("tcp:localhost:5763",
+        mav2 = mavutil.mavlink_connection("tcp:localhost:%u" % self.adjust_ardupilot_port(5763),
                                           robust_parsing=True,
                                           source_system=7,
                                           source_component=7)
@@ -6202,7 +6203,7 @@ Brakes have negligible effect (with=%0.2fm without=%0.2fm delta=%0.2fm)
         # execute these commands:
         self.set_parameter("SERIAL2_OPTIONS", 1024)
         self.reboot_sitl()  # mavlink-private is reboot-required
-        mav2 = mavutil.mavlink_connection("tcp:localhost:5763",
+        mav2 = mavutil.mavlink_connection("tcp:localhost:%u" % self.adjust_ardupilot_port(5763),
                                           robust_parsing=True,
                                           source_system=7,
                                           source_component=7)
@@ -6467,6 +6468,7 @@ Brakes have negligible effect (with=%0.2fm without=%0.2fm delta=%0.2fm)
 
     def NetworkingWebServer(self):
         '''web server'''
+        port = self.adjust_ardupilot_port(8081)
         applet_script = "net_webserver.lua"
 
         self.context_push()
@@ -6485,15 +6487,15 @@ Brakes have negligible effect (with=%0.2fm without=%0.2fm delta=%0.2fm)
         self.context_collect('STATUSTEXT')
 
         self.set_parameters({
-            "WEB_BIND_PORT": 8081,
+            "WEB_BIND_PORT": port,
         })
 
         self.scripting_restart()
-        self.wait_text("WebServer: starting on port 8081", check_context=True)
+        self.wait_text("WebServer: starting on port %u" % port, check_context=True)
 
         self.wait_ready_to_arm()
 
-        self.TestWebServer("http://127.0.0.1:8081")
+        self.TestWebServer("http://127.0.0.1:%u" % port)
 
         self.context_pop()
         self.context_pop()
@@ -6501,6 +6503,7 @@ Brakes have negligible effect (with=%0.2fm without=%0.2fm delta=%0.2fm)
 
     def NetworkingWebServerPPP(self):
         '''web server over PPP'''
+        port = self.adjust_ardupilot_port(8081)
         applet_script = "net_webserver.lua"
 
         self.context_push()
@@ -6522,7 +6525,7 @@ Brakes have negligible effect (with=%0.2fm without=%0.2fm delta=%0.2fm)
         self.reboot_sitl()
 
         self.progress("Starting PPP daemon")
-        pppd = util.start_PPP_daemon("192.168.14.15:192.168.14.13", '127.0.0.1:5765')
+        pppd = util.start_PPP_daemon("192.168.14.15:192.168.14.13", '127.0.0.1:%u' % self.adjust_ardupilot_port(5765))
 
         self.context_push()
         self.context_collect('STATUSTEXT')
@@ -6532,15 +6535,15 @@ Brakes have negligible effect (with=%0.2fm without=%0.2fm delta=%0.2fm)
         self.progress("PPP daemon started")
 
         self.set_parameters({
-            "WEB_BIND_PORT": 8081,
+            "WEB_BIND_PORT": port,
         })
 
         self.scripting_restart()
-        self.wait_text("WebServer: starting on port 8081", check_context=True)
+        self.wait_text("WebServer: starting on port %u" % port, check_context=True)
 
         self.wait_ready_to_arm()
 
-        self.TestWebServer("http://192.168.14.13:8081")
+        self.TestWebServer("http://192.168.14.13:%u" % port)
 
         self.context_pop()
         self.context_pop()
@@ -6999,7 +7002,9 @@ Brakes have negligible effect (with=%0.2fm without=%0.2fm delta=%0.2fm)
             self.MAV_CMD_DO_FENCE_ENABLE,
             self.MAV_CMD_BATTERY_RESET,
             self.NetworkingWebServer,
-            self.NetworkingWebServerPPP,
+            # the PPP addresses are fixed, and the test replaces the
+            # SITL binary:
+            Test(self.NetworkingWebServerPPP, shardable=False),
             self.RTL_SPEED,
             self.MissionRetransfer,
             self.FenceFullAndPartialTransfer,
@@ -13,6 +13,15 @@ EOF
 nice time ./Tools/autotest/test_build_options.py --board=CubeOrange --extra-hwdef=/tmp/extra-hwdef.dat --no-run-with-defaults --no-disable-all --no-enable-in-turn | tee /tmp/tbo-out  # noqa
 grep 'sabling.*saves' /tmp/tbo-out
 
+--parallel-builds N runs the disable-in-turn and enable-in-turn steps in
+N build directories (build/tbo-0 ... build/tbo-N-1) at once.  Where no
+size comparison is being made, --batch-size N checks up to N features
+whose defines (including dependencies) do not overlap together in one
+build; if such a build fails the features are retried one at a time.
+Batching is off by default: a dependency between features which is not
+declared in build_options.py can make a batch build when one of its
+features would not build on its own.
+
  - note that a lot of the time explicitly disabling features will make the binary larger as the ROMFS includes the generated hwdef.h which will have the extra define in it  # noqa
 
 AP_FLAKE8_CLEAN
@@ -23,7 +32,9 @@ import optparse
 import os
 import pathlib
 import re
+import subprocess
 import sys
+import threading
 
 from pysim import util
 
@@ -53,6 +64,8 @@ class TestBuildOptions(object):
                  extra_hwdef=None,
                  emit_disable_all_defines=None,
                  resume=False,
+                 parallel_builds=None,
+                 batch_size=1,
                  ):
         self.extra_hwdef = extra_hwdef
         self.sizes_nothing_disabled = None
@@ -68,7 +81,11 @@ class TestBuildOptions(object):
         self._board = board
         self.emit_disable_all_defines = emit_disable_all_defines
         self.resume = resume
+        self.parallel_builds = parallel_builds
+        self.batch_size = batch_size
         self.results = {}
+        # protects results and progress files when building in parallel:
+        self.results_lock = threading.Lock()
 
         self.enable_in_turn_results = {}
         self.sizes_everything_disabled = None
@@ -181,22 +198,29 @@ class TestBuildOptions(object):
         return ret
 
     def test_disable_feature(self, feature, options):
-        defines = self.get_disable_defines(feature, options)
+        self.test_disable_features([feature], options)
 
-        if len(defines.keys()) > 1:
-            self.progress("Disabling %s disables (%s)" % (
-                feature.define,
-                ",".join(defines.keys())))
+    def test_disable_features(self, features, options, build_dir=None):
+        '''disable features (and whatever depends on them) in a single
+        build and check they are not compiled in'''
+        defines = {}
+        for feature in features:
+            feature_defines = self.get_disable_defines(feature, options)
+            if len(feature_defines.keys()) > 1:
+                self.progress("Disabling %s disables (%s)" % (
+                    feature.define,
+                    ",".join(feature_defines.keys())))
+            defines.update(feature_defines)
 
-        self.test_compile_with_defines(defines)
+        self.test_compile_with_defines(defines, build_dir=build_dir)
 
-        self.assert_feature_not_in_code(defines, feature)
+        self.assert_feature_not_in_code(defines, features, build_dir=build_dir)
 
-    def assert_feature_not_in_code(self, defines, feature):
+    def assert_feature_not_in_code(self, defines, feature, build_dir=None):
         # if the feature is truly disabled then extract_features.py
         # should say so:
         for target in self.build_targets:
-            path = self.target_to_elf_path(target)
+            path = self.target_to_elf_path(target, build_dir=build_dir)
             extractor = extract_features.ExtractFeatures(path)
             (compiled_in_feature_defines, not_compiled_in_feature_defines) = extractor.extract()
             for define in defines:
@@ -218,18 +242,25 @@ class TestBuildOptions(object):
                         raise ValueError(error)
 
     def test_enable_feature(self, feature, options):
-        defines = self.get_enable_defines(feature, options)
-
-        enabled = list(filter(lambda x : bool(defines[x]), defines.keys()))
+        self.test_enable_features([feature], options)
 
-        if len(enabled) > 1:
-            self.progress("Enabling %s enables (%s)" % (
-                feature.define,
-                ",".join(enabled)))
+    def test_enable_features(self, features, options, build_dir=None):
+        '''enable features (and whatever they depend on) with everything
+        else disabled in a single build and check they are compiled in'''
+        defines = self.get_disable_all_defines()
+        for feature in features:
+            feature_defines = self.get_enable_defines(feature, options)
+            enabled = list(filter(lambda x : bool(feature_defines[x]), feature_defines.keys()))
+            if len(enabled) > 1:
+                self.progress("Enabling %s enables (%s)" % (
+                    feature.define,
+                    ",".join(enabled)))
+            for define in enabled:
+                defines[define] = 1
 
-        self.test_compile_with_defines(defines)
+        self.test_compile_with_defines(defines, build_dir=build_dir)
 
-        self.assert_feature_in_code(defines, feature)
+        self.assert_feature_in_code(defines, features, build_dir=build_dir)
 
     def define_is_whitelisted_for_feature_in_code(self, target, define):
         '''returns true if we can not expect the define to be extracted from
@@ -403,11 +434,11 @@ class TestBuildOptions(object):
             if re.match(some_re, define):
                 return True
 
-    def assert_feature_in_code(self, defines, feature):
+    def assert_feature_in_code(self, defines, feature, build_dir=None):
         # if the feature is truly disabled then extract_features.py
         # should say so:
         for target in self.build_targets:
-            path = self.target_to_elf_path(target)
+            path = self.target_to_elf_path(target, build_dir=build_dir)
             extractor = extract_features.ExtractFeatures(path)
             (compiled_in_feature_defines, not_compiled_in_feature_defines) = extractor.extract()
             for define in defines:
@@ -425,26 +456,63 @@ class TestBuildOptions(object):
         '''returns board to build for'''
         return self._board
 
-    def test_compile_with_defines(self, defines):
-        extra_hwdef_filepath = "/tmp/extra.hwdef"
+    def test_compile_with_defines(self, defines, build_dir=None):
+        if build_dir is None:
+            extra_hwdef_filepath = "/tmp/extra.hwdef"
+        else:
+            os.makedirs(build_dir, exist_ok=True)
+            extra_hwdef_filepath = os.path.abspath(os.path.join(build_dir, "extra.hwdef"))
         self.write_defines_to_file(defines, extra_hwdef_filepath)
         if self.extra_hwdef is not None:
             content = open(self.extra_hwdef, "r").read()
             with open(extra_hwdef_filepath, "a") as f:
                 f.write(content)
-        util.waf_configure(
-            self.board(),
-            extra_hwdef=extra_hwdef_filepath,
-        )
+        if build_dir is None:
+            util.waf_configure(
+                self.board(),
+                extra_hwdef=extra_hwdef_filepath,
+            )
+        else:
+            self.run_waf_in_build_dir(build_dir, [
+                "configure",
+                "--board", self.board(),
+                "--extra-hwdef", extra_hwdef_filepath,
+                "--out", build_dir,
+            ])
         for t in self.build_targets:
             try:
-                util.run_cmd([util.relwaf(), t])
+                if build_dir is None:
+                    util.run_cmd([util.relwaf(), t])
+                else:
+                    self.run_waf_in_build_dir(build_dir, [t, "-j", str(self.jobs_per_build())])
             except Exception:
                 print("Failed to build (%s) with things disabled" %
                       (t,))
                 raise
 
-    def target_to_path(self, target, extension=None):
+    def build_dir_for_worker(self, n):
+        return os.path.join(util.topdir(), "build", "tbo-%u" % n)
+
+    def jobs_per_build(self):
+        return max(1, (os.cpu_count() or 1) // self.parallel_builds)
+
+    def run_waf_in_build_dir(self, build_dir, args):
+        '''run waf on the configuration in build_dir.  waf finds the
+        output directory through a lock file in the top directory, so
+        each build directory gets its own'''
+        env = os.environ.copy()
+        env["WAFLOCK"] = ".lock-waf_%s_%s" % (sys.platform, os.path.basename(build_dir))
+        cmd = [util.relwaf()] + args
+        logpath = os.path.join(build_dir, "tbo.log")
+        with open(logpath, "a") as log:
+            log.write("Running: (%s)\n" % util.cmd_as_shell(cmd))
+            log.flush()
+            returncode = subprocess.call(cmd, cwd=util.topdir(), env=env, stdout=log, stderr=subprocess.STDOUT)
+        if returncode != 0:
+            print("Command (%s) failed; output is in %s" % (util.cmd_as_shell(cmd), logpath))
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    def target_to_path(self, target, extension=None, build_dir=None):
         '''given a build target (e.g. copter), return expected path to .bin
         file for that target'''
         target_to_binpath = {
@@ -458,23 +526,25 @@ class TestBuildOptions(object):
         filename = target_to_binpath[target]
         if extension is not None:
             filename += "." + extension
-        return os.path.join("build", self.board(), "bin", filename)
+        if build_dir is None:
+            build_dir = "build"
+        return os.path.join(build_dir, self.board(), "bin", filename)
 
-    def target_to_bin_path(self, target):
+    def target_to_bin_path(self, target, build_dir=None):
         '''given a build target (e.g. copter), return expected path to .bin
         file for that target'''
-        return self.target_to_path(target, 'bin')
+        return self.target_to_path(target, 'bin', build_dir=build_dir)
 
-    def target_to_elf_path(self, target):
+    def target_to_elf_path(self, target, build_dir=None):
         '''given a build target (e.g. copter), return expected path to .elf
         file for that target'''
-        return self.target_to_path(target)
+        return self.target_to_path(target, build_dir=build_dir)
 
-    def find_build_sizes(self):
+    def find_build_sizes(self, build_dir=None):
         '''returns a hash with size of all build targets'''
         ret = {}
         for target in self.build_targets:
-            path = self.target_to_bin_path(target)
+            path = self.target_to_bin_path(target, build_dir=build_dir)
             ret[target] = os.path.getsize(path)
         return ret
 
@@ -499,11 +569,11 @@ class TestBuildOptions(object):
             ret += ",".join(line) + "\n"
         return ret
 
-    def disable_in_turn_check_sizes(self, feature, sizes_nothing_disabled):
+    def disable_in_turn_check_sizes(self, feature, sizes_nothing_disabled, build_dir=None):
         if not self.do_step_disable_none:
             self.progress("disable-none skipped, size comparison not available")
             return
-        current_sizes = self.find_build_sizes()
+        current_sizes = self.find_build_sizes(build_dir=build_dir)
         for (build, new_size) in current_sizes.items():
             old_size = sizes_nothing_disabled[build]
             self.progress("Disabling %s(%s) on %s saves %u bytes" %
@@ -518,6 +588,9 @@ class TestBuildOptions(object):
         progress_file = pathlib.Path("/tmp/run-disable-in-turn-progress")
         resume_number = self.resume_number_from_progress_Path(progress_file)
         options = self.get_build_options_from_ardupilot_tree()
+        if self.parallel_builds is not None:
+            self.run_disable_in_turn_parallel(options, progress_file, resume_number)
+            return
         count = 1
         for feature in sorted(options, key=lambda x : x.define):
             if resume_number is not None:
@@ -543,11 +616,11 @@ class TestBuildOptions(object):
             count += 1
             self.disable_in_turn_check_sizes(feature, self.sizes_nothing_disabled)
 
-    def enable_in_turn_check_sizes(self, feature, sizes_everything_disabled):
+    def enable_in_turn_check_sizes(self, feature, sizes_everything_disabled, build_dir=None):
         if not self.do_step_disable_all:
             self.progress("disable-none skipped, size comparison not available")
             return
-        current_sizes = self.find_build_sizes()
+        current_sizes = self.find_build_sizes(build_dir=build_dir)
         for (build, new_size) in current_sizes.items():
             old_size = sizes_everything_disabled[build]
             self.progress("Enabling %s(%s) on %s costs %u bytes" %
@@ -575,6 +648,9 @@ class TestBuildOptions(object):
         progress_file = pathlib.Path("/tmp/run-enable-in-turn-progress")
         resume_number = self.resume_number_from_progress_Path(progress_file)
         options = self.get_build_options_from_ardupilot_tree()
+        if self.parallel_builds is not None:
+            self.run_enable_in_turn_parallel(options, progress_file, resume_number)
+            return
         count = 1
         for feature in options:
             if resume_number is not None:
@@ -592,6 +668,169 @@ class TestBuildOptions(object):
             count += 1
             self.enable_in_turn_check_sizes(feature, self.sizes_everything_disabled)
 
+    def run_disable_in_turn_parallel(self, options, progress_file, resume_number):
+        numbered_features = []
+        for (count, feature) in enumerate(sorted(options, key=lambda x : x.define), start=1):
+            if resume_number is not None and count < resume_number:
+                continue
+            if self.match_glob is not None:
+                if not fnmatch.fnmatch(feature.define, self.match_glob):
+                    continue
+            if feature.define in self.must_have_defines_for_board(self._board):
+                self.progress("Feature %s(%s) (%u/%u) is a MUST-HAVE" %
+                              (feature.label, feature.define, count, len(options)))
+                continue
+            numbered_features.append((count, feature))
+
+        batch_size = self.batch_size
+        if self.do_step_disable_none:
+            # sizes are per-feature, so each needs its own build
+            batch_size = 1
+
+        self.run_in_turn_parallel(
+            "Disabling",
+            numbered_features,
+            len(options),
+            progress_file,
+            batch_size,
+            lambda feature : self.get_disable_defines(feature, options).keys(),
+            lambda features, build_dir : self.test_disable_features(features, options, build_dir=build_dir),
+            lambda feature, build_dir : self.disable_in_turn_check_sizes(feature, self.sizes_nothing_disabled, build_dir=build_dir),  # noqa
+        )
+
+    def run_enable_in_turn_parallel(self, options, progress_file, resume_number):
+        numbered_features = []
+        for (count, feature) in enumerate(options, start=1):
+            if resume_number is not None and count < resume_number:
+                continue
+            if self.match_glob is not None:
+                if not fnmatch.fnmatch(feature.define, self.match_glob):
+                    continue
+            numbered_features.append((count, feature))
+
+        batch_size = self.batch_size
+        if self.do_step_disable_all:
+            # sizes are per-feature, so each needs its own build
+            batch_size = 1
+
+        def enabled_defines(feature):
+            ret = {}
+            self.update_get_enable_defines_for_feature(ret, feature, options)
+            return ret.keys()
+
+        self.run_in_turn_parallel(
+            "Enabling",
+            numbered_features,
+            len(options),
+            progress_file,
+            batch_size,
+            enabled_defines,
+            lambda features, build_dir : self.test_enable_features(features, options, build_dir=build_dir),
+            lambda feature, build_dir : self.enable_in_turn_check_sizes(feature, self.sizes_everything_disabled, build_dir=build_dir),  # noqa
+        )
+
+    def batch_features(self, numbered_features, batch_size, defines_for_feature):
+        '''split numbered_features into lists which can be tested in one
+        build: no two features in a list have a define (or dependency)
+        in common'''
+        batches = []
+        batch = []
+        batch_defines = set()
+        for (count, feature) in numbered_features:
+            defines = set(defines_for_feature(feature))
+            if len(batch) and (len(batch) >= batch_size or len(defines & batch_defines)):
+                batches.append(batch)
+                batch = []
+                batch_defines = set()
+            batch.append((count, feature))
+            batch_defines.update(defines)
+        if len(batch):
+            batches.append(batch)
+        return batches
+
+    def run_in_turn_parallel(self,
+                             verb,
+                             numbered_features,
+                             option_count,
+                             progress_file,
+                             batch_size,
+                             defines_for_feature,
+                             test_features,
+                             check_sizes):
+        '''test the (count, feature) pairs in numbered_features in
+        self.parallel_builds build directories at once'''
+        # features next to each other by define name are generally in
+        # the same library, so keeping them together in a directory
+        # means less is rebuilt between one build and the next:
+        numbered_features = sorted(numbered_features, key=lambda x : x[1].define)
+        batches = self.batch_features(numbered_features, batch_size, defines_for_feature)
+
+        # the progress file records the lowest-numbered feature not yet
+        # done (or the last feature, once all are), so --resume starts
+        # from there:
+        pending = sorted([count for (count, feature) in numbered_features])
+        defines_by_count = {count: feature.define for (count, feature) in numbered_features}
+
+        def completed(count, feature, build_dir):
+            with self.results_lock:
+                check_sizes(feature, build_dir)
+                pending.remove(count)
+                if len(pending):
+                    resume_count = pending[0]
+                else:
+                    resume_count = max(defines_by_count.keys())
+                with open(progress_file, "w") as f:
+                    f.write(f"{resume_count}/{option_count} {defines_by_count[resume_count]}\n")
+
+        def test_batch(batch, build_dir):
+            for (count, feature) in batch:
+                self.progress("%s feature %s(%s) (%u/%u) in %s" %
+                              (verb, feature.label, feature.define, count, option_count, build_dir))
+            try:
+                test_features([feature for (count, feature) in batch], build_dir)
+            except Exception:
+                if len(batch) == 1:
+                    raise
+                self.progress("Testing (%s) together failed; testing them one at a time" %
+                              ",".join([feature.define for (count, feature) in batch]))
+                for item in batch:
+                    test_batch([item], build_dir)
+                return
+            for (count, feature) in batch:
+                completed(count, feature, build_dir)
+
+        failures = []
+
+        def worker(build_dir, worker_batches):
+            for batch in worker_batches:
+                if len(failures):
+                    # another build directory has failed; give up
+                    return
+                try:
+                    test_batch(batch, build_dir)
+                except Exception as ex:
+                    failures.append(ex)
+                    return
+
+        # give each build directory a contiguous run of batches:
+        n_workers = min(self.parallel_builds, len(batches))
+        threads = []
+        start = 0
+        for n in range(n_workers):
+            end = start + (len(batches) - start) // (n_workers - n)
+            t = threading.Thread(
+                target=worker,
+                name=f"tbo-{n}",
+                args=(self.build_dir_for_worker(n), batches[start:end]),
+            )
+            t.start()
+            threads.append(t)
+            start = end
+        for t in threads:
+            t.join()
+        if len(failures):
+            raise failures[0]
+
     def get_option_by_label(self, label, options):
         for x in options:
             if x.label == label:
@@ -612,14 +851,23 @@ class TestBuildOptions(object):
 
         return defines
 
+    def baseline_build_dir(self):
+        '''when building in parallel the sizes to compare against are
+        taken from a build in the first worker's directory'''
+        if self.parallel_builds is None:
+            return None
+        return self.build_dir_for_worker(0)
+
     def run_disable_all(self):
         defines = self.get_disable_all_defines()
-        self.test_compile_with_defines(defines)
-        self.sizes_everything_disabled = self.find_build_sizes()
+        build_dir = self.baseline_build_dir()
+        self.test_compile_with_defines(defines, build_dir=build_dir)
+        self.sizes_everything_disabled = self.find_build_sizes(build_dir=build_dir)
 
     def run_disable_none(self):
-        self.test_compile_with_defines({})
-        self.sizes_nothing_disabled = self.find_build_sizes()
+        build_dir = self.baseline_build_dir()
+        self.test_compile_with_defines({}, build_dir=build_dir)
+        self.sizes_nothing_disabled = self.find_build_sizes(build_dir=build_dir)
 
     def run_with_defaults(self):
         options = self.get_build_options_from_ardupilot_tree()
@@ -716,6 +964,14 @@ if __name__ == '__main__':
     parser.add_option("--resume",
                       action='store_true',
                       help='resume from previous progress file')
+    parser.add_option("--parallel-builds",
+                      type='int',
+                      default=None,
+                      help='test features in this many build directories at once')
+    parser.add_option("--batch-size",
+                      type='int',
+                      default=1,
+                      help='with --parallel-builds, maximum number of non-interacting features to test in one build when sizes are not being compared; undeclared dependencies between features in a batch can hide failures')  # noqa
 
     opts, args = parser.parse_args()
 
@@ -731,6 +987,8 @@ if __name__ == '__main__':
         extra_hwdef=opts.extra_hwdef,
         emit_disable_all_defines=opts.emit_disable_all_defines,
         resume=opts.resume,
+        parallel_builds=opts.parallel_builds,
+        batch_size=opts.batch_size,
     )
 
     tbo.run()
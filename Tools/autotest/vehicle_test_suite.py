@@ -47,6 +47,8 @@ from pymavlink import quaternion
 from pymavlink.generator import mavgen
 
 from pysim import util, vehicleinfo
+from pysim.columnar_dfreader import ColumnarDFReader
+from pysim.mav_reader import MAVReader
 
 try:
     import queue as Queue
@@ -1843,7 +1845,7 @@ class LocationInt(object):
 
 class Test(object):
     '''a test definition - information about a test'''
-    def __init__(self, function, kwargs={}, attempts=1, speedup=None):
+    def __init__(self, function, kwargs={}, attempts=1, speedup=None, shardable=True):
         self.name = function.__name__
         self.description = function.__doc__
         if self.description is None:
@@ -1852,6 +1854,10 @@ class Test(object):
         self.kwargs = kwargs
         self.attempts = attempts
         self.speedup = speedup
+        # False if the test uses fixed network ports or addresses, or
+        # changes files shared between SITL instances; such tests are
+        # not run alongside others in a sharded run:
+        self.shardable = shardable
 
 
 class Result(object):
@@ -1862,6 +1868,7 @@ class Result(object):
         self.exception = None
         self.debug_filename = None
         self.time_elapsed = 0.0
+        self.sim_time_elapsed = None
         # self.passed = False
 
     def __str__(self):
@@ -1921,6 +1928,8 @@ class TestSuite(ABC):
                  dronecan_tests=False,
                  generate_junit=False,
                  enable_fgview=False,
+                 instance=0,
+                 mav_reader=False,
                  build_opts={}):
 
         self.start_time = time.time()
@@ -1986,8 +1995,14 @@ class TestSuite(ABC):
         self.last_heartbeat_time_ms = None
         self.last_heartbeat_time_wc_s = 0
         self.in_drain_mav = False
+        # read self.mav on a background thread (see pysim/mav_reader.py):
+        self.use_mav_reader = mav_reader
+        self.mav_reader = None
         self.tlog = None
         self.enable_fgview = enable_fgview
+        # SITL instance number (-I); moves all of the network ports
+        # so several test suites can run side-by-side:
+        self.instance = instance
 
         self.rc_thread = None
         self.rc_thread_should_quit = False
@@ -2000,6 +2015,10 @@ class TestSuite(ABC):
         self.last_sim_time_cached = 0
         self.last_sim_time_cached_wallclock = 0
 
+        # total simulated time, accumulated across reboots:
+        self.total_sim_time_ms = 0
+        self.last_system_time_boot_ms = None
+
         # to autopilot we do not want to go to the internet for tiles,
         # usually.  Set this to False to gather tiles from internet in
         # the cae there are new tiles required, then add them to the
@@ -2085,13 +2104,13 @@ class TestSuite(ABC):
 
     def adjust_ardupilot_port(self, port):
         '''adjust port in case we do not wish to use the default range (5760 and 5501 etc)'''
-        return port
+        return port + 10 * self.instance
 
     def spare_network_port(self, offset=0):
         '''returns a network port which should be able to be bound'''
         if offset > 2:
             raise ValueError("offset too large")
-        return 8000 + offset
+        return 8000 + offset + 10 * self.instance
 
     def autotest_connection_string_to_ardupilot(self):
         return "tcp:127.0.0.1:%u" % self.adjust_ardupilot_port(5760)
@@ -2099,7 +2118,7 @@ class TestSuite(ABC):
     def sitl_rcin_port(self, offset=0):
         if offset > 2:
             raise ValueError("offset too large")
-        return 5501 + offset
+        return 5501 + offset + 10 * self.instance
 
     def mavproxy_options(self):
         """Returns options to be passed to MAVProxy."""
@@ -3450,6 +3469,8 @@ class TestSuite(ABC):
 #        print("msg: %s" % str(msg))
         if msg.get_type() == 'STATUSTEXT':
             self.progress("AP: %s" % msg.text, send_statustext=False)
+        elif msg.get_type() == 'SYSTEM_TIME':
+            self.accumulate_sim_time(msg.time_boot_ms)
 
         self.write_msg_to_tlog(msg)
 
@@ -3463,6 +3484,16 @@ class TestSuite(ABC):
             # assume it's a function
             h(mav, msg)
 
+    def accumulate_sim_time(self, time_boot_ms):
+        '''keep a running total of simulated time which survives reboots'''
+        if self.last_system_time_boot_ms is not None:
+            if time_boot_ms >= self.last_system_time_boot_ms:
+                self.total_sim_time_ms += time_boot_ms - self.last_system_time_boot_ms
+            else:
+                # autopilot rebooted
+                self.total_sim_time_ms += time_boot_ms
+        self.last_system_time_boot_ms = time_boot_ms
+
     def send_message_hook(self, msg, x):
         self.write_msg_to_tlog(msg)
 
@@ -3490,6 +3521,16 @@ class TestSuite(ABC):
         simulation.'''
         if mav is None:
             mav = self.mav
+        if self.mav_reader is not None and mav is self.mav:
+            # the reader thread has already taken everything off the
+            # socket; just forget it
+            self.mav_reader.sync()
+            count = self.mav_reader.discard()
+            if not quiet:
+                self.progress("Discarded %u buffered messages from mav" % count, send_statustext=False)
+                if freshen_sim_time:
+                    self.get_sim_time()
+            return
         count = 0
         tstart = time.time()
         self.pause_SITL()
@@ -3527,6 +3568,8 @@ class TestSuite(ABC):
             return self.drain_mav_unparsed(quiet=quiet, mav=mav)
         if mav is None:
             mav = self.mav
+        if self.mav_reader is not None and mav is self.mav:
+            return self.drain_mav_reader(quiet=quiet)
         self.in_drain_mav = True
         count = 0
         tstart = time.time()
@@ -3571,6 +3614,31 @@ class TestSuite(ABC):
 
         self.in_drain_mav = False
 
+    def drain_mav_reader(self, quiet=True):
+        '''drain self.mav when it is being read by a MAVReader thread.
+        SITL does not need pausing: only the messages buffered by the
+        time the socket has been emptied are processed'''
+        self.in_drain_mav = True
+        tstart = time.time()
+        try:
+            self.mav_reader.sync()
+            count = self.mav_reader.pending()
+            for i in range(count):
+                if self.mav.recv_msg() is None:
+                    break
+        finally:
+            self.in_drain_mav = False
+        if quiet:
+            return
+        tdelta = time.time() - tstart
+        if tdelta == 0:
+            rate = "instantly"
+        else:
+            rate = "%f/s" % (count/float(tdelta),)
+        self.progress("Drained %u buffered messages from mav (%s)" % (count, rate), send_statustext=False)
+        if self.mav_reader.dropped:
+            self.progress("MAV reader has dropped %u messages" % self.mav_reader.dropped, send_statustext=False)
+
     def do_timesync_roundtrip(self, quiet=False, timeout_in_wallclock=False):
         if not quiet:
             self.progress("Doing timesync roundtrip")
@@ -4733,6 +4801,8 @@ class TestSuite(ABC):
 
     def TestLogDownloadMAVProxyNetwork(self, upload_logs=False):
         """Download latest log over network port"""
+        # ports port_base+1 to port_base+6 are used:
+        port_base = self.adjust_ardupilot_port(16000)
         self.context_push()
         self.set_parameters({
             "NET_ENABLE": 1,
@@ -4741,7 +4811,7 @@ class TestSuite(ABC):
             # UDP client
             "NET_P1_TYPE": 1,
             "NET_P1_PROTOCOL": 2,
-            "NET_P1_PORT": 16001,
+            "NET_P1_PORT": port_base + 1,
             "NET_P1_IP0": 127,
             "NET_P1_IP1": 0,
             "NET_P1_IP2": 0,
@@ -4749,7 +4819,7 @@ class TestSuite(ABC):
             # UDP server
             "NET_P2_TYPE": 2,
             "NET_P2_PROTOCOL": 2,
-            "NET_P2_PORT": 16002,
+            "NET_P2_PORT": port_base + 2,
             "NET_P2_IP0": 0,
             "NET_P2_IP1": 0,
             "NET_P2_IP2": 0,
@@ -4757,7 +4827,7 @@ class TestSuite(ABC):
             # TCP client
             "NET_P3_TYPE": 3,
             "NET_P3_PROTOCOL": 2,
-            "NET_P3_PORT": 16003,
+            "NET_P3_PORT": port_base + 3,
             "NET_P3_IP0": 127,
             "NET_P3_IP1": 0,
             "NET_P3_IP2": 0,
@@ -4765,7 +4835,7 @@ class TestSuite(ABC):
             # TCP server
             "NET_P4_TYPE": 4,
             "NET_P4_PROTOCOL": 2,
-            "NET_P4_PORT": 16004,
+            "NET_P4_PORT": port_base + 4,
             "NET_P4_IP0": 0,
             "NET_P4_IP1": 0,
             "NET_P4_IP2": 0,
@@ -4786,10 +4856,10 @@ class TestSuite(ABC):
 
         self.set_parameter('SIM_SPEEDUP', 1)
 
-        endpoints = [('UDPClient', ':16001') ,
-                     ('UDPServer', 'udpout:127.0.0.1:16002'),
-                     ('TCPClient', 'tcpin:0.0.0.0:16003'),
-                     ('TCPServer', 'tcp:127.0.0.1:16004')]
+        endpoints = [('UDPClient', ':%u' % (port_base + 1)),
+                     ('UDPServer', 'udpout:127.0.0.1:%u' % (port_base + 2)),
+                     ('TCPClient', 'tcpin:0.0.0.0:%u' % (port_base + 3)),
+                     ('TCPServer', 'tcp:127.0.0.1:%u' % (port_base + 4))]
         for name, e in endpoints:
             self.progress("Downloading log with %s %s" % (name, e))
             filename = "MAVProxy-downloaded-net-log-%s.BIN" % name
@@ -4811,7 +4881,7 @@ class TestSuite(ABC):
             # multicast UDP client
             "NET_P1_TYPE": 1,
             "NET_P1_PROTOCOL": 2,
-            "NET_P1_PORT": 16005,
+            "NET_P1_PORT": port_base + 5,
             "NET_P1_IP0": 239,
             "NET_P1_IP1": 255,
             "NET_P1_IP2": 145,
@@ -4819,7 +4889,7 @@ class TestSuite(ABC):
             # Broadcast UDP client
             "NET_P2_TYPE": 1,
             "NET_P2_PROTOCOL": 2,
-            "NET_P2_PORT": 16006,
+            "NET_P2_PORT": port_base + 6,
             "NET_P2_IP0": 255,
             "NET_P2_IP1": 255,
             "NET_P2_IP2": 255,
@@ -4832,8 +4902,8 @@ class TestSuite(ABC):
 
         self.set_parameter('SIM_SPEEDUP', 1)
 
-        endpoints = [('UDPMulticast', 'mcast:16005') ,
-                     ('UDPBroadcast', ':16006')]
+        endpoints = [('UDPMulticast', 'mcast:%u' % (port_base + 5)),
+                     ('UDPBroadcast', ':%u' % (port_base + 6))]
         for name, e in endpoints:
             self.progress("Downloading log with %s %s" % (name, e))
             filename = "MAVProxy-downloaded-net-log-%s.BIN" % name
@@ -8696,6 +8766,9 @@ Also, ignores heartbeats not from our target system'''
 
     def get_mavlink_connection_going(self):
         # get a mavlink connection going
+        if self.mav_reader is not None:
+            self.mav_reader.stop()
+            self.mav_reader = None
         try:
             retries = 20
             if self.gdb:
@@ -8716,6 +8789,9 @@ Also, ignores heartbeats not from our target system'''
         self.mav.message_hooks.append(self.message_hook)
         self.mav.mav.set_send_callback(self.send_message_hook, self)
         self.mav.idle_hooks.append(self.idle_hook)
+        if self.use_mav_reader:
+            self.mav_reader = MAVReader(self.mav)
+            self.mav_reader.start()
 
         # we need to wait for a heartbeat here.  If we don't then
         # self.mav.target_system will be zero because it hasn't
@@ -8888,6 +8964,7 @@ Also, ignores heartbeats not from our target system'''
         self.context_push()
 
         start_time = time.time()
+        start_sim_time_ms = self.total_sim_time_ms
 
         orig_speedup = None
 
@@ -8929,6 +9006,7 @@ Also, ignores heartbeats not from our target system'''
 
         result = Result(test)
         result.time_elapsed = self.test_timings[desc]
+        result.sim_time_elapsed = (self.total_sim_time_ms - start_sim_time_ms) * 0.001
 
         ardupilot_alive = False
         try:
@@ -9120,6 +9198,10 @@ Also, ignores heartbeats not from our target system'''
 
         if "model" not in start_sitl_args or start_sitl_args["model"] is None:
             start_sitl_args["model"] = self.frame
+        if self.instance != 0:
+            customisations = list(start_sitl_args.get("customisations", []))
+            customisations.extend(["-I", str(self.instance)])
+            start_sitl_args["customisations"] = customisations
         self.progress("Starting SITL", send_statustext=False)
         if binary is None:
             binary = self.binary
@@ -12261,6 +12343,14 @@ switch value'''
     def dfreader_for_current_onboard_log(self):
         return self.dfreader_for_path(self.current_onboard_log_filepath())
 
+    def columnar_dfreader_for_path(self, path):
+        '''returns a reader which decodes whole message types into numpy
+        arrays; much faster than dfreader_for_path for whole-log checks'''
+        return ColumnarDFReader(path)
+
+    def columnar_dfreader_for_current_onboard_log(self):
+        return self.columnar_dfreader_for_path(self.current_onboard_log_filepath())
+
     def current_onboard_log_contains_message(self, messagetype):
         self.progress("Checking (%s) for (%s)" %
                       (self.current_onboard_log_filepath(), messagetype))
@@ -12314,6 +12404,10 @@ switch value'''
             self.rc_thread.join()
             self.rc_thread = None
 
+        if self.mav_reader is not None:
+            self.mav_reader.stop()
+            self.mav_reader = None
+
         if self.mav is not None:
             self.mav.close()
             self.mav = None
@@ -14535,10 +14629,11 @@ SERIAL5_BAUD 128
     def IBus(self):
         '''test the IBus protocol'''
         self.set_parameter("SERIAL5_PROTOCOL", 49)
+        port = self.adjust_ardupilot_port(6735)
         self.customise_SITL_commandline([
-            "--serial5=tcp:6735" # serial5 spews to localhost:6735
+            "--serial5=tcp:%u" % port # serial5 spews to localhost:port
         ])
-        ibus = IBus(("127.0.0.1", 6735))
+        ibus = IBus(("127.0.0.1", port))
         ibus.connect()
 
         # expected_sensors should match the list created in AP_IBus_Telem
@@ -14630,6 +14725,12 @@ SERIAL5_BAUD 128
 
     def autotest(self, tests=None, allow_skips=True, step_name=None):
         """Autotest used by ArduPilot autotest CI."""
+        (tests, skip_list) = self.tests_to_run(tests=tests, allow_skips=allow_skips)
+        results = self.run_tests(tests)
+        return self.report_results(results, skip_list, step_name=step_name)
+
+    def tests_to_run(self, tests=None, allow_skips=True):
+        """Return (tests, skip_list) for the tests which are not disabled."""
         if tests is None:
             tests = self.tests()
         all_tests = []
@@ -14653,8 +14754,12 @@ SERIAL5_BAUD 128
                 skip_list.append((test, disabled[test.name]))
                 continue
             tests.append(test)
+        return (tests, skip_list)
 
-        results = self.run_tests(tests)
+    def report_results(self, results, skip_list, step_name=None):
+        """Summarise the results of a run, write the jUnit report if
+        requested and return True if all tests passed."""
+        self.results = results
 
         if len(skip_list):
             self.progress("Skipped tests:")
@@ -14687,6 +14792,12 @@ SERIAL5_BAUD 128
         suite = TestSuite(f"Autotest {frame} {test_name}")
         suite.timestamp = datetime.now().replace(microsecond=0).isoformat()
         for result in results:
+            if result.test is None:
+                # e.g. ValgrindFailedResult, which belongs to no one test
+                case = TestCase(type(result).__name__, f"{frame}")
+                case.result = [Failure(str(result))]
+                suite.add_testcase(case)
+                continue
             case = TestCase(f"{result.test.name}", f"{frame}", result.time_elapsed)
             # f"{result.test.description}"
             # case.file ## TODO : add file properties to match test location
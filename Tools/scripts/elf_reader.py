@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+'''
+Minimal reader for ELF32/ELF64 files, for tools which would otherwise
+run nm, size and strings over a firmware and parse their output.
+
+The file is memory-mapped and only the section headers, symbol table
+and string tables are decoded:
+
+    elf = ELFFile("build/CubeOrange/bin/arducopter")
+    for symbol in elf.symbols():
+        print(symbol.name, symbol.size)
+    print(elf.berkeley_sizes())     # (text, data, bss) as "size" prints
+    strings = elf.strings()         # as "strings" prints
+
+Symbol names are as stored in the file (i.e. mangled); demangle() runs
+them all through a single c++filt to get what "nm --demangle" shows.
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import mmap
+import re
+import struct
+import subprocess
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+
+SHN_UNDEF = 0
+SHN_XINDEX = 0xffff
+
+STT_SECTION = 3
+STT_FILE = 4
+
+Section = collections.namedtuple('Section', ['name', 'type', 'flags', 'addr', 'offset', 'size', 'link', 'entsize'])
+Symbol = collections.namedtuple('Symbol', ['name', 'value', 'size', 'type', 'bind', 'shndx'])
+
+# printable sequences as found by GNU strings (ASCII, minimum length 4)
+re_strings = re.compile(rb'[\t\x20-\x7e]{4,}')
+
+
+class ELFError(Exception):
+    pass
+
+
+class ELFFile(object):
+    '''a memory-mapped ELF file'''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, 'rb') as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # mmap refuses zero-length files
+                self.data = b''
+        if self.data[:4] != b'\x7fELF':
+            raise ELFError("%s is not an ELF file" % filepath)
+        elf_class = self.data[4]
+        elf_data = self.data[5]
+        if elf_data == 1:
+            endian = '<'
+        elif elf_data == 2:
+            endian = '>'
+        else:
+            raise ELFError("%s: bad EI_DATA %u" % (filepath, elf_data))
+        if elf_class == 1:
+            self.bits = 32
+            header = struct.Struct(endian + 'HHIIIIIHHHHHH')
+            self.section_struct = struct.Struct(endian + 'IIIIIIIIII')
+            self.symbol_struct = struct.Struct(endian + 'IIIBBH')
+        elif elf_class == 2:
+            self.bits = 64
+            header = struct.Struct(endian + 'HHIQQQIHHHHHH')
+            self.section_struct = struct.Struct(endian + 'IIQQQQIIQQ')
+            self.symbol_struct = struct.Struct(endian + 'IBBHQQ')
+        else:
+            raise ELFError("%s: bad EI_CLASS %u" % (filepath, elf_class))
+        (self.e_type, self.e_machine, _, self.e_entry, _, shoff, _, _, _, _,
+         shentsize, shnum, shstrndx) = header.unpack_from(self.data, 16)
+        self._sections = self.read_sections(shoff, shentsize, shnum, shstrndx)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_section_header(self, shoff, shentsize, index):
+        fields = self.section_struct.unpack_from(self.data, shoff + index * shentsize)
+        (name, sh_type, flags, addr, offset, size, link, info, addralign, entsize) = fields
+        return (name, sh_type, flags, addr, offset, size, link, entsize)
+
+    def read_sections(self, shoff, shentsize, shnum, shstrndx):
+        if shoff == 0:
+            return []
+        if shnum == 0 or shstrndx == SHN_XINDEX:
+            # the real values are stored in the first section header
+            first = self.read_section_header(shoff, shentsize, 0)
+            if shnum == 0:
+                shnum = first[5]
+            if shstrndx == SHN_XINDEX:
+                shstrndx = first[6]
+        headers = [self.read_section_header(shoff, shentsize, i) for i in range(shnum)]
+        strtab_offset = headers[shstrndx][4] if shstrndx < len(headers) else None
+        ret = []
+        for (name, sh_type, flags, addr, offset, size, link, entsize) in headers:
+            if strtab_offset is None:
+                name = ""
+            else:
+                name = self.cstring(strtab_offset + name)
+            ret.append(Section(name, sh_type, flags, addr, offset, size, link, entsize))
+        return ret
+
+    def cstring(self, offset):
+        end = self.data.find(b'\0', offset)
+        if end == -1:
+            end = len(self.data)
+        return self.data[offset:end].decode('utf-8', errors='replace')
+
+    def sections(self):
+        return self._sections
+
+    def symbols(self):
+        '''returns the defined symbols which nm would list (i.e. not
+        undefined, section or file symbols), sorted by name'''
+        ret = []
+        for section in self._sections:
+            if section.type != SHT_SYMTAB:
+                continue
+            strtab = self._sections[section.link]
+            entsize = section.entsize or self.symbol_struct.size
+            for ofs in range(section.offset + entsize, section.offset + section.size, entsize):
+                fields = self.symbol_struct.unpack_from(self.data, ofs)
+                if self.bits == 32:
+                    (name, value, size, info, other, shndx) = fields
+                else:
+                    (name, info, other, shndx, value, size) = fields
+                sym_type = info & 0xf
+                if shndx == SHN_UNDEF or sym_type in (STT_SECTION, STT_FILE) or name == 0:
+                    continue
+                ret.append(Symbol(self.cstring(strtab.offset + name), value, size, sym_type, info >> 4, shndx))
+        ret.sort(key=lambda x: (x.name, x.value))
+        return ret
+
+    def section_sizes(self):
+        '''returns dict of allocated section name => size'''
+        return {s.name: s.size for s in self._sections if s.flags & SHF_ALLOC}
+
+    def berkeley_sizes(self):
+        '''returns (text, data, bss) as "size" calculates them'''
+        text = data = bss = 0
+        for s in self._sections:
+            if not s.flags & SHF_ALLOC:
+                continue
+            if s.type == SHT_NOBITS:
+                bss += s.size
+            elif s.flags & SHF_EXECINSTR or not s.flags & SHF_WRITE:
+                text += s.size
+            else:
+                data += s.size
+        return (text, data, bss)
+
+    def strings(self, min_length=4):
+        '''returns the printable strings in the whole file'''
+        if min_length == 4:
+            regex = re_strings
+        else:
+            regex = re.compile(rb'[\t\x20-\x7e]{%u,}' % min_length)
+        return [m.decode('ascii') for m in regex.findall(self.data)]
+
+
+def demangle(names, cxxfilt="c++filt"):
+    '''returns names demangled as "nm --demangle" would, using one
+    c++filt process for the lot'''
+    names = list(names)
+    if len(names) == 0:
+        return []
+    output = subprocess.run([cxxfilt],
+                            input="\n".join(names) + "\n",
+                            stdout=subprocess.PIPE,
+                            check=True,
+                            universal_newlines=True).stdout
+    ret = output.split("\n")[:len(names)]
+    if len(ret) != len(names):
+        raise ValueError("c++filt returned %u names for %u" % (len(ret), len(names)))
+    return ret
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='show symbols and section sizes of an ELF file')
+    parser.add_argument('elf', help='ELF file')
+    parser.add_argument('--demangle', action='store_true', default=False, help='demangle symbol names')
+    args = parser.parse_args()
+
+    with ELFFile(args.elf) as elf:
+        (text, data, bss) = elf.berkeley_sizes()
+        print("text=%u data=%u bss=%u" % (text, data, bss))
+        symbols = elf.symbols()
+        names = [s.name for s in symbols]
+        if args.demangle:
+            names = demangle(names)
+        for (symbol, name) in zip(symbols, names):
+            print("%08x %08x %s" % (symbol.value, symbol.size, name))
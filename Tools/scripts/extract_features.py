@@ -6,6 +6,9 @@ script to determine what features have been built into an ArduPilot binary
 AP_FLAKE8_CLEAN
 """
 import argparse
+import bisect
+import hashlib
+import multiprocessing
 import os
 import re
 import string
@@ -13,6 +16,7 @@ import subprocess
 import sys
 import time
 import build_options
+import elf_reader
 import select
 
 
@@ -22,6 +26,27 @@ else:
     running_python3 = True
 
 
+re_symbol_name = re.compile("^([^(]+).*")
+re_nm_line_with_size = re.compile("^([^ ]+) ([^ ]+) ([^ ]) (.*)")
+re_nm_line = re.compile("^([^ ]+) ([^ ]) (.*)")
+
+
+def literal_prefix(pattern):
+    '''returns the literal text every string matched by re.match(pattern)
+    must start with; conservative, so may be shorter than it could be'''
+    if '|' in pattern:
+        return ''
+    prefix = ''
+    for c in pattern:
+        if c in '.^$*+?{}[]\\|()':
+            if c in '*?{':
+                # the previous character may be matched zero times
+                prefix = prefix[:-1]
+            break
+        prefix += c
+    return prefix
+
+
 class ExtractFeatures(object):
 
     class FindString(object):
@@ -381,6 +406,8 @@ class ExtractFeatures(object):
         def __init__(self):
             self.symbols = dict()
             self.symbols_without_arguments = dict()
+            # sorted keys of the dicts above, built on first use:
+            self.indexes = dict()
 
         def add(self, key, attributes):
             self.symbols[key] = attributes
@@ -388,7 +415,7 @@ class ExtractFeatures(object):
             # also keep around the same symbol name without arguments.
             # if the key is already present then the attributes become
             # None as there are multiple possible answers...
-            m = re.match("^([^(]+).*", key)
+            m = re_symbol_name.match(key)
             if m is None:
                 extracted_symbol_name = key
             else:
@@ -406,8 +433,67 @@ class ExtractFeatures(object):
                 some_dict = self.symbols
             return some_dict
 
+        def index_for_dict(self, some_dict):
+            '''returns (sorted keys, key => position in some_dict)'''
+            key = id(some_dict)
+            if key not in self.indexes:
+                self.indexes[key] = (sorted(some_dict.keys()),
+                                     {k: i for (i, k) in enumerate(some_dict.keys())})
+            return self.indexes[key]
+
+        def matches(self, symbol):
+            '''returns a list of re.match(symbol, s) results for the keys s
+            in dict_for_symbol(symbol) which match, in the order the
+            keys were added.  Only keys starting with the literal prefix
+            of symbol are tried, found by bisecting the sorted keys'''
+            (sorted_keys, position) = self.index_for_dict(self.dict_for_symbol(symbol))
+            prefix = literal_prefix(symbol)
+            start = bisect.bisect_left(sorted_keys, prefix)
+            candidates = []
+            for s in sorted_keys[start:]:
+                if not s.startswith(prefix):
+                    break
+                candidates.append(s)
+            candidates.sort(key=lambda s: position[s])
+            compiled = re.compile(symbol)
+            ret = []
+            for s in candidates:
+                m = compiled.match(s)
+                if m is not None:
+                    ret.append(m)
+            return ret
+
+    def demangle(self, names):
+        """Demangle names with the c++filt from the same toolchain as
+        self.nm, or the host's if there isn't one."""
+        cxxfilts = []
+        if self.nm.endswith("nm"):
+            cxxfilts.append(self.nm[:-2] + "c++filt")
+        cxxfilts.append("c++filt")
+        for cxxfilt in cxxfilts:
+            try:
+                return elf_reader.demangle(names, cxxfilt=cxxfilt)
+            except FileNotFoundError:
+                pass
+        raise FileNotFoundError("No c++filt found (tried %s)" % ", ".join(cxxfilts))
+
     def extract_symbols_from_elf(self, filename):
         """Parses ELF in filename, returns dict of symbols=>attributes."""
+        with elf_reader.ELFFile(filename) as elf:
+            symbols = elf.symbols()
+        try:
+            names = self.demangle([symbol.name for symbol in symbols])
+        except FileNotFoundError:
+            return self.extract_symbols_from_elf_with_nm(filename)
+        ret = ExtractFeatures.Symbols()
+        for (symbol, name) in zip(symbols, names):
+            ret.add(name, {
+                "size": symbol.size,
+            })
+        return ret
+
+    def extract_symbols_from_elf_with_nm(self, filename):
+        """Runs nm on filename, returns dict of symbols=>attributes."""
         text_output = self.run_program('EF', [
             self.nm,
             '--demangle',
@@ -416,9 +502,9 @@ class ExtractFeatures(object):
         ], show_output=False)
         ret = ExtractFeatures.Symbols()
         for line in text_output.split("\n"):
-            m = re.match("^([^ ]+) ([^ ]+) ([^ ]) (.*)", line.rstrip())
+            m = re_nm_line_with_size.match(line.rstrip())
             if m is None:
-                m = re.match("^([^ ]+) ([^ ]) (.*)", line.rstrip())
+                m = re_nm_line.match(line.rstrip())
                 if m is None:
                     # raise ValueError("Did not match (%s)" % line)
                     # e.g. Did not match (         U _errno)
@@ -436,12 +522,9 @@ class ExtractFeatures(object):
         return ret
 
     def extract_strings_from_elf(self, filename):
-        """Runs strings on filename, returns as a list"""
-        text_output = self.run_program('EF', [
-            self.strings,
-            filename
-        ], show_output=False)
-        return text_output.split("\n")
+        """Returns the printable strings in filename, as strings would"""
+        with elf_reader.ELFFile(filename) as elf:
+            return elf.strings()
 
     def extract(self):
         '''returns two sets - compiled_in and not_compiled_in'''
@@ -449,7 +532,7 @@ class ExtractFeatures(object):
         build_options_defines = set([x.define for x in build_options.BUILD_OPTIONS])
 
         symbols = self.extract_symbols_from_elf(self.filename)
-        strings = self.extract_strings_from_elf(self.filename)
+        strings = frozenset(self.extract_strings_from_elf(self.filename))
 
         remaining_build_options_defines = build_options_defines
         compiled_in_feature_defines = []
@@ -462,14 +545,9 @@ class ExtractFeatures(object):
                     compiled_in_feature_defines.append(some_define)
                     remaining_build_options_defines.discard(some_define)
             else:
-                some_dict = symbols.dict_for_symbol(symbol)
                 # look for symbols without arguments
                 # print("Looking for (%s)" % str(name))
-                for s in some_dict.keys():
-                    m = re.match(symbol, s)
-                    # print("matching %s with %s" % (symbol, s))
-                    if m is None:
-                        continue
+                for m in symbols.matches(symbol):
                     d = m.groupdict()
                     for key in d.keys():
                         d[key] = d[key].upper()
@@ -512,13 +590,108 @@ class ExtractFeatures(object):
         print(self.create_string())
 
 
+def find_elf_files(paths):
+    '''returns the ELF files in paths, searching directories recursively'''
+    ret = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                ret.extend(find_elf_files([os.path.join(dirpath, x) for x in sorted(filenames)]))
+            continue
+        try:
+            with open(path, 'rb') as f:
+                magic = f.read(4)
+        except OSError:
+            continue
+        if magic == b'\x7fELF':
+            ret.append(path)
+    return ret
+
+
+def cache_key(filepath):
+    '''key for the features of filepath; changes with the ELF and with
+    the feature and build options lists'''
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(1024*1024)
+            if len(chunk) == 0:
+                break
+            h.update(chunk)
+    features = []
+    for (define, symbol) in ExtractFeatures("").features:
+        if isinstance(symbol, ExtractFeatures.FindString):
+            symbol = ("FindString", symbol.string)
+        features.append((define, symbol))
+    h.update(repr(features).encode('utf-8'))
+    h.update(repr(sorted([x.define for x in build_options.BUILD_OPTIONS])).encode('utf-8'))
+    return h.hexdigest()
+
+
+def batch_extract(job):
+    '''extract features from one ELF for run_batch; returns (filepath,
+    features text, True if it came from the cache)'''
+    (filepath, nm, cache_dir) = job
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, cache_key(filepath) + ".txt")
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                return (filepath, f.read(), True)
+    text = ExtractFeatures(filepath, nm).create_string()
+    if cache_path is not None:
+        # write via a temporary file as other processes may be reading it
+        tmpname = "%s.%u.tmp" % (cache_path, os.getpid())
+        with open(tmpname, 'w') as f:
+            f.write(text)
+        os.replace(tmpname, cache_path)
+    return (filepath, text, False)
+
+
+def run_batch(paths, nm, cache_dir=None, jobs=None):
+    '''write FILE.features.txt for every ELF FILE found in paths'''
+    ExtractFeatures("").validate_features_list()
+    filepaths = find_elf_files(paths)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    cached = 0
+    with multiprocessing.Pool(jobs) as pool:
+        for (filepath, text, from_cache) in pool.imap_unordered(batch_extract,
+                                                                [(x, nm, cache_dir) for x in filepaths]):
+            with open(filepath + ".features.txt", 'w') as f:
+                # same as the output without --batch
+                print(text, file=f)
+            if from_cache:
+                cached += 1
+    print("EF: extracted features from %u ELF files (%u from cache)" % (len(filepaths), cached))
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(prog='extract_features.py', description='Extract ArduPilot features from binaries')
-    parser.add_argument('firmware_file', help='firmware binary')
+    parser.add_argument('firmware_file', nargs='+', help='firmware binary, or with --batch binaries and directories of them')
     parser.add_argument('--nm', type=str, default="arm-none-eabi-nm", help='nm binary to use.')
+    parser.add_argument('--batch', action='store_true', default=False,
+                        help='write FILE.features.txt for every ELF FILE found instead of printing features')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of ELF files to process at once in --batch mode')
+    parser.add_argument('--cache-dir', type=str,
+                        default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                             "..", "..", "build", "extract_features_cache"),
+                        help='directory to cache --batch results in, by ELF hash')
+    parser.add_argument('--no-cache', action='store_true', default=False, help='do not cache --batch results')
     args = parser.parse_args()
     # print(args.firmware_file, args.nm)
 
-    ef = ExtractFeatures(args.firmware_file, args.nm)
+    if args.batch:
+        cache_dir = None
+        if not args.no_cache:
+            cache_dir = os.path.realpath(args.cache_dir)
+        run_batch(args.firmware_file, args.nm, cache_dir=cache_dir, jobs=args.jobs)
+        sys.exit(0)
+
+    if len(args.firmware_file) != 1:
+        parser.error("only one firmware_file may be given without --batch")
+
+    ef = ExtractFeatures(args.firmware_file[0], args.nm)
     ef.run()
@@ -14,10 +14,21 @@ Starting in the ardupilot directory.
 ~/ardupilot $ python Tools/scripts/size_compare_branches.py --branch=[PR_BRANCH_NAME] --vehicle=copter
 
 Output is placed into ../ELF_DIFF_[VEHICLE_NAME]
+
+--symbol-diff writes a plain-text comparison of section and symbol
+sizes to ../SYMBOL_DIFF_[BOARD]_[VEHICLE].txt instead; it reads the ELF
+files directly and takes seconds rather than minutes.
+
+--build-cache-dir keeps the outputs of each build in a local cache
+keyed on the board, vehicle, git tree, extra hwdefs and toolchain, so
+re-running a comparison only builds what has changed.  With
+--reuse-configure a build directory which is already configured for
+the same board, options and build system is not re-configured.
 '''
 
 import copy
 import fnmatch
+import hashlib
 import optparse
 import os
 import pathlib
@@ -29,6 +40,7 @@ import tempfile
 import threading
 import time
 import board_list
+import elf_reader
 
 
 class SizeCompareBranchesResult(object):
@@ -41,9 +53,87 @@ class SizeCompareBranchesResult(object):
         self.identical = identical
 
 
+class BuildCache(object):
+    '''local store of build outputs, keyed by a hash of everything which
+    went into them (see SizeCompareBranches.build_cache_key).  Each
+    entry is a directory of files relative to build/BOARD.  The least
+    recently used entries are removed once the cache is larger than
+    max_size bytes'''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def store(self, key, board_dir, relpaths):
+        '''copy relpaths (relative to board_dir) into the cache as key'''
+        tmpdir = tempfile.mkdtemp(dir=self.path, prefix="tmp-")
+        for relpath in relpaths:
+            dest = os.path.join(tmpdir, relpath)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copy2(os.path.join(board_dir, relpath), dest)
+        with self.lock:
+            if os.path.isdir(self.entry_path(key)):
+                shutil.rmtree(tmpdir)
+            else:
+                os.rename(tmpdir, self.entry_path(key))
+            self.touch(key)
+            self.evict()
+
+    def restore(self, key, board_dir):
+        '''copy the files stored as key into board_dir; returns False if
+        there is no such entry'''
+        entry = self.entry_path(key)
+        with self.lock:
+            if not os.path.isdir(entry):
+                return False
+            for (dirpath, dirnames, filenames) in os.walk(entry):
+                for filename in filenames:
+                    if filename == "last-used":
+                        continue
+                    src = os.path.join(dirpath, filename)
+                    dest = os.path.join(board_dir, os.path.relpath(src, entry))
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    shutil.copy2(src, dest)
+            self.touch(key)
+        return True
+
+    def touch(self, key):
+        pathlib.Path(self.entry_path(key), "last-used").touch()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for key in os.listdir(self.path):
+            entry = self.entry_path(key)
+            if key.startswith("tmp-") or not os.path.isdir(entry):
+                continue
+            size = 0
+            for (dirpath, dirnames, filenames) in os.walk(entry):
+                size += sum([os.path.getsize(os.path.join(dirpath, x)) for x in filenames])
+            try:
+                last_used = os.path.getmtime(os.path.join(entry, "last-used"))
+            except OSError:
+                last_used = 0
+            entries.append((last_used, size, entry))
+            total += size
+        for (last_used, size, entry) in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
 class SizeCompareBranches(object):
     '''script to build and compare branches using elf_diff'''
 
+    # change this when what is stored in the build cache changes
+    build_cache_version = 1
+
     def __init__(self,
                  branch=None,
                  master_branch="master",
@@ -51,6 +141,7 @@ class SizeCompareBranches(object):
                  vehicle=["plane"],
                  bin_dir=None,
                  run_elf_diff=True,
+                 run_symbol_diff=False,
                  all_vehicles=False,
                  exclude_board_glob=[],
                  all_boards=False,
@@ -62,7 +153,10 @@ class SizeCompareBranches(object):
                  extra_hwdef_branch=[],
                  extra_hwdef_master=[],
                  parallel_copies=None,
-                 jobs=None):
+                 jobs=None,
+                 build_cache_dir=None,
+                 build_cache_size=10*1024*1024*1024,
+                 reuse_configure=False):
 
         if branch is None:
             branch = self.find_current_git_branch_or_sha1()
@@ -73,6 +167,7 @@ class SizeCompareBranches(object):
         self.vehicle = vehicle
         self.bin_dir = bin_dir
         self.run_elf_diff = run_elf_diff
+        self.run_symbol_diff = run_symbol_diff
         self.extra_hwdef = extra_hwdef
         self.extra_hwdef_branch = extra_hwdef_branch
         self.extra_hwdef_master = extra_hwdef_master
@@ -84,6 +179,11 @@ class SizeCompareBranches(object):
         self.show_unchanged = show_unchanged
         self.parallel_copies = parallel_copies
         self.jobs = jobs
+        self.build_cache = None
+        if build_cache_dir is not None:
+            self.build_cache = BuildCache(build_cache_dir, build_cache_size)
+        self.reuse_configure = reuse_configure
+        self._toolchain_version = None
 
         if self.bin_dir is None:
             self.bin_dir = self.find_bin_dir()
@@ -341,7 +441,6 @@ class SizeCompareBranches(object):
         build_dir = "build"
         if source_dir is not None:
             build_dir = os.path.join(source_dir, "build")
-        shutil.rmtree(build_dir, ignore_errors=True)
         waf_configure_args = ["configure", "--board", board]
         if self.waf_consistent_builds:
             waf_configure_args.append("--consistent-builds")
@@ -357,7 +456,25 @@ class SizeCompareBranches(object):
         if jobs is not None:
             waf_configure_args.extend(["-j", str(jobs)])
 
-        self.run_waf(waf_configure_args, show_output=False, source_dir=source_dir)
+        configure_state_path = os.path.join(build_dir, "scb_configure_state.txt")
+        configure_state = None
+        if self.reuse_configure:
+            configure_state = self.configure_state(branch, waf_configure_args, extra_hwdef, source_dir)
+        try:
+            old_configure_state = pathlib.Path(configure_state_path).read_text()
+        except OSError:
+            old_configure_state = None
+        if configure_state is not None and configure_state == old_configure_state:
+            self.progress(f"Reusing configuration of {board} in {build_dir}")
+            # remove the outputs of previous builds so they can't be
+            # mistaken for this one's:
+            for dirname in "bin", "bootloader":
+                shutil.rmtree(os.path.join(build_dir, board, dirname), ignore_errors=True)
+        else:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            self.run_waf(waf_configure_args, show_output=False, source_dir=source_dir)
+            if configure_state is not None:
+                pathlib.Path(configure_state_path).write_text(configure_state)
         # we can't run `./waf copter blimp plane` without error, so do
         # them one-at-a-time:
         for v in vehicle:
@@ -381,12 +498,107 @@ class SizeCompareBranches(object):
                 if source_dir is not None:
                     dsdl_generated_path = os.path.join(source_dir, dsdl_generated_path)
                 shutil.rmtree(dsdl_generated_path, ignore_errors=True)
+            # the build directory is no longer configured for the vehicles:
+            pathlib.Path(configure_state_path).unlink(missing_ok=True)
             self.run_waf(bootloader_waf_configure_args, show_output=False, source_dir=source_dir)
             self.run_waf([v], show_output=False, source_dir=source_dir)
         self.run_program("rsync", ["rsync", "-ap", "build/", outdir], cwd=source_dir)
         if source_dir is not None:
             pathlib.Path(outdir, "scb_sourcepath.txt").write_text(source_dir)
 
+    # files and directories which the result of a waf configure depends on
+    configure_inputs = [
+        "wscript",
+        "Tools/ardupilotwaf",
+        "libraries/AP_HAL_ChibiOS/hwdef",
+        "modules",
+    ]
+
+    def configure_state(self, branch, waf_configure_args, extra_hwdef, source_dir=None):
+        '''returns a string identifying the configuration which
+        waf_configure_args would produce at branch, or None if that
+        can't be determined'''
+        try:
+            trees = self.run_git(
+                ["rev-parse"] + [f"{branch}:{x}" for x in self.configure_inputs],
+                show_output=False,
+                source_dir=source_dir,
+            )
+        except subprocess.CalledProcessError:
+            return None
+        args = copy.copy(waf_configure_args)
+        if extra_hwdef is not None:
+            # the extra hwdef is a new temporary file each time; use its content
+            args[args.index(extra_hwdef)] = self.file_sha256(extra_hwdef)
+        return "\n".join([" ".join(args), trees.strip(), ""])
+
+    def file_sha256(self, filepath):
+        with open(filepath, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def tree_is_dirty(self):
+        '''returns True if tracked files have been modified, in which case
+        a build of a commit would not be what is in that commit'''
+        output = self.run_git(["status", "--porcelain", "--untracked-files=no"], show_output=False)
+        return len(output.strip()) != 0
+
+    def toolchain_version(self):
+        '''returns the versions of the compilers builds may use'''
+        if self._toolchain_version is None:
+            versions = []
+            for compiler in [os.path.join(self.bin_dir, "arm-none-eabi-g++"), "g++"]:
+                try:
+                    output = subprocess.check_output([compiler, "--version"], universal_newlines=True)
+                    versions.append(output.split("\n")[0])
+                except (OSError, subprocess.CalledProcessError):
+                    versions.append("none")
+            self._toolchain_version = "\n".join(versions)
+        return self._toolchain_version
+
+    def build_cache_keys(self, task, extra_hwdef, source_dir=None):
+        '''returns a dictionary of vehicle => build cache key for task'''
+        try:
+            tree = self.run_git(
+                ["rev-parse", task.commitish + "^{tree}"],
+                show_output=False,
+                source_dir=source_dir,
+            ).strip()
+        except subprocess.CalledProcessError:
+            return {}
+        extra_hwdef_hash = None
+        if extra_hwdef is not None:
+            extra_hwdef_hash = self.file_sha256(extra_hwdef)
+        ret = {}
+        for vehicle in task.vehicles_to_build:
+            description = repr((
+                self.build_cache_version,
+                task.board,
+                vehicle,
+                tree,
+                extra_hwdef_hash,
+                self.waf_consistent_builds,
+                self.run_elf_diff,
+                self.toolchain_version(),
+            ))
+            ret[vehicle] = hashlib.sha256(description.encode('utf-8')).hexdigest()
+        return ret
+
+    def build_artifacts(self, board_dir, vehicle):
+        '''returns paths relative to board_dir of the files built for vehicle'''
+        name = self.vehicle_map[vehicle]
+        ret = []
+        for dirname in "bin", "bootloader":
+            try:
+                filenames = os.listdir(os.path.join(board_dir, dirname))
+            except OSError:
+                continue
+            for filename in sorted(filenames):
+                # e.g. arducopter, arducopter.apj, arducopter_with_bl.hex
+                # but not arducopter-heli:
+                if filename == name or filename.startswith(name + ".") or filename.startswith(name + "_"):
+                    ret.append(os.path.join(dirname, filename))
+        return ret
+
     def vehicles_to_build_for_board_info(self, board_info):
         vehicles_to_build = []
         for vehicle in self.vehicle:
@@ -515,6 +727,10 @@ class SizeCompareBranches(object):
         tmpdir = tempfile.mkdtemp()
         self.tmpdir = tmpdir
 
+        if self.build_cache is not None and self.tree_is_dirty():
+            self.progress("Tracked files are modified; not using the build cache")
+            self.build_cache = None
+
         self.master_commit = self.master_branch
         if self.use_merge_base:
             self.master_commit = self.find_git_branch_merge_base(self.branch, self.master_branch)
@@ -600,6 +816,73 @@ class SizeCompareBranches(object):
 
             self.run_program("SCB", elf_diff_commandline)
 
+    def symbol_sizes(self, elf):
+        '''returns dict of demangled symbol name => total size'''
+        symbols = elf.symbols()
+        cxxfilt = os.path.join(self.bin_dir, "arm-none-eabi-c++filt")
+        if not os.path.exists(cxxfilt):
+            cxxfilt = "c++filt"
+        names = elf_reader.demangle([x.name for x in symbols], cxxfilt=cxxfilt)
+        ret = {}
+        for (symbol, name) in zip(symbols, names):
+            ret[name] = ret.get(name, 0) + symbol.size
+        return ret
+
+    def symbol_diff_text(self, master_elf_path, new_elf_path, master_alias, new_alias):
+        '''returns a text report of the section and symbol size changes
+        between two ELF files'''
+        with elf_reader.ELFFile(master_elf_path) as master_elf, elf_reader.ELFFile(new_elf_path) as new_elf:
+            master_sizes = master_elf.berkeley_sizes()
+            new_sizes = new_elf.berkeley_sizes()
+            master_symbols = self.symbol_sizes(master_elf)
+            new_symbols = self.symbol_sizes(new_elf)
+
+        ret = "old: %s\nnew: %s\n\n" % (master_alias, new_alias)
+        ret += "%-6s %10s %10s %10s\n" % ("", "text", "data", "bss")
+        ret += "%-6s %10u %10u %10u\n" % (("old",) + master_sizes)
+        ret += "%-6s %10u %10u %10u\n" % (("new",) + new_sizes)
+        ret += "%-6s %+10d %+10d %+10d\n" % (("delta",) + tuple([n - m for (m, n) in zip(master_sizes, new_sizes)]))
+
+        changes = []
+        for name in set(master_symbols.keys()) | set(new_symbols.keys()):
+            delta = new_symbols.get(name, 0) - master_symbols.get(name, 0)
+            if name not in master_symbols:
+                status = "added"
+            elif name not in new_symbols:
+                status = "removed"
+            elif delta != 0:
+                status = "changed"
+            else:
+                continue
+            changes.append((status, delta, name))
+        ret += "\n%u symbols added, %u removed, %u changed in size\n\n" % (
+            len([x for x in changes if x[0] == "added"]),
+            len([x for x in changes if x[0] == "removed"]),
+            len([x for x in changes if x[0] == "changed"]))
+        for (status, delta, name) in sorted(changes, key=lambda x: (-abs(x[1]), x[2])):
+            ret += "%+8d %-7s %s\n" % (delta, status, name)
+        return ret
+
+    def symbol_diff_results(self, result_master, result_branch):
+        '''write a symbol size comparison for each vehicle, reading the
+        ELF files in-process; much quicker than elf_diff'''
+        master_branch = result_master["branch"]
+        branch = result_branch["branch"]
+        board = result_master["board"]
+        for vehicle in result_master["vehicle"].keys():
+            elf_filename = result_master["vehicle"][vehicle]["elf_filename"]
+            master_elf_dir = result_master["vehicle"][vehicle]["elf_dir"]
+            new_elf_dir = result_branch["vehicle"][vehicle]["elf_dir"]
+            text = self.symbol_diff_text(
+                os.path.join(master_elf_dir, elf_filename),
+                os.path.join(new_elf_dir, elf_filename),
+                "%s %s" % (master_branch, elf_filename),
+                "%s %s" % (branch, elf_filename),
+            )
+            path = "../SYMBOL_DIFF_%s_%s.txt" % (board, vehicle)
+            pathlib.Path(path).write_text(text)
+            self.progress("Wrote symbol comparison (%s)" % path)
+
     def compare_task_results(self, task_results, no_elf_diff=False):
         # pair off results, master and branch:
         pairs = {}
@@ -625,6 +908,8 @@ class SizeCompareBranches(object):
                 results[board] = self.compare_results(master, pair["branch"])
                 if self.run_elf_diff and not no_elf_diff:
                     self.elf_diff_results(master, pair["branch"])
+                if self.run_symbol_diff and not no_elf_diff:
+                    self.symbol_diff_results(master, pair["branch"])
             except FileNotFoundError:
                 pass
 
@@ -700,16 +985,44 @@ class SizeCompareBranches(object):
     def run_build_task(self, task, source_dir=None, jobs=None):
         self.progress(f"Building {task}")
         shutil.rmtree(task.outdir, ignore_errors=True)
+        extra_hwdef = self.extra_hwdef_file(task.extra_hwdef_file)
+        board_dir = os.path.join(task.outdir, task.board)
+
+        cache_keys = {}
+        if self.build_cache is not None:
+            cache_keys = self.build_cache_keys(task, extra_hwdef, source_dir=source_dir)
+        vehicles_to_build = []
+        for vehicle in task.vehicles_to_build:
+            if vehicle in cache_keys and self.build_cache.restore(cache_keys[vehicle], board_dir):
+                self.progress(f"Using cached build of {vehicle} for {task.board} at {task.commitish}")
+                continue
+            vehicles_to_build.append(vehicle)
+
+        if len(vehicles_to_build) == 0:
+            return
+
         self.build_branch_into_dir(
             task.board,
             task.commitish,
-            task.vehicles_to_build,
+            vehicles_to_build,
             task.outdir,
             source_dir=source_dir,
-            extra_hwdef=self.extra_hwdef_file(task.extra_hwdef_file),
+            extra_hwdef=extra_hwdef,
             jobs=jobs,
         )
 
+        if len(vehicles_to_build) != len(task.vehicles_to_build):
+            # the build tree doesn't have the cached vehicles, so results
+            # must be taken from outdir:
+            pathlib.Path(task.outdir, "scb_sourcepath.txt").unlink(missing_ok=True)
+
+        for vehicle in vehicles_to_build:
+            if vehicle not in cache_keys:
+                continue
+            relpaths = self.build_artifacts(board_dir, vehicle)
+            if len(relpaths):
+                self.build_cache.store(cache_keys[vehicle], board_dir, relpaths)
+
     def gather_results_for_task(self, task):
         result = {
             "board": task.board,
@@ -782,6 +1095,11 @@ if __name__ == '__main__':
                       action="store_true",
                       default=False,
                       help="run elf_diff on output files")
+    parser.add_option("",
+                      "--symbol-diff",
+                      action="store_true",
+                      default=False,
+                      help="write a symbol size comparison of output files to ../SYMBOL_DIFF_BOARD_VEHICLE.txt")
     parser.add_option("",
                       "--master-branch",
                       type="string",
@@ -862,6 +1180,21 @@ if __name__ == '__main__':
                       type=int,
                       default=None,
                       help="Passed to waf configure -j; number of build jobs.  If running with --parallel-copies, this is divided by the number of remaining threads before being passed.")  # noqa
+    parser.add_option("",
+                      "--build-cache-dir",
+                      type="string",
+                      default=None,
+                      help="keep build outputs in this directory and reuse them when the same source tree is built again")
+    parser.add_option("",
+                      "--build-cache-size",
+                      type=int,
+                      default=10*1024,
+                      help="maximum size of the build cache in MB")
+    parser.add_option("",
+                      "--reuse-configure",
+                      action='store_true',
+                      default=False,
+                      help="skip waf configure when the build directory is already configured the same way")
     cmd_opts, cmd_args = parser.parse_args()
 
     vehicle = []
@@ -885,6 +1218,7 @@ if __name__ == '__main__':
         extra_hwdef_branch=cmd_opts.extra_hwdef_branch,
         extra_hwdef_master=cmd_opts.extra_hwdef_master,
         run_elf_diff=(cmd_opts.elf_diff),
+        run_symbol_diff=cmd_opts.symbol_diff,
         all_vehicles=cmd_opts.all_vehicles,
         all_boards=cmd_opts.all_boards,
         exclude_board_glob=cmd_opts.exclude_board_glob,
@@ -894,5 +1228,8 @@ if __name__ == '__main__':
         show_unchanged=not cmd_opts.hide_unchanged,
         parallel_copies=cmd_opts.parallel_copies,
         jobs=cmd_opts.jobs,
+        build_cache_dir=cmd_opts.build_cache_dir,
+        build_cache_size=cmd_opts.build_cache_size*1024*1024,
+        reuse_configure=cmd_opts.reuse_configure,
     )
     x.run()
@@ -10,10 +10,12 @@ parser.add_argument("--no-graph", action='store_true', default=False, help='disa
 parser.add_argument("--log-parm", action='store_true', default=False, help='show corrections using coefficients from log file')
 parser.add_argument("--online", action='store_true', default=False, help='use online polynomial fitting')
 parser.add_argument("--tclr", action='store_true', default=False, help='use TCLR messages from log instead of IMU messages')
+parser.add_argument("--no-bulk", action='store_true', default=False, help='decode the log message-by-message rather than in bulk')
 parser.add_argument("log", metavar="LOG")
 
 args = parser.parse_args()
 
+import os
 import sys
 import math
 import re
@@ -22,6 +24,10 @@ import numpy as np
 import matplotlib.pyplot as pyplot
 from scipy import signal
 from pymavlink.rotmat import Vector3, Matrix3
+from pymavlink import rotmat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '../autotest/pysim'))
+from columnar_dfreader import ColumnarDFReader
 
 # fit an order 3 polynomial
 POLY_ORDER = 3
@@ -109,7 +115,8 @@ class Coefficients:
             return 0.0
         if axis not in coeff:
             return 0.0
-        temperature = constrain(temperature, self.tmin[imu], self.tmax[imu])
+        # np.clip so temperature may also be an array of temperatures
+        temperature = np.clip(temperature, self.tmin[imu], self.tmax[imu])
         cal_temp = constrain(cal_temp, self.tmin[imu], self.tmax[imu])
         poly = np.poly1d(coeff[axis])
         return poly(cal_temp - TEMP_REF) - poly(temperature - TEMP_REF)
@@ -168,6 +175,21 @@ class OnlineIMUfit:
             self.vec[i] += y * temp
             temp *= x
 
+    def update_array(self, x, y):
+        '''equivalent to calling update() for each element of x and y'''
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        top = 2*(self.porder - 1)
+        # sums of powers of x, xpow[n] = sum(x**n)
+        powers = np.vander(x, top + 1, increasing=True)
+        xpow = powers.sum(axis=0)
+        for j in range(self.porder):
+            for l in range(self.porder):
+                self.mat[j][l] += xpow[top - j - l]
+        ypow = (powers[:, :self.porder] * y[:, None]).sum(axis=0)
+        for i in range(self.porder):
+            self.vec[i] += ypow[self.porder - 1 - i]
+
     def get_polynomial(self):
         inv_mat = np.linalg.inv(self.mat)
         res = np.zeros(self.porder)
@@ -180,8 +202,7 @@ class OnlineIMUfit:
         self.porder = order + 1
         self.mat = np.zeros((self.porder, self.porder))
         self.vec = np.zeros(self.porder)
-        for i in range(len(x)):
-            self.update(x[i], y[i])
+        self.update_array(x, y)
         return self.get_polynomial()
 
 class IMUData:
@@ -218,6 +239,21 @@ class IMUData:
         self.gyro[imu]['Z'] = np.append(self.gyro[imu]['Z'], value.z)
         self.gyro[imu]['time'] = np.append(self.gyro[imu]['time'], time)
 
+    def add_arrays(self, data, imu, temperature, time, x, y, z):
+        '''add arrays of samples in one go'''
+        if imu not in data:
+            data[imu] = {}
+            for axis in AXEST:
+                data[imu][axis] = np.zeros(0,dtype=float)
+        for (axis, values) in zip(AXEST, (x, y, z, temperature, time)):
+            data[imu][axis] = np.concatenate((data[imu][axis], values))
+
+    def add_accel_arrays(self, imu, temperature, time, x, y, z):
+        self.add_arrays(self.accel, imu, temperature, time, x, y, z)
+
+    def add_gyro_arrays(self, imu, temperature, time, x, y, z):
+        self.add_arrays(self.gyro, imu, temperature, time, x, y, z)
+
     def moving_average(self, data, w):
         '''apply a moving average filter over a window of width w'''
         ret = np.cumsum(data)
@@ -240,29 +276,28 @@ class IMUData:
             self.accel[imu] = self.FilterArray(self.accel[imu], width_s)
             self.gyro[imu] = self.FilterArray(self.gyro[imu], width_s)
 
+    def value_at_temp(self, data, axis, temperature):
+        '''return the value closest to the given temperature, interpolating
+        between the first pair of samples which bracket it'''
+        T = data['T']
+        if temperature < T[0]:
+            return data[axis][0]
+        bracketing = np.nonzero((temperature >= T[:-1]) & (temperature <= T[1:]))[0]
+        if len(bracketing) == 0:
+            return data[axis][-1]
+        i = bracketing[0]
+        v1 = data[axis][i]
+        v2 = data[axis][i+1]
+        p = (temperature - T[i]) / (T[i+1]-T[i])
+        return v1 + (v2-v1) * p
+
     def accel_at_temp(self, imu, axis, temperature):
         '''return the accel value closest to the given temperature'''
-        if temperature < self.accel[imu]['T'][0]:
-            return self.accel[imu][axis][0]
-        for i in range(len(self.accel[imu]['T'])-1):
-            if temperature >= self.accel[imu]['T'][i] and temperature <= self.accel[imu]['T'][i+1]:
-                v1 = self.accel[imu][axis][i]
-                v2 = self.accel[imu][axis][i+1]
-                p = (temperature - self.accel[imu]['T'][i]) / (self.accel[imu]['T'][i+1]-self.accel[imu]['T'][i])
-                return v1 + (v2-v1) * p
-        return self.accel[imu][axis][-1]
+        return self.value_at_temp(self.accel[imu], axis, temperature)
 
     def gyro_at_temp(self, imu, axis, temperature):
         '''return the gyro value closest to the given temperature'''
-        if temperature < self.gyro[imu]['T'][0]:
-            return self.gyro[imu][axis][0]
-        for i in range(len(self.gyro[imu]['T'])-1):
-            if temperature >= self.gyro[imu]['T'][i] and temperature <= self.gyro[imu]['T'][i+1]:
-                v1 = self.gyro[imu][axis][i]
-                v2 = self.gyro[imu][axis][i+1]
-                p = (temperature - self.gyro[imu]['T'][i]) / (self.gyro[imu]['T'][i+1]-self.gyro[imu]['T'][i])
-                return v1 + (v2-v1) * p
-        return self.gyro[imu][axis][-1]
+        return self.value_at_temp(self.gyro[imu], axis, temperature)
 
 
 def constrain(value, minv, maxv):
@@ -273,14 +308,96 @@ def constrain(value, minv, maxv):
         value = maxv
     return value
 
-def IMUfit(logfile):
-    '''find IMU calibration parameters from a log file'''
-    print("Processing log %s" % logfile)
+# compiled once; PARM messages are matched against all of these
+RE_TCAL_ENABLE = re.compile(r"^INS_TCAL(\d)_ENABLE$")
+RE_TCAL_COEFF = re.compile(r"^INS_TCAL(\d)_(ACC|GYR)([1-3])_([XYZ])$")
+RE_TCAL_TMIN = re.compile(r"^INS_TCAL(\d)_TMIN$")
+RE_TCAL_TMAX = re.compile(r"^INS_TCAL(\d)_TMAX")
+RE_GYR_CALTEMP = re.compile(r"^INS_GYR(\d)_CALTEMP")
+RE_ACC_CALTEMP = re.compile(r"^INS_ACC(\d)_CALTEMP")
+RE_OFFS = re.compile(r"^INS_(ACC|GYR)(\d?)OFFS_([XYZ])$")
+
+def process_parm(c, stop_capture, name, value):
+    '''update coefficients c from a PARM message.  Returns the new
+    board orientation if the message sets it, otherwise None'''
+    if name == 'AHRS_ORIENTATION':
+        orientation = int(value)
+        print("Using orientation %d" % orientation)
+        return orientation
+    if not name.startswith('INS_'):
+        return None
+    # build up the old coefficients so we can remove the impact of
+    # existing coefficients from the data
+    m = RE_TCAL_ENABLE.match(name)
+    if m:
+        imu = int(m.group(1))-1
+        if stop_capture[imu]:
+            return None
+        if value == 1 and c.enable[imu] == 2:
+            print("TCAL[%u] enabled" % imu)
+            stop_capture[imu] = True
+            return None
+        if value == 0 and c.enable[imu] == 1:
+            print("TCAL[%u] disabled" % imu)
+            stop_capture[imu] = True
+            return None
+        c.set_enable(imu, value)
+    m = RE_TCAL_COEFF.match(name)
+    if m:
+        imu = int(m.group(1))-1
+        stype = m.group(2)
+        p = int(m.group(3))
+        axis = m.group(4)
+        if stop_capture[imu]:
+            return None
+        if stype == 'ACC':
+            c.set_acoeff(imu, axis, p, value/SCALE_FACTOR)
+        if stype == 'GYR':
+            c.set_gcoeff(imu, axis, p, value/SCALE_FACTOR)
+    m = RE_TCAL_TMIN.match(name)
+    if m:
+        imu = int(m.group(1))-1
+        if stop_capture[imu]:
+            return None
+        c.set_tmin(imu, value)
+    m = RE_TCAL_TMAX.match(name)
+    if m:
+        imu = int(m.group(1))-1
+        if stop_capture[imu]:
+            return None
+        c.set_tmax(imu, value)
+    m = RE_GYR_CALTEMP.match(name)
+    if m:
+        imu = int(m.group(1))-1
+        if stop_capture[imu]:
+            return None
+        c.set_gyro_tcal(imu, value)
+    m = RE_ACC_CALTEMP.match(name)
+    if m:
+        imu = int(m.group(1))-1
+        if stop_capture[imu]:
+            return None
+        c.set_accel_tcal(imu, value)
+    m = RE_OFFS.match(name)
+    if m:
+        stype = m.group(1)
+        if m.group(2) == "":
+            imu = 0
+        else:
+            imu = int(m.group(2))-1
+        axis = m.group(3)
+        if stop_capture[imu]:
+            return None
+        if stype == 'ACC':
+            c.set_aoffset(imu, axis, value)
+        if stype == 'GYR':
+            c.set_goffset(imu, axis, value)
+    return None
+
+def load_messages(logfile, data, c):
+    '''load IMU or TCLR data from a log one message at a time'''
     mlog = mavutil.mavlink_connection(logfile)
 
-    data = IMUData()
-
-    c = Coefficients()
     orientation = 0
 
     stop_capture = [ False ] * 3
@@ -296,75 +413,9 @@ def IMUfit(logfile):
             break
 
         if msg.get_type() == 'PARM':
-            # build up the old coefficients so we can remove the impact of
-            # existing coefficients from the data
-            m = re.match("^INS_TCAL(\d)_ENABLE$", msg.Name)
-            if m:
-                imu = int(m.group(1))-1
-                if stop_capture[imu]:
-                    continue
-                if msg.Value == 1 and c.enable[imu] == 2:
-                    print("TCAL[%u] enabled" % imu)
-                    stop_capture[imu] = True
-                    continue
-                if msg.Value == 0 and c.enable[imu] == 1:
-                    print("TCAL[%u] disabled" % imu)
-                    stop_capture[imu] = True
-                    continue
-                c.set_enable(imu, msg.Value)
-            m = re.match("^INS_TCAL(\d)_(ACC|GYR)([1-3])_([XYZ])$", msg.Name)
-            if m:
-                imu = int(m.group(1))-1
-                stype = m.group(2)
-                p = int(m.group(3))
-                axis = m.group(4)
-                if stop_capture[imu]:
-                    continue
-                if stype == 'ACC':
-                    c.set_acoeff(imu, axis, p, msg.Value/SCALE_FACTOR)
-                if stype == 'GYR':
-                    c.set_gcoeff(imu, axis, p, msg.Value/SCALE_FACTOR)
-            m = re.match("^INS_TCAL(\d)_TMIN$", msg.Name)
-            if m:
-                imu = int(m.group(1))-1
-                if stop_capture[imu]:
-                    continue
-                c.set_tmin(imu, msg.Value)
-            m = re.match("^INS_TCAL(\d)_TMAX", msg.Name)
-            if m:
-                imu = int(m.group(1))-1
-                if stop_capture[imu]:
-                    continue
-                c.set_tmax(imu, msg.Value)
-            m = re.match("^INS_GYR(\d)_CALTEMP", msg.Name)
-            if m:
-                imu = int(m.group(1))-1
-                if stop_capture[imu]:
-                    continue
-                c.set_gyro_tcal(imu, msg.Value)
-            m = re.match("^INS_ACC(\d)_CALTEMP", msg.Name)
-            if m:
-                imu = int(m.group(1))-1
-                if stop_capture[imu]:
-                    continue
-                c.set_accel_tcal(imu, msg.Value)
-            m = re.match("^INS_(ACC|GYR)(\d?)OFFS_([XYZ])$", msg.Name)
-            if m:
-                stype = m.group(1)
-                if m.group(2) == "":
-                    imu = 0
-                else:
-                    imu = int(m.group(2))-1
-                axis = m.group(3)
-                if stop_capture[imu]:
-                    continue
-                if stype == 'ACC':
-                    c.set_aoffset(imu, axis, msg.Value)
-                if stype == 'GYR':
-                    c.set_goffset(imu, axis, msg.Value)
-            if msg.Name == 'AHRS_ORIENTATION':
-                orientation = int(msg.Value)
-                print("Using orientation %d" % orientation)
+            new_orientation = process_parm(c, stop_capture, msg.Name, msg.Value)
+            if new_orientation is not None:
+                orientation = new_orientation
 
         if msg.get_type() == 'TCLR' and args.tclr:
             imu = msg.I
@@ -407,6 +458,116 @@ def IMUfit(logfile):
             data.add_accel(imu, T, time, acc)
             data.add_gyro (imu, T, time, gyr)
 
+def rotate_by_inverse_id_arrays(x, y, z, orientation):
+    '''apply Vector3.rotate_by_inverse_id to arrays of x, y and z'''
+    if orientation >= len(rotmat.rotations):
+        print("Invalid AHRS_ORIENTATION %u" % orientation)
+        sys.exit(1)
+    rt = rotmat.rotations[orientation].rt
+    # same operation order as Matrix3 * Vector3 so results are identical
+    return (rt.a.x * x + rt.a.y * y + rt.a.z * z,
+            rt.b.x * x + rt.b.y * y + rt.b.z * z,
+            rt.c.x * x + rt.c.y * y + rt.c.z * z)
+
+def load_bulk(logfile, data, c):
+    '''load IMU or TCLR data from a binary log, decoding each message
+    type into arrays in one pass'''
+    log = ColumnarDFReader(logfile)
+
+    orientation = 0
+
+    stop_capture = [ False ] * 3
+
+    if 'PARM' in log:
+        parm = log['PARM']
+        parm_names = [n.decode('ascii', errors='replace') for n in parm['Name']]
+        parm_values = parm['Value'].astype(float)
+        parm_offsets = parm.offsets
+    else:
+        parm_names = []
+        parm_values = []
+        parm_offsets = np.zeros(0, dtype=np.int64)
+
+    # PARM messages are applied in log order, as load_messages does
+    parms_done = 0
+
+    def apply_parms(nparms):
+        nonlocal orientation, parms_done
+        while parms_done < nparms:
+            new_orientation = process_parm(c, stop_capture, parm_names[parms_done], parm_values[parms_done])
+            if new_orientation is not None:
+                orientation = new_orientation
+            parms_done += 1
+
+    if args.tclr:
+        # TCLR samples are used as logged, so only the final
+        # parameters matter
+        apply_parms(len(parm_names))
+        if 'TCLR' not in log:
+            return
+        tclr = log['TCLR']
+        for (imu, rows) in tclr.split('I').items():
+            T = rows['Temp'].astype(float)
+            time = rows['TimeUS']*1.0e-6
+            xyz = [rows[axis].astype(float) for axis in AXES]
+            stype = rows['SType']
+            accel = stype == 0
+            gyro = stype == 1
+            data.add_accel_arrays(imu, T[accel], time[accel], *[v[accel] for v in xyz])
+            data.add_gyro_arrays(imu, T[gyro], time[gyro], *[v[gyro] for v in xyz])
+        return
+
+    if 'IMU' not in log:
+        apply_parms(len(parm_names))
+        return
+    imu_msgs = log['IMU']
+    # PARM messages change the coefficients, enables and orientation
+    # applied to subsequent IMU samples; process the IMU samples in
+    # runs, each run seeing the PARM messages which came before it
+    # in the log.
+    parms_before = np.searchsorted(parm_offsets, imu_msgs.offsets)
+    for nparms in np.unique(parms_before):
+        apply_parms(nparms)
+        run = imu_msgs.raw[parms_before == nparms]
+        for imu in np.unique(run['I']):
+            imu = int(imu)
+            if stop_capture[imu]:
+                continue
+            rows = run[run['I'] == imu]
+            T = rows['T'].astype(float)
+            acc = [rows[col].astype(float) for col in ('AccX', 'AccY', 'AccZ')]
+            gyr = [rows[col].astype(float) for col in ('GyrX', 'GyrY', 'GyrZ')]
+
+            # invert the board orientation rotation. Corrections are in sensor frame
+            if orientation != 0:
+                acc = rotate_by_inverse_id_arrays(*acc, orientation)
+                gyr = rotate_by_inverse_id_arrays(*gyr, orientation)
+
+            if c.enable[imu] == 1:
+                acal_temp = c.atcal.get(imu, TEMP_REF)
+                gcal_temp = c.gtcal.get(imu, TEMP_REF)
+                acc = [acc[i] - c.correction(c.acoef[imu], imu, T, axis, acal_temp) for (i, axis) in enumerate(AXES)]
+                gyr = [gyr[i] - c.correction(c.gcoef[imu], imu, T, axis, gcal_temp) for (i, axis) in enumerate(AXES)]
+
+            time = rows['TimeUS']*1.0e-6
+            data.add_accel_arrays(imu, T, time, *acc)
+            data.add_gyro_arrays(imu, T, time, *gyr)
+    # and those after the last IMU sample
+    apply_parms(len(parm_names))
+
+def IMUfit(logfile):
+    '''find IMU calibration parameters from a log file'''
+    print("Processing log %s" % logfile)
+
+    data = IMUData()
+
+    c = Coefficients()
+
+    if args.no_bulk or not logfile.lower().endswith('.bin'):
+        load_messages(logfile, data, c)
+    else:
+        load_bulk(logfile, data, c)
+
     if len(data.IMUs()) == 0:
         print("No data found")
         sys.exit(1)
@@ -429,23 +590,31 @@ def IMUfit(logfile):
         c.set_tmin(imu, tmin)
         c.set_tmax(imu, tmax)
 
-        for axis in AXES:
-            if args.online:
+        if args.online:
+            for axis in AXES:
                 fit = OnlineIMUfit()
                 trel = data.accel[imu]['T'] - TEMP_REF
                 ofs = data.accel_at_temp(imu, axis, clog.atcal[imu])
                 c.set_accel_poly(imu, axis, fit.polyfit(trel, data.accel[imu][axis] - ofs, POLY_ORDER))
                 trel = data.gyro[imu]['T'] - TEMP_REF
                 c.set_gyro_poly(imu, axis, fit.polyfit(trel, data.gyro[imu][axis], POLY_ORDER))
-            else:
-                trel = data.accel[imu]['T'] - TEMP_REF
+        else:
+            # fit all three axes at once; they share temperatures
+            aofs = []
+            for axis in AXES:
                 if imu in clog.atcal:
-                    ofs = data.accel_at_temp(imu, axis, clog.atcal[imu])
+                    aofs.append(data.accel_at_temp(imu, axis, clog.atcal[imu]))
                 else:
-                    ofs = np.mean(data.accel[imu][axis])
-                c.set_accel_poly(imu, axis, np.polyfit(trel, data.accel[imu][axis] - ofs, POLY_ORDER))
-                trel = data.gyro[imu]['T'] - TEMP_REF
-                c.set_gyro_poly(imu, axis, np.polyfit(trel, data.gyro[imu][axis], POLY_ORDER))
+                    aofs.append(np.mean(data.accel[imu][axis]))
+            trel = data.accel[imu]['T'] - TEMP_REF
+            accel = np.column_stack([data.accel[imu][axis] - aofs[i] for (i, axis) in enumerate(AXES)])
+            apoly = np.polyfit(trel, accel, POLY_ORDER)
+            trel = data.gyro[imu]['T'] - TEMP_REF
+            gyro = np.column_stack([data.gyro[imu][axis] for axis in AXES])
+            gpoly = np.polyfit(trel, gyro, POLY_ORDER)
+            for (i, axis) in enumerate(AXES):
+                c.set_accel_poly(imu, axis, apoly[:, i])
+                c.set_gyro_poly(imu, axis, gpoly[:, i])
 
         params = c.param_string(imu)
         print(params)
@@ -61,10 +61,10 @@ import json
 import zlib
 import base64
 import time
-import array
 import os
 import platform
 import re
+import threading
 
 from sys import platform as _platform
 
@@ -108,56 +108,44 @@ else:
 compatible_IDs = {33: (9, 'AUAVX2.1')}
 
 
-# CRC equivalent to crc_crc32() in AP_Math/crc.cpp
-crctab = array.array('I', [
-    0x00000000, 0x77073096, 0xee0e612c, 0x990951ba, 0x076dc419, 0x706af48f, 0xe963a535, 0x9e6495a3,
-    0x0edb8832, 0x79dcb8a4, 0xe0d5e91e, 0x97d2d988, 0x09b64c2b, 0x7eb17cbd, 0xe7b82d07, 0x90bf1d91,
-    0x1db71064, 0x6ab020f2, 0xf3b97148, 0x84be41de, 0x1adad47d, 0x6ddde4eb, 0xf4d4b551, 0x83d385c7,
-    0x136c9856, 0x646ba8c0, 0xfd62f97a, 0x8a65c9ec, 0x14015c4f, 0x63066cd9, 0xfa0f3d63, 0x8d080df5,
-    0x3b6e20c8, 0x4c69105e, 0xd56041e4, 0xa2677172, 0x3c03e4d1, 0x4b04d447, 0xd20d85fd, 0xa50ab56b,
-    0x35b5a8fa, 0x42b2986c, 0xdbbbc9d6, 0xacbcf940, 0x32d86ce3, 0x45df5c75, 0xdcd60dcf, 0xabd13d59,
-    0x26d930ac, 0x51de003a, 0xc8d75180, 0xbfd06116, 0x21b4f4b5, 0x56b3c423, 0xcfba9599, 0xb8bda50f,
-    0x2802b89e, 0x5f058808, 0xc60cd9b2, 0xb10be924, 0x2f6f7c87, 0x58684c11, 0xc1611dab, 0xb6662d3d,
-    0x76dc4190, 0x01db7106, 0x98d220bc, 0xefd5102a, 0x71b18589, 0x06b6b51f, 0x9fbfe4a5, 0xe8b8d433,
-    0x7807c9a2, 0x0f00f934, 0x9609a88e, 0xe10e9818, 0x7f6a0dbb, 0x086d3d2d, 0x91646c97, 0xe6635c01,
-    0x6b6b51f4, 0x1c6c6162, 0x856530d8, 0xf262004e, 0x6c0695ed, 0x1b01a57b, 0x8208f4c1, 0xf50fc457,
-    0x65b0d9c6, 0x12b7e950, 0x8bbeb8ea, 0xfcb9887c, 0x62dd1ddf, 0x15da2d49, 0x8cd37cf3, 0xfbd44c65,
-    0x4db26158, 0x3ab551ce, 0xa3bc0074, 0xd4bb30e2, 0x4adfa541, 0x3dd895d7, 0xa4d1c46d, 0xd3d6f4fb,
-    0x4369e96a, 0x346ed9fc, 0xad678846, 0xda60b8d0, 0x44042d73, 0x33031de5, 0xaa0a4c5f, 0xdd0d7cc9,
-    0x5005713c, 0x270241aa, 0xbe0b1010, 0xc90c2086, 0x5768b525, 0x206f85b3, 0xb966d409, 0xce61e49f,
-    0x5edef90e, 0x29d9c998, 0xb0d09822, 0xc7d7a8b4, 0x59b33d17, 0x2eb40d81, 0xb7bd5c3b, 0xc0ba6cad,
-    0xedb88320, 0x9abfb3b6, 0x03b6e20c, 0x74b1d29a, 0xead54739, 0x9dd277af, 0x04db2615, 0x73dc1683,
-    0xe3630b12, 0x94643b84, 0x0d6d6a3e, 0x7a6a5aa8, 0xe40ecf0b, 0x9309ff9d, 0x0a00ae27, 0x7d079eb1,
-    0xf00f9344, 0x8708a3d2, 0x1e01f268, 0x6906c2fe, 0xf762575d, 0x806567cb, 0x196c3671, 0x6e6b06e7,
-    0xfed41b76, 0x89d32be0, 0x10da7a5a, 0x67dd4acc, 0xf9b9df6f, 0x8ebeeff9, 0x17b7be43, 0x60b08ed5,
-    0xd6d6a3e8, 0xa1d1937e, 0x38d8c2c4, 0x4fdff252, 0xd1bb67f1, 0xa6bc5767, 0x3fb506dd, 0x48b2364b,
-    0xd80d2bda, 0xaf0a1b4c, 0x36034af6, 0x41047a60, 0xdf60efc3, 0xa867df55, 0x316e8eef, 0x4669be79,
-    0xcb61b38c, 0xbc66831a, 0x256fd2a0, 0x5268e236, 0xcc0c7795, 0xbb0b4703, 0x220216b9, 0x5505262f,
-    0xc5ba3bbe, 0xb2bd0b28, 0x2bb45a92, 0x5cb36a04, 0xc2d7ffa7, 0xb5d0cf31, 0x2cd99e8b, 0x5bdeae1d,
-    0x9b64c2b0, 0xec63f226, 0x756aa39c, 0x026d930a, 0x9c0906a9, 0xeb0e363f, 0x72076785, 0x05005713,
-    0x95bf4a82, 0xe2b87a14, 0x7bb12bae, 0x0cb61b38, 0x92d28e9b, 0xe5d5be0d, 0x7cdcefb7, 0x0bdbdf21,
-    0x86d3d2d4, 0xf1d4e242, 0x68ddb3f8, 0x1fda836e, 0x81be16cd, 0xf6b9265b, 0x6fb077e1, 0x18b74777,
-    0x88085ae6, 0xff0f6a70, 0x66063bca, 0x11010b5c, 0x8f659eff, 0xf862ae69, 0x616bffd3, 0x166ccf45,
-    0xa00ae278, 0xd70dd2ee, 0x4e048354, 0x3903b3c2, 0xa7672661, 0xd06016f7, 0x4969474d, 0x3e6e77db,
-    0xaed16a4a, 0xd9d65adc, 0x40df0b66, 0x37d83bf0, 0xa9bcae53, 0xdebb9ec5, 0x47b2cf7f, 0x30b5ffe9,
-    0xbdbdf21c, 0xcabac28a, 0x53b39330, 0x24b4a3a6, 0xbad03605, 0xcdd70693, 0x54de5729, 0x23d967bf,
-    0xb3667a2e, 0xc4614ab8, 0x5d681b02, 0x2a6f2b94, 0xb40bbe37, 0xc30c8ea1, 0x5a05df1b, 0x2d02ef8d])
-
-
+# CRC equivalent to crc_crc32() in AP_Math/crc.cpp. That is the
+# standard reflected CRC-32 table but without the initial and final
+# inversion, so the zlib implementation is used with the inversion undone
 def crc32(bytes, state=0):
     '''crc32 exposed for use by chibios.py'''
-    for byte in bytes:
-        index = (state ^ byte) & 0xff
-        state = crctab[index] ^ (state >> 8)
+    return zlib.crc32(bytes, state ^ 0xffffffff) ^ 0xffffffff
+
+
+def crc32_padding(state, length, pad=b'\xff'):
+    '''continue a crc32 over length bytes of pad, as the bootloader does for
+    the erased flash after the image'''
+    block = pad * min(length, 65536)
+    while length > 0:
+        n = min(length, len(block))
+        state = crc32(block[:n], state)
+        length -= n
     return state
 
 
+def decode_image(encoded):
+    '''decode a base64 encoded, zlib compressed image in chunks, so only the
+    decompressed image is held in memory rather than several copies of it'''
+    if any(c in encoded for c in ' \t\r\n'):
+        encoded = ''.join(encoded.split())
+    decompressor = zlib.decompressobj()
+    image = bytearray()
+    chunk = 65536   # must be a multiple of 4 base64 characters
+    for i in range(0, len(encoded), chunk):
+        image += decompressor.decompress(base64.b64decode(encoded[i:i+chunk]))
+    image += decompressor.flush()
+    return image
+
+
 class firmware(object):
     '''Loads a firmware file'''
 
     desc = {}
     image = bytes()
-    crcpad = bytearray(b'\xff\xff\xff\xff')
 
     def __init__(self, path):
 
@@ -166,9 +154,10 @@ class firmware(object):
         self.desc = json.load(f)
         f.close()
 
-        self.image = bytearray(zlib.decompress(base64.b64decode(self.desc['image'])))
+        # the encoded images are dropped from desc once decoded
+        self.image = decode_image(self.desc.pop('image'))
         if 'extf_image' in self.desc:
-            self.extf_image = bytearray(zlib.decompress(base64.b64decode(self.desc['extf_image'])))
+            self.extf_image = decode_image(self.desc.pop('extf_image'))
         else:
             self.extf_image = None
         # pad image to 4-byte length
@@ -185,14 +174,14 @@ class firmware(object):
         return default
 
     def extf_crc(self, size):
-        state = crc32(self.extf_image[:size], int(0))
+        state = crc32(memoryview(self.extf_image)[:size], int(0))
         return state
 
     def crc(self, padlen):
         state = crc32(self.image, int(0))
-        for i in range(len(self.image), (padlen - 1), 4):
-            state = crc32(self.crcpad, state)
-        return state
+        # the bootloader pads in 4 byte words up to padlen
+        padwords = len(range(len(self.image), (padlen - 1), 4))
+        return crc32_padding(state, padwords * 4)
 
 
 class uploader(object):
@@ -259,7 +248,8 @@ class uploader(object):
                  source_system=None,
                  source_component=None,
                  no_extf=False,
-                 force_erase=False):
+                 force_erase=False,
+                 pipeline_window=0):
         self.MAVLINK_REBOOT_ID1 = bytearray(b'\xfe\x21\x72\xff\x00\x4c\x00\x00\x40\x40\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xf6\x00\x01\x00\x00\x53\x6b')  # NOQA
         self.MAVLINK_REBOOT_ID0 = bytearray(b'\xfe\x21\x45\xff\x00\x4c\x00\x00\x40\x40\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xf6\x00\x00\x00\x00\xcc\x37')  # NOQA
         if target_component is None:
@@ -270,6 +260,10 @@ class uploader(object):
             source_component = 1
         self.no_extf = no_extf
         self.force_erase = force_erase
+        # number of PROG_MULTI commands to keep in flight, 0 or 1 for lock-step
+        self.pipeline_window = pipeline_window
+        # if set, called with (label, percent) instead of drawing a progress bar
+        self.progress_callback = None
 
         # open the port, keep the default timeout short so we can poll quickly
         self.port = serial.Serial(portname, baudrate_bootloader, timeout=2.0, write_timeout=2.0)
@@ -440,6 +434,10 @@ class uploader(object):
 
         percent = (float(progress) / float(maxVal)) * 100.0
 
+        if self.progress_callback is not None:
+            self.progress_callback(label, percent)
+            return
+
         sys.stdout.write("\r%s: [%-20s] %.1f%%" % (label, '='*int(percent/5.0), percent))
         sys.stdout.flush()
 
@@ -488,6 +486,16 @@ class uploader(object):
         self.__send(uploader.EOC)
         self.__getSync()
 
+    # send a PROG_MULTI command without waiting for the reply
+    def __program_multi_nosync(self, data):
+
+        if runningPython3:
+            length = len(data).to_bytes(1, byteorder='big')
+        else:
+            length = chr(len(data))
+
+        self.__send(uploader.PROG_MULTI + length + bytes(data) + uploader.EOC)
+
     # send a PROG_EXTF_MULTI command to write a collection of bytes to external flash
     def __program_multi_extf(self, data):
 
@@ -548,9 +556,11 @@ class uploader(object):
         if self.bl_rev >= 3:
             self.__getSync()
 
-    # split a sequence into a list of size-constrained pieces
+    # split a sequence into a list of size-constrained pieces, as views
+    # onto the sequence rather than copies
     def __split_len(self, seq, length):
-        return [seq[i:i+length] for i in range(0, len(seq), length)]
+        view = memoryview(seq)
+        return [view[i:i+length] for i in range(0, len(seq), length)]
 
     # upload code
     def __program(self, label, fw):
@@ -558,6 +568,7 @@ class uploader(object):
         code = fw.image
         groups = self.__split_len(code, uploader.PROG_MULTI_MAX)
 
+        start = time.time()
         uploadProgress = 0
         for bytes in groups:
             self.__program_multi(bytes)
@@ -567,6 +578,69 @@ class uploader(object):
             if uploadProgress % 256 == 0:
                 self.__drawProgressBar(label, uploadProgress, len(groups))
         self.__drawProgressBar(label, 100, 100)
+        self.__report_throughput(len(code), time.time() - start)
+
+    # upload code keeping up to pipeline_window PROG_MULTI commands in
+    # flight, checking the sync replies as they come back. The
+    # bootloader handles commands strictly in order, so the n'th reply
+    # is for the n'th command. This relies on the link having flow
+    # control (as USB-CDC does) so the bootloader's receive buffer
+    # can't overflow while it is writing to flash
+    def __program_pipelined(self, label, fw):
+        print("\n", end='')
+        code = fw.image
+        groups = self.__split_len(code, uploader.PROG_MULTI_MAX)
+        window = self.pipeline_window
+
+        start = time.time()
+        sent = 0
+        acked = 0
+        while acked < len(groups):
+            while sent < len(groups) and sent - acked < window:
+                self.__program_multi_nosync(groups[sent])
+                sent += 1
+            try:
+                self.__getSync()
+            except RuntimeError as ex:
+                raise RuntimeError("chunk %u of %u: %s" % (acked, len(groups), str(ex)))
+            acked += 1
+            if acked % 256 == 0:
+                self.__drawProgressBar(label, acked, len(groups))
+        self.__drawProgressBar(label, 100, 100)
+        self.__report_throughput(len(code), time.time() - start)
+
+    # discard replies to commands which were in flight when an error happened
+    def __drain(self, quiet_time=0.2):
+        timeout = self.port.timeout
+        self.port.timeout = quiet_time
+        try:
+            while len(self.port.read(1024)) > 0:
+                pass
+        finally:
+            self.port.timeout = timeout
+
+    # erase and program the flash, pipelining if enabled. Once a
+    # pipelined write has failed we can't tell which of the commands in
+    # flight were written, so the flash is erased and programmed again
+    # in lock-step
+    def __erase_and_program(self, fw):
+        self.__erase("Erase  ")
+        if self.pipeline_window <= 1:
+            self.__program("Program", fw)
+            return
+        try:
+            self.__program_pipelined("Program", fw)
+        except RuntimeError as ex:
+            print("\nPipelined programming failed (%s), retrying in lock-step" % str(ex))
+            self.__drain()
+            self.__sync()
+            self.__erase("Erase  ")
+            self.__program("Program", fw)
+
+    def __report_throughput(self, nbytes, elapsed):
+        if self.progress_callback is not None or elapsed <= 0:
+            return
+        print(" %u bytes in %.1fs (%.1f kB/s)" % (nbytes, elapsed, nbytes / (1024.0 * elapsed)), end='')
 
     # download code
     def __download(self, label, fw):
@@ -937,8 +1011,7 @@ class uploader(object):
             self.__verify_extf("Verify ExtF ", fw, fw.property('extf_image_size', 0))
 
         if (fw.property('image_size') > 0):
-            self.__erase("Erase  ")
-            self.__program("Program", fw)
+            self.__erase_and_program(fw)
 
             if self.bl_rev == 2:
                 self.__verify_v2("Verify ", fw)
@@ -1081,6 +1154,125 @@ def find_bootloader(up, port):
             return False
 
 
+class MultiFlashResult(object):
+    '''outcome of flashing the board on one port in --multi mode'''
+    def __init__(self, port):
+        self.port = port
+        self.board = ""
+        self.status = "waiting"
+        self.message = ""
+        self.start_time = time.time()
+        self.end_time = None
+        self.last_reported = None
+
+    def elapsed(self):
+        end_time = self.end_time
+        if end_time is None:
+            end_time = time.time()
+        return end_time - self.start_time
+
+
+def multi_flash_port(args, fw, baud_flightstack, result, output_lock):
+    '''find and flash the board on one port; run in a thread per port'''
+    def progress(label, percent):
+        # report each stage in 10% steps so the output stays readable
+        # with many boards flashing at once
+        step = (label.strip(), int(percent / 10))
+        if step == result.last_reported:
+            return
+        result.last_reported = step
+        with output_lock:
+            print("%s: %s %u%%" % (result.port, step[0], step[1] * 10))
+
+    try:
+        up = uploader(result.port,
+                      args.baud_bootloader,
+                      baud_flightstack,
+                      args.baud_bootloader_flash,
+                      args.target_system,
+                      args.target_component,
+                      args.source_system,
+                      args.source_component,
+                      args.no_extf,
+                      args.force_erase,
+                      args.pipeline)
+    except Exception as e:
+        result.status = "no port"
+        result.message = str(e)
+        result.end_time = time.time()
+        return
+    up.progress_callback = progress
+
+    try:
+        if not find_bootloader(up, result.port):
+            result.status = "no bootloader"
+            return
+        result.board = "%s (%u,%u)" % (up.board_name_for_board_id(up.board_type), up.board_type, up.board_rev)
+        result.status = "flashing"
+        if args.identify:
+            up.dump_board_info()
+        elif args.verify_firmware_is:
+            up.verify_firmware_is(fw, boot_delay=args.boot_delay)
+        else:
+            up.upload(fw, force=args.force, boot_delay=args.boot_delay)
+        result.status = "OK"
+    except Exception as ex:
+        result.status = "FAILED"
+        result.message = str(ex)
+    finally:
+        up.close()
+        result.end_time = time.time()
+        with output_lock:
+            print("%s: %s %s" % (result.port, result.status, result.message))
+
+
+def print_multi_summary(results):
+    '''print a table of per-port results from flash_multi()'''
+    print("")
+    print("%-50s %-28s %-14s %8s  %s" % ("Port", "Board", "Result", "Time", "Message"))
+    for port in sorted(results.keys()):
+        r = results[port]
+        print("%-50s %-28s %-14s %7.1fs  %s" % (r.port, r.board, r.status, r.elapsed(), r.message))
+    statuses = [r.status for r in results.values()]
+    print("%u flashed OK, %u failed, %u ports without a bootloader" %
+          (statuses.count("OK"), statuses.count("FAILED"),
+           len(statuses) - statuses.count("OK") - statuses.count("FAILED")))
+
+
+def flash_multi(args, fw, baud_flightstack):
+    '''
+    flash every board found on the ports given by --port concurrently,
+    using a thread per port. Ports are rescanned until no new port has
+    appeared for --multi-wait seconds and all threads have finished, so
+    boards which re-enumerate under a new name when rebooted into their
+    bootloader are picked up. Each port name is only tried once.
+    Returns True if at least one board was flashed and none failed
+    '''
+    results = {}
+    threads = []
+    output_lock = threading.Lock()
+    last_new_port = time.time()
+    while True:
+        for port in ports_to_try(args):
+            if port in results:
+                continue
+            result = MultiFlashResult(port)
+            results[port] = result
+            t = threading.Thread(target=multi_flash_port,
+                                 args=(args, fw, baud_flightstack, result, output_lock))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+            last_new_port = time.time()
+        busy = any([t.is_alive() for t in threads])
+        if not busy and time.time() - last_new_port > args.multi_wait:
+            break
+        time.sleep(0.5)
+    print_multi_summary(results)
+    statuses = [r.status for r in results.values()]
+    return "OK" in statuses and "FAILED" not in statuses
+
+
 def main():
 
     # Parse commandline arguments
@@ -1137,6 +1329,13 @@ def main():
     parser.add_argument('--erase-extflash', type=lambda x: int(x, 0), default=None,
                         help="Erase sectors containing specified amount of bytes from ext flash")
     parser.add_argument('--force-erase', action="store_true", help="Do not check for pre cleared flash, always erase the chip")
+    parser.add_argument('--pipeline', type=int, default=0,
+                        help="Keep this many program commands in flight rather than waiting for each reply. "
+                        "Only use on USB links")
+    parser.add_argument('--multi', action="store_true",
+                        help="Flash all boards found on the ports given by --port (or the default ports) concurrently")
+    parser.add_argument('--multi-wait', type=float, default=5.0,
+                        help="In --multi mode, stop once no new port has appeared for this many seconds")
     parser.add_argument('firmware', nargs="?", action="store", default=None, help="Firmware file to be uploaded")
     args = parser.parse_args()
 
@@ -1156,6 +1355,19 @@ def main():
 
     baud_flightstack = [int(x) for x in args.baud_flightstack.split(',')]
 
+    if args.multi:
+        if args.download or args.erase_extflash:
+            parser.error("--multi can not be used with --download or --erase-extflash")
+        if args.identify:
+            fw = None
+        try:
+            if not flash_multi(args, fw, baud_flightstack):
+                sys.exit(1)
+        except KeyboardInterrupt:
+            print("\n Upload aborted by user.")
+            sys.exit(1)
+        sys.exit(0)
+
     # Spin waiting for a device to show up
     try:
         while True:
@@ -1175,7 +1387,8 @@ def main():
                                   args.source_system,
                                   args.source_component,
                                   args.no_extf,
-                                  args.force_erase)
+                                  args.force_erase,
+                                  args.pipeline)
 
                 except Exception as e:
                     if not is_WSL and not is_WSL2 and "win32" not in _platform:
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+'''
+Simulate one or more ArduPilot bootloaders on pseudo-terminals, for
+testing uploader.py without hardware.
+
+Each simulated board implements the subset of the protocol in
+Tools/AP_Bootloader/bl_protocol.cpp that uploader.py uses.  Replies can
+be delayed to approximate the turnaround of a USB-CDC link, which is
+what makes lock-step programming slow on real boards:
+
+    ./Tools/scripts/uploader_sim.py --count 4 --link /tmp/fakebl --latency 0.001 &
+    ./Tools/scripts/uploader.py --port '/tmp/fakebl*' --multi build/fmuv3/bin/arducopter.apj
+
+--selftest flashes a random image with lock-step and pipelined
+programming, checks the simulated flash contents afterwards, and
+reports the throughput of each.  It also checks that a pipelined
+upload falls back to lock-step when the bootloader rejects a write.
+
+AP_FLAKE8_CLEAN
+'''
+
+import argparse
+import base64
+import collections
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import tempfile
+import tty
+import zlib
+
+# protocol bytes, see uploader.uploader
+INSYNC = 0x12
+EOC = 0x20
+OK = 0x10
+FAILED = 0x11
+INVALID = 0x13
+
+GET_SYNC = 0x21
+GET_DEVICE = 0x22
+CHIP_ERASE = 0x23
+PROG_MULTI = 0x27
+READ_MULTI = 0x28
+GET_CRC = 0x29
+GET_OTP = 0x2a
+GET_SN = 0x2b
+GET_CHIP = 0x2c
+SET_BOOT_DELAY = 0x2d
+GET_CHIP_DES = 0x2e
+REBOOT = 0x30
+SET_BAUD = 0x33
+CHIP_FULL_ERASE = 0x40
+
+INFO_BL_REV = 1
+INFO_BOARD_ID = 2
+INFO_BOARD_REV = 3
+INFO_FLASH_SIZE = 4
+INFO_EXTF_SIZE = 6
+
+PROG_MULTI_MAX = 256
+
+
+class Timeout(Exception):
+    pass
+
+
+class SimBootloader(object):
+    '''a simulated bootloader attached to the master side of a pty'''
+    def __init__(self,
+                 board_id=9,
+                 board_rev=0,
+                 flash_size=2*1024*1024 - 16*1024,
+                 bl_rev=5,
+                 latency=0.0,
+                 fail_after=None):
+        self.board_id = board_id
+        self.board_rev = board_rev
+        self.flash_size = flash_size
+        self.bl_rev = bl_rev
+        self.latency = latency
+        # reply INVALID to this many PROG_MULTI commands, then work normally
+        self.fail_after = fail_after
+        self.flash = bytearray(b'\xff' * flash_size)
+        self.address = 0
+        self.done_sync = False
+        self.prog_count = 0
+        self.erase_count = 0
+        self.rebooted = False
+        (self.master, slave) = os.openpty()
+        tty.setraw(slave)
+        self.slave = slave
+        self.portname = os.ttyname(slave)
+        self.inbuf = bytearray()
+        # replies waiting for the link latency to pass, as (due time, data)
+        self.outqueue = collections.deque()
+        self.outqueue_cond = threading.Condition()
+        self.threads = []
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for target in (self.run, self.run_output):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.running = False
+        with self.outqueue_cond:
+            self.outqueue_cond.notify()
+        for t in self.threads:
+            t.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def cin(self, timeout):
+        '''read one byte, raising Timeout if none arrives in time'''
+        if len(self.inbuf) == 0:
+            (r, w, x) = select.select([self.master], [], [], timeout)
+            if not r:
+                raise Timeout()
+            b = os.read(self.master, 4096)
+            if len(b) == 0:
+                raise Timeout()
+            self.inbuf += b
+        c = self.inbuf[0]
+        del self.inbuf[0]
+        return c
+
+    def cin_bytes(self, n, timeout=1.0):
+        return bytes([self.cin(timeout) for i in range(n)])
+
+    def expect_eoc(self):
+        return self.cin(0.5) == EOC
+
+    def reply(self, status, data=b''):
+        '''queue a reply to be sent once the link latency has passed. The
+        bootloader carries on handling commands meanwhile, as a real one
+        does while its replies are in transit'''
+        with self.outqueue_cond:
+            self.outqueue.append((time.time() + self.latency, data + bytes([INSYNC, status])))
+            self.outqueue_cond.notify()
+
+    def run_output(self):
+        '''send queued replies when they are due'''
+        while self.running:
+            with self.outqueue_cond:
+                if len(self.outqueue) == 0:
+                    self.outqueue_cond.wait(0.1)
+                    continue
+                (due, data) = self.outqueue[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self.outqueue_cond.wait(delay)
+                    continue
+                self.outqueue.popleft()
+            os.write(self.master, data)
+
+    def crc(self):
+        '''crc32 as calculated by crc_crc32() over the whole flash'''
+        return zlib.crc32(self.flash, 0xffffffff) ^ 0xffffffff
+
+    def handle(self, c):
+        '''handle one command byte; returns None if it should be ignored'''
+        if c == GET_SYNC:
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            self.done_sync = True
+            return self.reply(OK)
+        if c == GET_DEVICE:
+            arg = self.cin(1.0)
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            values = {
+                INFO_BL_REV: self.bl_rev,
+                INFO_BOARD_ID: self.board_id,
+                INFO_BOARD_REV: self.board_rev,
+                INFO_FLASH_SIZE: self.flash_size,
+                INFO_EXTF_SIZE: 0,
+            }
+            if arg not in values:
+                return self.reply(INVALID)
+            return self.reply(OK, struct.pack("<I", values[arg]))
+        if c in (CHIP_ERASE, CHIP_FULL_ERASE):
+            if not self.expect_eoc() or not self.done_sync:
+                return self.reply(INVALID)
+            self.flash[:] = b'\xff' * self.flash_size
+            self.address = 0
+            self.erase_count += 1
+            return self.reply(OK)
+        if c == PROG_MULTI:
+            n = self.cin(0.05)
+            data = self.cin_bytes(n)
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            self.prog_count += 1
+            if n % 4 != 0 or n > PROG_MULTI_MAX or self.address + n > self.flash_size:
+                return self.reply(INVALID)
+            if self.fail_after is not None and self.prog_count > self.fail_after:
+                self.fail_after = None
+                return self.reply(INVALID)
+            self.flash[self.address:self.address+n] = data
+            self.address += n
+            return self.reply(OK)
+        if c == READ_MULTI:
+            n = self.cin(0.05)
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            data = bytes(self.flash[self.address:self.address+n])
+            self.address += n
+            return self.reply(OK, data)
+        if c == GET_CRC:
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            return self.reply(OK, struct.pack("<I", self.crc()))
+        if c in (GET_OTP, GET_SN):
+            self.cin_bytes(4)
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            return self.reply(OK, b'\x00' * 4)
+        if c == GET_CHIP:
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            return self.reply(OK, struct.pack("<I", 0x10016450))
+        if c == GET_CHIP_DES:
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            des = b"STM32H7[4|5]x,V"
+            return self.reply(OK, struct.pack("<I", len(des)) + des)
+        if c == SET_BOOT_DELAY:
+            self.cin(0.1)
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            return self.reply(OK)
+        if c == SET_BAUD:
+            self.cin_bytes(4)
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            return self.reply(OK)
+        if c == REBOOT:
+            if not self.expect_eoc():
+                return self.reply(INVALID)
+            self.rebooted = True
+            return self.reply(OK)
+        # unknown bytes are ignored, as on a real bootloader
+        return None
+
+    def run(self):
+        while self.running:
+            try:
+                c = self.cin(0.1)
+            except Timeout:
+                continue
+            except OSError:
+                # nothing has the slave side open
+                time.sleep(0.01)
+                continue
+            try:
+                self.handle(c)
+            except Timeout:
+                self.reply(INVALID)
+
+
+def selftest(args):
+    '''flash a random image using uploader.py and check the result'''
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    import uploader
+
+    image = os.urandom(args.image_size)
+    apj = tempfile.NamedTemporaryFile(mode='w', suffix='.apj', delete=False)
+    json.dump({
+        'board_id': args.board_id,
+        'board_revision': 0,
+        'image_size': len(image),
+        'image': base64.b64encode(zlib.compress(image, 9)).decode('ascii'),
+    }, apj)
+    apj.close()
+    fw = uploader.firmware(apj.name)
+    os.unlink(apj.name)
+
+    tests = [
+        ("lock-step", 0, None),
+        ("pipelined", args.window, None),
+        ("pipelined, failing", args.window, 100),
+    ]
+    times = {}
+    ok = True
+    for (name, window, fail_after) in tests:
+        sim = SimBootloader(board_id=args.board_id,
+                            flash_size=args.flash_size,
+                            latency=args.latency,
+                            fail_after=fail_after)
+        sim.start()
+        up = uploader.uploader(sim.portname, 115200, [57600], pipeline_window=window)
+        up.identify()
+        start = time.time()
+        up.upload(fw)
+        times[name] = time.time() - start
+        up.close()
+        sim.stop()
+        expected = bytearray(fw.image) + b'\xff' * (args.flash_size - len(fw.image))
+        if sim.flash != expected:
+            print("%s: flash contents do not match" % name)
+            ok = False
+        if fail_after is not None and sim.erase_count != 2:
+            print("%s: expected a second erase for the lock-step retry" % name)
+            ok = False
+
+    print("")
+    for (name, window, fail_after) in tests:
+        print("%-20s %6.2fs %8.1f kB/s" % (name, times[name], len(image) / (1024.0 * times[name])))
+    print("pipelining with window %u is %.1fx faster" % (args.window, times["lock-step"] / times["pipelined"]))
+    if not ok:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="simulate ArduPilot bootloaders on pseudo-terminals")
+    parser.add_argument("--count", type=int, default=1, help="number of boards to simulate")
+    parser.add_argument("--board-id", type=int, default=9, help="board ID to report")
+    parser.add_argument("--flash-size", type=int, default=2*1024*1024 - 16*1024, help="flash size to report")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay before each reply in seconds")
+    parser.add_argument("--link", default=None, help="create symlinks to the ptys named with this prefix")
+    parser.add_argument("--selftest", action="store_true", help="test lock-step and pipelined uploads and exit")
+    parser.add_argument("--image-size", type=int, default=512*1024, help="image size for --selftest")
+    parser.add_argument("--window", type=int, default=4, help="pipeline window for --selftest")
+    args = parser.parse_args()
+
+    if args.selftest:
+        selftest(args)
+        return
+
+    boards = []
+    for i in range(args.count):
+        sim = SimBootloader(board_id=args.board_id,
+                            flash_size=args.flash_size,
+                            latency=args.latency)
+        sim.start()
+        boards.append(sim)
+        name = sim.portname
+        if args.link is not None:
+            name = "%s%u" % (args.link, i)
+            if os.path.lexists(name):
+                os.unlink(name)
+            os.symlink(sim.portname, name)
+        print("board %u on %s" % (i, name))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link is not None:
+            for i in range(args.count):
+                name = "%s%u" % (args.link, i)
+                if os.path.islink(name):
+                    os.unlink(name)
+
+
+if __name__ == '__main__':
+    main()
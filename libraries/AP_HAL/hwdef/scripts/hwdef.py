@@ -5,6 +5,7 @@ AP_FLAKE8_CLEAN
 '''
 
 import filecmp
+import functools
 import os
 import pickle
 import re
@@ -12,6 +13,42 @@ import shlex
 import sys
 
 
+@functools.lru_cache(maxsize=None)
+def _split_line(line, posix):
+    return tuple(shlex.split(line, posix=posix))
+
+
+def split_line(line, posix=True):
+    '''as shlex.split(), but remembering the result.  Boards share most
+    of their lines through common include files, so this saves
+    splitting them again when many boards are processed in one process'''
+    return list(_split_line(line, posix))
+
+
+# filepath => ((mtime, size), lines)
+_hwdef_lines = {}
+
+
+def read_hwdef_lines(filename):
+    '''return the lines of a hwdef file which aren't empty or comments,
+    with comments stripped.  Results are cached until the file changes'''
+    st = os.stat(filename)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _hwdef_lines.get(filename)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    lines = []
+    with open(filename, "r") as f:
+        for line in f.readlines():
+            line = line.split('#')[0] # ensure we discard the comments
+            line = line.strip()
+            if len(line) == 0 or line[0] == '#':
+                continue
+            lines.append(line)
+    _hwdef_lines[filename] = (stamp, lines)
+    return lines
+
+
 class IncludeNotFoundException(Exception):
     def __init__(self, hwdef, includer):
         self.hwdef = hwdef
@@ -155,15 +192,11 @@ class HWDef:
     def process_file(self, filename, depth=0):
         '''process a hwdef.dat file'''
         try:
-            f = open(filename, "r")
+            lines = read_hwdef_lines(filename)
         except Exception:
             self.error("Unable to open file %s" % filename)
-        for line in f.readlines():
-            line = line.split('#')[0] # ensure we discard the comments
-            line = line.strip()
-            if len(line) == 0 or line[0] == '#':
-                continue
-            a = shlex.split(line)
+        for line in lines:
+            a = split_line(line)
             if a[0] == "include" and len(a) > 1:
                 include_file = a[1]
                 if include_file[0] != '/':
@@ -189,7 +222,7 @@ class HWDef:
 
     def process_line(self, line, depth):
         '''process one line of pin definition file'''
-        a = shlex.split(line, posix=False)
+        a = split_line(line, posix=False)
 
         if a[0] == 'undef':
             return self.process_line_undef(line, depth, a)
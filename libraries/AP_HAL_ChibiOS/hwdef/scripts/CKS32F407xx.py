@@ -4,10 +4,13 @@
 CKS32F407 is based on STM32F407
 '''
 
+import copy
 import STM32F407xx as ST
 
-build = ST.build
-mcu = ST.mcu
+# copy what we change so boards using STM32F407xx processed in the
+# same process (chibios_hwdef.py --batch) are not affected
+build = copy.deepcopy(ST.build)
+mcu = copy.deepcopy(ST.mcu)
 DMA_Map = ST.DMA_Map
 AltFunction_map = ST.AltFunction_map
 ADC1_map = ST.ADC1_map
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+'''
+indexed alternate function and ADC tables for the MCU modules
+
+The MCU modules (STM32H743xx.py etc) hold their alternate functions
+as a dictionary keyed on "PIN:FUNCTION" strings, which can only be
+searched one way. get_index() builds an index of an MCU module the
+first time it is asked for, keyed on (port, pin, function), and the
+reverse maps on first use:
+
+    index = af_index.get_index("STM32H743xx")
+    index.alt_function("PB10", "USART3_TX")    # 7
+    index.pins_with_function("USART3_TX")      # ['PB10', 'PC10', 'PD8']
+    index.functions_of_pin("PB10")             # {'I2C2_SCL': 4, ...}
+
+It can also be run to find which pins can carry a function, or what a
+pin can do:
+
+    ./af_index.py STM32H743xx USART3_TX 'SPI2_*'
+    ./af_index.py STM32F405xx PB10
+
+AP_FLAKE8_CLEAN
+'''
+
+import fnmatch
+import importlib
+import re
+import sys
+
+re_portpin = re.compile(r'^P([A-K])(\d+)$')
+
+
+def split_portpin(portpin):
+    '''split a pin name like PB10 into port and pin number'''
+    m = re_portpin.match(portpin)
+    if m is None:
+        raise ValueError("Bad pin name %s" % portpin)
+    return (m.group(1), int(m.group(2)))
+
+
+def pin_sort_key(portpin):
+    return split_portpin(portpin)
+
+
+class AltFunctionIndex(object):
+    '''index of the alternate functions and ADC channels of one MCU'''
+
+    def __init__(self, lib):
+        self.has_alt_functions = hasattr(lib, "AltFunction_map")
+        # (port, pin, function) => alternate function number
+        self.alt_functions = {}
+        for (key, af) in getattr(lib, "AltFunction_map", {}).items():
+            # keys are like "PB10:USART3_TX"
+            (portpin, function) = key.split(":", 1)
+            self.alt_functions[(portpin[1], int(portpin[2:]), function)] = af
+        # ADC number => pin name => channel
+        self.adc_maps = {}
+        for adc in (1, 2, 3):
+            adc_map = getattr(lib, "ADC%u_map" % adc, None)
+            if adc_map is not None:
+                self.adc_maps[adc] = adc_map
+        # reverse maps, built when first needed
+        self._by_pin = None
+        self._by_function = None
+
+    def alt_function(self, portpin, function):
+        '''return the alternate function number for function on a pin, or
+        None if the pin can't carry it'''
+        (port, pin) = split_portpin(portpin)
+        return self.alt_functions.get((port, pin, function))
+
+    def adc_channel(self, adc, portpin):
+        '''return the channel of ADC adc on a pin, or None if it has none.
+        Raises KeyError if the MCU has no table for that ADC'''
+        return self.adc_maps[adc].get(portpin)
+
+    def build_reverse_maps(self):
+        by_pin = {}
+        by_function = {}
+        for ((port, pin, function), af) in self.alt_functions.items():
+            portpin = "P%s%u" % (port, pin)
+            by_pin.setdefault(portpin, {})[function] = af
+            by_function.setdefault(function, []).append(portpin)
+        for function in by_function.keys():
+            by_function[function].sort(key=pin_sort_key)
+        self._by_pin = by_pin
+        self._by_function = by_function
+
+    def functions_of_pin(self, portpin):
+        '''return a dictionary of function => alternate function number
+        for a pin'''
+        if self._by_pin is None:
+            self.build_reverse_maps()
+        return self._by_pin.get(portpin, {})
+
+    def pins_with_function(self, function):
+        '''return the pins which can carry function, in port and pin order'''
+        if self._by_function is None:
+            self.build_reverse_maps()
+        return self._by_function.get(function, [])
+
+    def functions(self):
+        '''return all the functions of the MCU, sorted'''
+        if self._by_function is None:
+            self.build_reverse_maps()
+        return sorted(self._by_function.keys())
+
+
+# MCU module name => AltFunctionIndex
+_indexes = {}
+
+
+def get_index(mcu):
+    '''return the AltFunctionIndex for an MCU module, building it on first
+    use. Raises ImportError if there is no module for the MCU'''
+    index = _indexes.get(mcu)
+    if index is None:
+        index = AltFunctionIndex(importlib.import_module(mcu))
+        _indexes[mcu] = index
+    return index
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='show which pins can carry functions, or the functions of pins')
+    parser.add_argument('mcu', help='MCU type, e.g. STM32H743xx')
+    parser.add_argument('patterns', nargs='+', metavar='PIN_OR_FUNCTION',
+                        help='pin name (e.g. PB10) or function (wildcards allowed, e.g. USART*_TX)')
+    args = parser.parse_args()
+
+    try:
+        index = get_index(args.mcu)
+    except ImportError:
+        print("Unable to find module for MCU %s" % args.mcu)
+        sys.exit(1)
+    if not index.has_alt_functions:
+        print("%s has no alternate function table" % args.mcu)
+        sys.exit(1)
+
+    for pattern in args.patterns:
+        if re_portpin.match(pattern):
+            functions = index.functions_of_pin(pattern)
+            for function in sorted(functions.keys()):
+                print("%-5s %-20s AF%u" % (pattern, function, functions[function]))
+            continue
+        matched = fnmatch.filter(index.functions(), pattern)
+        if len(matched) == 0:
+            print("No function matching %s" % pattern)
+        for function in matched:
+            for portpin in index.pins_with_function(function):
+                print("%-20s %-5s AF%u" % (function, portpin, index.alt_function(portpin, function)))
@@ -6,12 +6,16 @@ AP_FLAKE8_CLEAN
 
 '''
 
+import af_index
 import argparse
+import contextlib
+import functools
+import io
+import multiprocessing
 import sys
 import fnmatch
 import os
 import dma_resolver
-import shlex
 import re
 import shutil
 
@@ -147,17 +151,22 @@ class ChibiOSHWDef(hwdef.HWDef):
             # default DMA off on I2C for H7, we're much better off reducing DMA sharing
             self.dma_exclude_pattern = ['I2C*']
 
+    def get_af_index(self, mcu):
+        '''get alternate function and ADC index for the chosen MCU'''
+        try:
+            return af_index.get_index(mcu)
+        except ImportError:
+            self.error("Unable to find module for MCU %s" % mcu)
+
     def get_alt_function(self, mcu, pin, function):
         '''return alternative function number for a pin'''
-        lib = self.get_mcu_lib(mcu)
+        index = self.get_af_index(mcu)
 
         if function.endswith('_TXINV') or function.endswith('_RXINV'):
             # RXINV and TXINV are special labels for inversion pins, not alt-functions
             return None
 
-        if hasattr(lib, "AltFunction_map"):
-            alt_map = lib.AltFunction_map
-        else:
+        if not index.has_alt_functions:
             # just check if Alt Func is available or not
             for label in self.af_labels:
                 if function.startswith(label):
@@ -171,10 +180,10 @@ class ChibiOSHWDef(hwdef.HWDef):
 
         for label in self.af_labels:
             if function.startswith(label):
-                s = pin + ":" + function
-                if s not in alt_map:
-                    self.error("Unknown pin function %s for MCU %s" % (s, mcu))
-                return alt_map[s]
+                af = index.alt_function(pin, function)
+                if af is None:
+                    self.error("Unknown pin function %s:%s for MCU %s" % (pin, function, mcu))
+                return af
         return None
 
     def have_type_prefix(self, ptype):
@@ -184,44 +193,28 @@ class ChibiOSHWDef(hwdef.HWDef):
                 return True
         return False
 
-    def get_ADC1_chan(self, mcu, pin):
-        '''return ADC1 channel for an analog pin'''
-        import importlib
+    def get_ADC_chan(self, adc, mcu, pin):
+        '''return ADC channel for an analog pin'''
         try:
-            lib = importlib.import_module(mcu)
-            ADC1_map = lib.ADC1_map
-        except ImportError:
-            self.error("Unable to find ADC1_Map for MCU %s" % mcu)
+            chan = self.get_af_index(mcu).adc_channel(adc, pin)
+        except KeyError:
+            self.error("Unable to find ADC%u_Map for MCU %s" % (adc, mcu))
+
+        if chan is None:
+            self.error("Unable to find ADC%u channel for pin %s" % (adc, pin))
+        return chan
 
-        if pin not in ADC1_map:
-            self.error("Unable to find ADC1 channel for pin %s" % pin)
-        return ADC1_map[pin]
+    def get_ADC1_chan(self, mcu, pin):
+        '''return ADC1 channel for an analog pin'''
+        return self.get_ADC_chan(1, mcu, pin)
 
     def get_ADC2_chan(self, mcu, pin):
         '''return ADC2 channel for an analog pin'''
-        import importlib
-        try:
-            lib = importlib.import_module(mcu)
-            ADC2_map = lib.ADC2_map
-        except ImportError:
-            self.error("Unable to find ADC2_Map for MCU %s" % mcu)
-
-        if pin not in ADC2_map:
-            self.error("Unable to find ADC2 channel for pin %s" % pin)
-        return ADC2_map[pin]
+        return self.get_ADC_chan(2, mcu, pin)
 
     def get_ADC3_chan(self, mcu, pin):
         '''return ADC3 channel for an analog pin'''
-        import importlib
-        try:
-            lib = importlib.import_module(mcu)
-            ADC3_map = lib.ADC3_map
-        except ImportError:
-            self.error("Unable to find ADC3_Map for MCU %s" % mcu)
-
-        if pin not in ADC3_map:
-            self.error("Unable to find ADC3 channel for pin %s" % pin)
-        return ADC3_map[pin]
+        return self.get_ADC_chan(3, mcu, pin)
 
     class generic_pin(object):
         '''class to hold pin definition'''
@@ -1121,7 +1114,8 @@ class ChibiOSHWDef(hwdef.HWDef):
     ''')
 
         lib = self.get_mcu_lib(self.mcu_type)
-        build_info = lib.build
+        # copy so we don't change the MCU module for other boards processed in this process
+        build_info = lib.build.copy()
 
         if self.get_mcu_config('CPU_FLAGS') and self.get_mcu_config('CORTEX'):
             # CPU flags specified in mcu file
@@ -1828,18 +1822,18 @@ INCLUDE common.ld
                     # no requirement for the pin to have valid UART
                     # RTS alternative function
                     # If it does this enables hardware flow control for RS-485
-                    lib = self.get_mcu_lib(self.mcu_type)
-                    if (rts_line == "0") or (rts_line_name not in self.bylabel) or not hasattr(lib, "AltFunction_map"):
+                    index = self.get_af_index(self.mcu_type)
+                    if (rts_line == "0") or (rts_line_name not in self.bylabel) or not index.has_alt_functions:
                         # No pin, 0 is a valid alt function, use UINT8_MAX for invalid
                         return "UINT8_MAX"
 
                     pin = self.bylabel[rts_line_name]
                     for label in self.af_labels:
                         if rts_line_name.startswith(label):
-                            s = pin.portpin + ":" + rts_line_name
-                            if s not in lib.AltFunction_map:
+                            af = index.alt_function(pin.portpin, rts_line_name)
+                            if af is None:
                                 return "UINT8_MAX"
-                            return lib.AltFunction_map[s]
+                            return af
                 if have_low_noise:
                     low_noise = 'false'
                     rx_port = dev + '_RX'
@@ -2516,6 +2510,9 @@ Please run: Tools/scripts/build_bootloaders.py %s
                 dma_priority=self.get_config('DMA_PRIORITY', default='TIM* SPI*', spaces=True),
                 dma_noshare=self.dma_noshare,
                 quiet=self.quiet,
+                # the solver can change the DMA map of a board, so it
+                # is only used by boards which have been tested with it
+                use_solver=self.get_config('DMA_SOLVER', default=0, type=int) != 0,
             )
 
         if not self.is_bootloader_fw():
@@ -2716,10 +2713,9 @@ Please run: Tools/scripts/build_bootloaders.py %s
     def write_processed_defaults_file(self, filepath):
         # see if board has a defaults.parm file or a --default-parameters file was specified
         defaults_filename = os.path.join(os.path.dirname(self.hwdef[0]), 'defaults.parm')
-        defaults_path = os.path.join(os.path.dirname(self.hwdef[0]), args.params)
-
         defaults_abspath = None
-        if os.path.exists(defaults_path):
+        if (self.default_params_filepath is not None and
+                os.path.exists(os.path.join(os.path.dirname(self.hwdef[0]), self.default_params_filepath))):
             defaults_abspath = os.path.abspath(self.default_params_filepath)
             self.progress("Default parameters path from command line: %s" % self.default_params_filepath)
         elif os.path.exists(defaults_filename):
@@ -2816,7 +2812,7 @@ Please run: Tools/scripts/build_bootloaders.py %s
     def process_line(self, line, depth):
         '''process one line of pin definition file'''
         self.all_lines.append(line)
-        a = shlex.split(line, posix=False)
+        a = hwdef.split_line(line, posix=False)
         # keep all config lines for later use
         self.alllines.append(line)
 
@@ -2950,29 +2946,6 @@ Please run: Tools/scripts/build_bootloaders.py %s
 
         super(ChibiOSHWDef, self).process_line_env(line, depth, a)
 
-    def process_file(self, filename, depth=0):
-        '''process a hwdef.dat file'''
-        try:
-            f = open(filename, "r")
-        except Exception:
-            self.error("Unable to open file %s" % filename)
-        for line in f.readlines():
-            line = line.split('#')[0] # ensure we discard the comments
-            line = line.strip()
-            if len(line) == 0 or line[0] == '#':
-                continue
-            a = shlex.split(line)
-            if a[0] == "include" and len(a) > 1:
-                include_file = a[1]
-                if include_file[0] != '/':
-                    dir = os.path.dirname(filename)
-                    include_file = os.path.normpath(
-                        os.path.join(dir, include_file))
-                self.progress("Including %s" % include_file)
-                self.process_file(include_file, depth+1)
-            else:
-                self.process_line(line, depth)
-
     def add_apperiph_defaults(self, f):
         '''add default defines for peripherals'''
         if not self.is_periph_fw():
@@ -3138,6 +3111,74 @@ Please run: Tools/scripts/build_bootloaders.py %s
         self.write_env_py(os.path.join(self.outdir, "env.py"))
 
 
+def process_board(task, quiet=True):
+    '''process one board for run_batch()'''
+    (outdir, hwdefs, bootloader, signed_fw, params) = task
+    output = io.StringIO()
+    error = None
+    try:
+        with contextlib.redirect_stdout(output):
+            os.makedirs(outdir, exist_ok=True)
+            c = ChibiOSHWDef(
+                outdir=outdir,
+                bootloader=bootloader,
+                signed_fw=signed_fw,
+                hwdef=hwdefs,
+                default_params_filepath=params,
+                quiet=quiet,
+            )
+            c.run()
+    except SystemExit as ex:
+        # error() has printed the problem
+        error = "exited with status %s" % ex.code
+    except Exception as ex:
+        error = "%s: %s" % (type(ex).__name__, ex)
+    return (task, error, output.getvalue())
+
+
+def run_batch(tasks, jobs=1, quiet=True):
+    '''process many boards in this process, or in a pool of jobs
+    processes.  Each task is a tuple of (outdir, list of hwdef files,
+    bootloader, signed_fw, params).  MCU modules are only imported, and
+    hwdef files only read, once per process however many boards use
+    them.  Yields (task, error, output) for each task in order, where
+    error is None if the board was processed successfully'''
+    process = functools.partial(process_board, quiet=quiet)
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield process(task)
+        return
+    chunksize = max(1, len(tasks) // (jobs * 4))
+    with multiprocessing.Pool(jobs) as pool:
+        for result in pool.imap(process, tasks, chunksize=chunksize):
+            yield result
+
+
+def batch_main(args):
+    '''process each of args.hwdef as a separate board'''
+    tasks = []
+    for filepath in args.hwdef:
+        board = os.path.basename(os.path.dirname(os.path.abspath(filepath)))
+        bootloader = args.bootloader or os.path.basename(filepath) == 'hwdef-bl.dat'
+        if bootloader:
+            board += "-bl"
+        tasks.append((os.path.join(args.outdir, board), [filepath], bootloader, args.signed_fw, args.params))
+
+    failed = []
+    for (task, error, output) in run_batch(tasks, jobs=args.jobs, quiet=args.quiet):
+        if not args.quiet:
+            sys.stdout.write(output)
+        if error is not None:
+            failed.append((task, error, output))
+    for (task, error, output) in failed:
+        if args.quiet:
+            sys.stdout.write(output)
+        print("Failed %s: %s" % (task[1][0], error))
+    print("Processed %u boards, %u failed" % (len(tasks), len(failed)))
+    if len(failed) != 0:
+        sys.exit(1)
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser("chibios_pins.py")
@@ -3153,9 +3194,18 @@ if __name__ == '__main__':
         '--params', type=str, default=None, help='user default params path')
     parser.add_argument(
         '--quiet', action='store_true', default=False, help='quiet running')
+    parser.add_argument(
+        '--batch', action='store_true', default=False,
+        help='process each hwdef file as a separate board, into a subdirectory of the output directory named after the board')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, help='number of processes to use with --batch')
 
     args = parser.parse_args()
 
+    if args.batch:
+        batch_main(args)
+        sys.exit(0)
+
     c = ChibiOSHWDef(
         outdir=args.outdir,
         bootloader=args.bootloader,
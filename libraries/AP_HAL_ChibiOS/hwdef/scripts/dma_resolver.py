@@ -292,14 +292,219 @@ def forbidden_list(p, peripheral_list):
     return ret
 
 
+class DMASolverLimit(Exception):
+    pass
+
+
+class DMASolver(object):
+    '''
+    exact search for an allocation of DMA streams to peripherals
+
+    Peripherals are taken in priority order. Each may get a stream of its
+    own, share a stream with peripherals it is allowed to share with, or
+    go without DMA. The best allocation assigns the most peripherals,
+    then favours higher priority peripherals, then shares the fewest
+    streams. Ties go to the first allocation found, trying streams of
+    its own in dma_map order before shared streams, so the result is
+    deterministic.
+
+    The users of each stream are held as a bitmask of peripherals. The
+    search is cut off wherever the peripherals which could still get a
+    stream can't beat the best allocation found so far. What the
+    remaining peripherals can achieve only depends on whether each
+    stream is in use, whether it holds a peripheral which can't share
+    and which of its users the remaining peripherals may not share
+    with, so scores they were found unable to beat are memoised on that.
+    '''
+    def __init__(self, periphs, dma_map, fixed, noshare_list, priority_list, max_nodes=200000):
+        self.periphs = periphs
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        self.required = [False] * len(periphs)
+        # memo key => score the remaining peripherals can't beat
+        self.failed = {}
+        names = periphs + sorted(fixed.keys())
+        self.bits = {}
+        for i in range(len(names)):
+            self.bits[names[i]] = 1 << i
+        self.priority = [get_list_index(p, priority_list) for p in names]
+        unshareable = 0
+        for p in names:
+            if not can_share(p, noshare_list):
+                unshareable |= self.bits[p]
+        self.noshare_mask = unshareable
+        self.unshareable = unshareable
+        # flags above the peripheral bits for the memo keys
+        self.in_use = 1 << len(names)
+        self.no_share = 1 << (len(names)+1)
+
+        streams = set(fixed.values())
+        for p in periphs:
+            for streamchan in dma_map[p]:
+                streams.add((streamchan[0], streamchan[1]))
+        self.streams = sorted(streams)
+        stream_index = {}
+        for i in range(len(self.streams)):
+            stream_index[self.streams[i]] = i
+
+        # stream choices for each peripheral in dma_map order
+        self.options = []
+        for p in periphs:
+            options = []
+            for streamchan in dma_map[p]:
+                s = stream_index[(streamchan[0], streamchan[1])]
+                if s not in options:
+                    options.append(s)
+            self.options.append(options)
+
+        # peripherals each peripheral may not share with, either way round
+        self.forbidden = []
+        for p in periphs:
+            mask = 0
+            for p2 in names:
+                if not sharing_allowed(p, p2) or not sharing_allowed(p2, p):
+                    mask |= self.bits[p2]
+            self.forbidden.append(mask)
+        # peripherals which matter to the sharing of periphs[i:]
+        self.relevant = [0] * (len(periphs)+1)
+        for i in reversed(range(len(periphs))):
+            self.relevant[i] = self.relevant[i+1] | self.forbidden[i]
+
+        users = [0] * len(self.streams)
+        for p in sorted(fixed.keys()):
+            users[stream_index[fixed[p]]] |= self.bits[p]
+        self.initial_users = tuple(users)
+
+    def sharing_priority(self, users):
+        '''as get_sharing_priority() for a bitmask of peripherals'''
+        highest = len(self.priority)
+        for i in range(len(self.priority)):
+            if users & (1 << i) and self.priority[i] < highest:
+                highest = self.priority[i]
+        return highest
+
+    def memo_key(self, i, users):
+        relevant = self.relevant[i]
+        key = [i]
+        for u in users:
+            k = u & relevant
+            if u:
+                k |= self.in_use
+                if u & self.unshareable:
+                    k |= self.no_share
+            key.append(k)
+        return tuple(key)
+
+    def can_use(self, i, u):
+        '''check if periphs[i] can use a stream with users u'''
+        if u == 0:
+            return True
+        return (u & self.unshareable) == 0 and ((1 << i) & self.unshareable) == 0 and (u & self.forbidden[i]) == 0
+
+    def bound(self, i, users):
+        '''upper bound on the score for periphs[i:], counting each
+        peripheral which could still get a stream'''
+        n = len(self.periphs)
+        count = 0
+        value = 0
+        for j in range(i, n):
+            for s in self.options[j]:
+                if self.can_use(j, users[s]):
+                    count += 1
+                    value |= 1 << (n-1-j)
+                    break
+        return (count, value, 0)
+
+    def search(self, i, users, need):
+        '''returns (score, streams) for the best allocation of periphs[i:]
+        scoring more than need, given the current users of each stream,
+        or None if there is none. streams holds a stream index or None
+        for each peripheral'''
+        n = len(self.periphs)
+        if i == n:
+            if (0, 0, 0) > need:
+                return ((0, 0, 0), ())
+            return None
+        key = self.memo_key(i, users)
+        if key in self.failed and need >= self.failed[key]:
+            return None
+        self.nodes += 1
+        if self.nodes > self.max_nodes:
+            raise DMASolverLimit()
+        bound = self.bound(i, users)
+        if bound <= need:
+            self.failed[key] = min(self.failed.get(key, bound), bound)
+            return None
+
+        weight = 1 << (n-1-i)
+        free = []
+        shared = []
+        for s in self.options[i]:
+            if users[s] == 0:
+                free.append(s)
+            elif self.can_use(i, users[s]):
+                shared.append(s)
+        # share with the lowest priority peripherals first, as the greedy allocation does
+        shared = sorted(shared, key=lambda s: self.sharing_priority(users[s]), reverse=True)
+
+        best = None
+        threshold = need
+        for s in free + shared:
+            delta = (1, weight, -1 if users[s] else 0)
+            new_users = users[:s] + (users[s] | (1 << i),) + users[s+1:]
+            child_need = (threshold[0]-delta[0], threshold[1]-delta[1], threshold[2]-delta[2])
+            result = self.search(i+1, new_users, child_need)
+            if result is not None:
+                score = (result[0][0]+delta[0], result[0][1]+delta[1], result[0][2]+delta[2])
+                best = (score, (s,) + result[1])
+                threshold = score
+        if not self.required[i]:
+            result = self.search(i+1, users, threshold)
+            if result is not None:
+                best = (result[0], (None,) + result[1])
+        if best is None:
+            self.failed[key] = min(self.failed.get(key, need), need)
+        return best
+
+    def solve(self, need, required=[], exclusive=[]):
+        '''returns (score, allocation) for the best allocation scoring
+        more than need which gives a stream to all the peripherals in
+        required and a stream of their own to all those in exclusive,
+        where allocation is a dictionary of peripheral to stream. Returns
+        None if there is no such allocation or the search was too large'''
+        self.required = [p in required or p in exclusive for p in self.periphs]
+        # a peripheral which must not share is treated like one in the
+        # noshare list
+        self.unshareable = self.noshare_mask
+        for p in exclusive:
+            self.unshareable |= self.bits[p]
+        self.failed = {}
+        try:
+            result = self.search(0, self.initial_users, need)
+        except DMASolverLimit:
+            return None
+        if result is None:
+            return None
+        (score, streams) = result
+        allocation = {}
+        for i in range(len(self.periphs)):
+            if streams[i] is not None:
+                allocation[self.periphs[i]] = self.streams[streams[i]]
+        return (score, allocation)
+
+
 def write_dma_header(f, peripheral_list, mcu_type, dma_exclude=[],
-                     dma_priority='', dma_noshare=[], quiet=False):
-    '''write out a DMA resolver header file'''
-    global dma_map, have_DMAMUX, has_bdshot
+                     dma_priority='', dma_noshare=[], quiet=False, use_solver=False):
+    '''write out a DMA resolver header file. If use_solver is set and
+    the greedy allocation leaves peripherals without DMA, look for a
+    better allocation with DMASolver'''
+    global dma_map, have_DMAMUX, has_bdshot, DMAMUX2_peripherals
     timer_ch_periph = []
 
+    # don't carry over anything from a previous board
+    have_DMAMUX = False
+    DMAMUX2_peripherals = []
     if mcu_type.startswith('STM32H7'):
-        global DMAMUX2_peripherals
         DMAMUX2_peripherals = [ 'I2C4', 'SPI6', 'ADC3' ]
 
     has_bdshot = False
@@ -348,6 +553,7 @@ def write_dma_header(f, peripheral_list, mcu_type, dma_exclude=[],
     # force sharing of TIMx_UP and TIMx_CHy if possible
     periphs = peripheral_list.copy()
     forbidden_streams = []
+    forced_dict = {}
     for periph in peripheral_list:
         if "_UP" in periph:
             for periph2 in peripheral_list:
@@ -357,6 +563,8 @@ def write_dma_header(f, peripheral_list, mcu_type, dma_exclude=[],
                         stream = (shared_channels[0][0], shared_channels[0][1])
                         curr_dict[periph] = stream
                         curr_dict[periph2] = stream
+                        forced_dict[periph] = stream
+                        forced_dict[periph2] = stream
                         forbidden_streams.append(stream)
                         periphs.remove(periph)
                         periphs.remove(periph2)
@@ -427,6 +635,37 @@ def write_dma_header(f, peripheral_list, mcu_type, dma_exclude=[],
             unassigned_new.remove(periph)
     unassigned = unassigned_new
 
+    if unassigned and use_solver:
+        # the greedy allocation can miss allocations which need
+        # several peripherals to move at once, so try an exact search
+        # and use it if it finds DMA for more peripherals, without
+        # taking it away from any, and without making any peripheral
+        # in DMA_PRIORITY share a stream it had to itself
+        solver_periphs = [p for p in periphs if p not in dma_exclude]
+        solver = DMASolver(solver_periphs, dma_map, forced_dict, noshare_list, priority_list)
+        required = [p for p in solver_periphs if p in curr_dict]
+        exclusive = [p for p in required
+                     if get_list_index(p, priority_list) < len(priority_list) and
+                     len(stream_assign[curr_dict[p]]) == 1]
+        # any score with a higher count beats this
+        need = (len(required), 1 << len(solver_periphs), 0)
+        result = solver.solve(need, required=required, exclusive=exclusive)
+        if solver.nodes > solver.max_nodes:
+            print("DMA solver gave up after %u nodes" % solver.max_nodes)
+        elif result is not None:
+            curr_dict = forced_dict.copy()
+            curr_dict.update(result[1])
+            unassigned = [p for p in solver_periphs if p not in curr_dict]
+            stream_assign = {}
+            for k in sorted(curr_dict.keys()):
+                p = curr_dict[k]
+                if not p in stream_assign:
+                    stream_assign[p] = [k]
+                else:
+                    stream_assign[p].append(k)
+            if not quiet:
+                print("DMA solver assigned %u more peripherals" % (result[0][0] - len(required)))
+
     for key in sorted(curr_dict.keys()):
         stream = curr_dict[key]
         if len(stream_assign[stream]) > 1:
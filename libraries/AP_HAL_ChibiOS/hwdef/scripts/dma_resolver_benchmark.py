@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+'''
+benchmark dma_resolver.py over the hwdefs in the tree
+
+chibios_hwdef.py is run over each hwdef to collect the inputs it gives
+the DMA resolver. The resolver is then timed on those inputs with the
+greedy allocation alone and with DMASolver, and the boards where the
+solver finds DMA for more peripherals are listed.  The solver is only
+used for boards with DMA_SOLVER 1 in their hwdef, which those listed
+can add once they have been tested with the new DMA map:
+
+    ./dma_resolver_benchmark.py
+    ./dma_resolver_benchmark.py ../CubeOrange/hwdef.dat --verbose
+
+AP_FLAKE8_CLEAN
+'''
+
+import argparse
+import contextlib
+import glob
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import chibios_hwdef
+import dma_resolver
+
+
+def collect_inputs(hwdef):
+    '''run chibios_hwdef.py over hwdef and return (the arguments it
+    passed to write_dma_header, whether the hwdef enables the solver),
+    or None if it didn't call it'''
+    inputs = []
+    write_dma_header = dma_resolver.write_dma_header
+
+    def capture(f, peripheral_list, mcu_type, dma_exclude=[], dma_priority='', dma_noshare=[], quiet=False,
+                use_solver=False):
+        inputs.append(((list(peripheral_list), mcu_type, list(dma_exclude), dma_priority, list(dma_noshare)),
+                       use_solver))
+        return write_dma_header(f, peripheral_list, mcu_type, dma_exclude=dma_exclude,
+                                dma_priority=dma_priority, dma_noshare=dma_noshare, quiet=quiet,
+                                use_solver=use_solver)
+
+    outdir = tempfile.mkdtemp(prefix="dma-benchmark-")
+    dma_resolver.write_dma_header = capture
+    try:
+        c = chibios_hwdef.ChibiOSHWDef(
+            outdir=outdir,
+            bootloader=os.path.basename(hwdef) == "hwdef-bl.dat",
+            hwdef=[hwdef],
+            default_params_filepath=None,
+            quiet=True,
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            c.run()
+    finally:
+        dma_resolver.write_dma_header = write_dma_header
+        shutil.rmtree(outdir, ignore_errors=True)
+    if len(inputs) == 0:
+        return None
+    return inputs[0]
+
+
+def resolve(inputs, use_solver):
+    '''returns (time taken, header, unassigned peripherals)'''
+    (peripheral_list, mcu_type, dma_exclude, dma_priority, dma_noshare) = inputs
+    f = io.StringIO()
+    tstart = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        (unassigned, ordered_timers) = dma_resolver.write_dma_header(
+            f,
+            list(peripheral_list),
+            mcu_type,
+            dma_exclude=list(dma_exclude),
+            dma_priority=dma_priority,
+            dma_noshare=list(dma_noshare),
+            quiet=True,
+            use_solver=use_solver)
+    return (time.time() - tstart, f.getvalue(), unassigned)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to resolve each board")
+    parser.add_argument("--verbose", action='store_true', help="show the unassigned peripherals for changed boards")
+    parser.add_argument("hwdef", nargs="*", help="hwdef files (default all in the tree)")
+    args = parser.parse_args()
+
+    hwdefs = args.hwdef
+    if len(hwdefs) == 0:
+        hwdef_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+        hwdefs = sorted(glob.glob(os.path.join(hwdef_dir, "*", "hwdef.dat")) +
+                        glob.glob(os.path.join(hwdef_dir, "*", "hwdef-bl.dat")))
+
+    boards = []
+    failed = []
+    for hwdef in hwdefs:
+        name = os.path.relpath(hwdef, os.path.join(os.path.dirname(hwdef), ".."))
+        try:
+            inputs = collect_inputs(hwdef)
+        except BaseException as ex:
+            # chibios_hwdef exits on errors in the hwdef
+            failed.append((name, ex))
+            continue
+        if inputs is not None:
+            boards.append((name,) + inputs)
+
+    totals = {False: 0, True: 0}
+    slowest = []
+    changed = []
+    unassigned_count = {False: 0, True: 0}
+    for (name, inputs, enabled) in boards:
+        results = {}
+        for use_solver in (False, True):
+            times = []
+            for i in range(args.repeat):
+                (dt, header, unassigned) = resolve(inputs, use_solver)
+                times.append(dt)
+            results[use_solver] = (header, unassigned)
+            totals[use_solver] += min(times)
+            if unassigned:
+                unassigned_count[use_solver] += 1
+            if use_solver:
+                slowest.append((min(times), name))
+        if results[False][0] != results[True][0]:
+            changed.append((name, enabled, results[False][1], results[True][1]))
+
+    print("Resolved %u boards (%u failed to process)" % (len(boards), len(failed)))
+    for (name, ex) in failed:
+        print("  %s: %s" % (name, ex))
+    print("Greedy: %.3fs, %u boards with unassigned peripherals" % (totals[False], unassigned_count[False]))
+    print("Solver: %.3fs, %u boards with unassigned peripherals" % (totals[True], unassigned_count[True]))
+    print("Slowest:")
+    for (dt, name) in sorted(slowest, reverse=True)[:5]:
+        print("  %.4fs %s" % (dt, name))
+    print("%u boards changed by the solver" % len(changed))
+    for (name, enabled, before, after) in changed:
+        if enabled:
+            name += " (DMA_SOLVER enabled)"
+        if args.verbose:
+            print("  %s: %s -> %s" % (name, before, after))
+        else:
+            print("  %s" % name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
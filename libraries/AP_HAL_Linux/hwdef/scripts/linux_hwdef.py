@@ -7,7 +7,6 @@ AP_FLAKE8_CLEAN
 '''
 
 import argparse
-import shlex
 import sys
 import os
 
@@ -40,7 +39,7 @@ class LinuxHWDef(hwdef.HWDef):
         self.all_lines.append(line)
         self.alllines.append(line)
 
-        a = shlex.split(line, posix=False)
+        a = hwdef.split_line(line, posix=False)
         if a[0] == 'LINUX_SPIDEV':
             self.process_line_linux_spidev(line, depth, a)
 
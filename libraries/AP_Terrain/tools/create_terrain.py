@@ -6,6 +6,13 @@ create ardupilot terrain database files
 from MAVProxy.modules.mavproxy_map import srtm
 import math, struct, os, sys
 import crc16, time, struct
+import array, collections, hashlib, re, pickle
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # avoid annoying crc16 DeprecationWarning
 import warnings
@@ -247,6 +254,14 @@ class DataFile(object):
         block.crc = crc16.crc16xmodem(buf[:IO_BLOCK_DATA_SIZE])
         buf = self.pack(block)
         self.fh.write(buf)
+        # flush each block so an interrupted run leaves complete blocks
+        # behind for check_filled() to find when it is resumed
+        self.fh.flush()
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
 
     def check_filled(self, block):
         '''read a grid block and check if already filled'''
@@ -371,13 +386,305 @@ def pos_range(filename):
     return lat_min, lat_max, lon_min, lon_max
 
 
+# returned by a TileSource for a tile with no land in it
+OCEAN_TILE = 'ocean'
+
+class TileSource(object):
+    '''a source of zipped SRTM tiles'''
+    def tile_file(self, lat_int, lon_int):
+        '''return path to the .hgt.zip file for a tile, OCEAN_TILE if there
+        is no tile for this position or None if it is not available yet'''
+        raise NotImplementedError()
+
+class DownloaderTileSource(TileSource):
+    '''tiles fetched from terrain.ardupilot.org into the MAVProxy tile cache'''
+    def __init__(self, debug=False):
+        self.downloader = srtm.SRTMDownloader(debug=debug)
+        self.downloader.loadFileList()
+
+    def tile_file(self, lat_int, lon_int):
+        entry = self.downloader.filelist.get((lat_int, lon_int), None)
+        if entry is not None:
+            path = os.path.join(self.downloader.cachedir, entry[1])
+            if os.path.exists(path):
+                return path
+        # let the downloader fetch the file list or tile in the background
+        tile = self.downloader.getTile(lat_int, lon_int)
+        if tile == 0:
+            return None
+        if isinstance(tile, srtm.SRTMOceanTile):
+            return OCEAN_TILE
+        entry = self.downloader.filelist.get((lat_int, lon_int), None)
+        if entry is None:
+            return None
+        return os.path.join(self.downloader.cachedir, entry[1])
+
+class MissingTileError(Exception):
+    '''a tile which may have land in it is not available'''
+    pass
+
+class LocalDirectoryTileSource(TileSource):
+    '''
+    tiles from a local directory tree of .hgt.zip files, such as a copy
+    of the SRTM1 or SRTM3 directories of terrain.ardupilot.org or of a
+    MAVProxy tile cache. No network access is needed.
+
+    The server has no files for ocean tiles, so a missing tile is only
+    treated as ocean if the directory holds a complete MAVProxy file
+    list (filelist_python) which does not have it, or if
+    missing_is_ocean is set. Otherwise MissingTileError is raised
+    rather than writing land as sea level
+    '''
+    def __init__(self, directory, missing_is_ocean=False):
+        self.directory = directory
+        self.missing_is_ocean = missing_is_ocean
+        self.server_tiles = self.load_filelist(os.path.join(directory, "filelist_python"))
+        self.files = {}
+        regex = re.compile(r"^([NS])(\d{2})([EW])(\d{3})\.hgt\.zip$", re.IGNORECASE)
+        for (root, dirs, files) in os.walk(directory):
+            for f in files:
+                m = regex.match(f)
+                if m is None:
+                    continue
+                lat = int(m.group(2))
+                lon = int(m.group(4))
+                if m.group(1).upper() == 'S':
+                    lat = -lat
+                if m.group(3).upper() == 'W':
+                    lon = -lon
+                self.files[(lat, lon)] = os.path.join(root, f)
+        if len(self.files) == 0:
+            print("Warning: no SRTM tiles found in %s" % directory)
+
+    def load_filelist(self, path):
+        '''return the set of tiles on the server from a MAVProxy file
+        list, or None if there is no complete list'''
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            filelist = pickle.load(f)
+        tiles = set([k for k in filelist.keys() if isinstance(k, tuple)])
+        # as for MAVProxy, a shorter list is from an interrupted download
+        if len(tiles) < 14500:
+            print("Warning: ignoring incomplete file list %s" % path)
+            return None
+        return tiles
+
+    def tile_file(self, lat_int, lon_int):
+        path = self.files.get((lat_int, lon_int), None)
+        if path is not None:
+            return path
+        if self.server_tiles is not None and (lat_int, lon_int) not in self.server_tiles:
+            return OCEAN_TILE
+        if self.missing_is_ocean:
+            print("WARNING: tile %d,%d is not in %s, treating it as ocean" %
+                  (lat_int, lon_int, self.directory))
+            return OCEAN_TILE
+        raise MissingTileError("tile %d,%d is not in %s; copy it there, or use "
+                               "--missing-tiles-are-ocean if it has no land in it" %
+                               (lat_int, lon_int, self.directory))
+
+class DecodedTile(srtm.SRTMTile):
+    '''a SRTM tile loaded from already decoded samples'''
+    def __init__(self, data, lat, lon):
+        self.data = data
+        self.size = int(math.sqrt(len(data)))
+        self.lat = lat
+        self.lon = lon
+
+class TileCache(object):
+    '''
+    in-memory LRU cache of SRTM tiles, shared by all degree squares
+    created by a process. If cachedir is given then decoded tiles are
+    also kept on disk, named by a hash of the zip file contents, which
+    avoids decompressing and byte swapping them on every run
+    '''
+    def __init__(self, source, size, cachedir=None):
+        self.source = source
+        self.size = max(size, 1)
+        self.cachedir = cachedir
+        self.tiles = collections.OrderedDict()
+        if cachedir is not None and not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+
+    def load_decoded(self, path, lat_int, lon_int):
+        '''load a tile via the on-disk cache of decoded tiles'''
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        cached = os.path.join(self.cachedir, digest + ".tile")
+        if os.path.exists(cached):
+            data = array.array('h')
+            with open(cached, 'rb') as f:
+                data.frombytes(f.read())
+            if len(data) in (1201*1201, 3601*3601):
+                return DecodedTile(data, lat_int, lon_int)
+        tile = srtm.SRTMTile(path, lat_int, lon_int)
+        # write via a temporary name so other processes never see a
+        # partial file
+        tmpname = "%s.%u.tmp" % (cached, os.getpid())
+        with open(tmpname, 'wb') as f:
+            tile.data.tofile(f)
+        os.replace(tmpname, cached)
+        return tile
+
+    def load(self, lat_int, lon_int):
+        '''load a tile from the source, waiting for it to download if needed'''
+        waited = False
+        while True:
+            path = self.source.tile_file(lat_int, lon_int)
+            if path is not None:
+                break
+            print("waiting on download of %d,%d" % (lat_int, lon_int))
+            time.sleep(0.3)
+            waited = True
+        if waited:
+            print("downloaded %d,%d" % (lat_int, lon_int))
+        if path == OCEAN_TILE:
+            return srtm.SRTMOceanTile(lat_int, lon_int)
+        if self.cachedir is not None:
+            return self.load_decoded(path, lat_int, lon_int)
+        return srtm.SRTMTile(path, lat_int, lon_int)
+
+    def get(self, lat_int, lon_int):
+        '''get a tile, evicting the least recently used tile if needed'''
+        tile_idx = (lat_int, lon_int)
+        tile = self.tiles.get(tile_idx, None)
+        if tile is not None:
+            self.tiles.move_to_end(tile_idx)
+            return tile
+        tile = self.load(lat_int, lon_int)
+        self.tiles[tile_idx] = tile
+        while len(self.tiles) > self.size:
+            self.tiles.popitem(last=False)
+        return tile
+
+def get_tile(lat_int, lon_int):
+    '''get a SRTM tile from the shared tile cache'''
+    return tile_cache.get(lat_int, lon_int)
+
+def fill_grid_points(grid, lat, lon):
+    '''fill a grid block one point at a time'''
+    for gx in range(TERRAIN_GRID_BLOCK_SIZE_X):
+        for gy in range(TERRAIN_GRID_BLOCK_SIZE_Y):
+            lat_e7, lon_e7 = add_offset(lat*1.0e7, lon*1.0e7, gx*GRID_SPACING, gy*GRID_SPACING)
+            lat2_int = int(math.floor(lat_e7*1.0e-7))
+            lon2_int = int(math.floor(lon_e7*1.0e-7))
+            tile = get_tile(lat2_int, lon2_int)
+            if isinstance(tile, srtm.SRTMOceanTile):
+                # shortcut ocean tile creation, heights are already zero
+                continue
+            altitude = tile.getAltitudeFromLatLon(lat_e7*1.0e-7, lon_e7*1.0e-7)
+            grid.fill(gx, gy, altitude)
+
+def tile_data_array(tile):
+    '''return the samples of a SRTM tile as a numpy array'''
+    data = getattr(tile, 'numpy_data', None)
+    if data is None:
+        data = numpy.frombuffer(tile.data, dtype=numpy.int16)
+        tile.numpy_data = data
+    return data
+
+def tile_altitudes(tile, lat, lon):
+    '''
+    bilinear interpolation of arrays of lat/lon within one tile. This
+    follows the arithmetic of SRTMTile.getAltitudeFromLatLon() exactly
+    so results are identical to filling the grid one point at a time
+    '''
+    size = tile.size
+    data = tile_data_array(tile)
+    x = (lon - tile.lon) * (size - 1)
+    y = (lat - tile.lat) * (size - 1)
+    x_int = x.astype(numpy.int64)
+    y_int = y.astype(numpy.int64)
+    x_frac = x - x_int
+    y_frac = y - y_int
+    offset = x_int + size * (size - y_int - 1)
+    def pixels(ofs):
+        v = data[ofs].astype(numpy.float64)
+        # -32768 is a special value for areas with no data
+        v[v == -32768] = -1
+        return v
+    value00 = pixels(offset)
+    value10 = pixels(offset+1)
+    value01 = pixels(offset-size)
+    value11 = pixels(offset-size+1)
+    value1 = value10 * x_frac + value00 * (1 - x_frac)
+    value2 = value11 * x_frac + value01 * (1 - x_frac)
+    return value2 * y_frac + value1 * (1 - y_frac)
+
+def fill_grid_numpy(grid, lat, lon):
+    '''
+    fill a grid block using numpy, computing all 28x32 offsets and
+    altitudes at once. The float32 emulation in add_offset() is kept
+    by calculating the longitude scale for each row with
+    longitude_scale()
+    '''
+    lat_e7 = lat*1.0e7
+    lon_e7 = lon*1.0e7
+    ofs_north = numpy.arange(TERRAIN_GRID_BLOCK_SIZE_X, dtype=numpy.float64) * GRID_SPACING
+    ofs_east = numpy.arange(TERRAIN_GRID_BLOCK_SIZE_Y, dtype=numpy.float64) * GRID_SPACING
+    dlat = numpy.trunc(ofs_north * LOCATION_SCALING_FACTOR_INV)
+    scale = numpy.array([longitude_scale((lat_e7+d*0.5)*1.0e-7) for d in dlat])
+    dlng = numpy.trunc((ofs_east * LOCATION_SCALING_FACTOR_INV)[numpy.newaxis,:] / scale[:,numpy.newaxis])
+    lat2_e7 = numpy.trunc(lat_e7 + dlat)[:,numpy.newaxis] + numpy.zeros_like(dlng)
+    lon2_e7 = numpy.trunc(lon_e7 + dlng)
+    lat2 = lat2_e7 * 1.0e-7
+    lon2 = lon2_e7 * 1.0e-7
+    lat2_int = numpy.floor(lat2).astype(int)
+    lon2_int = numpy.floor(lon2).astype(int)
+
+    heights = numpy.zeros(lat2.shape, dtype=numpy.int64)
+    # a block can straddle up to four SRTM tiles
+    for (lat_int, lon_int) in sorted(set(zip(lat2_int.flat, lon2_int.flat))):
+        tile = get_tile(int(lat_int), int(lon_int))
+        if isinstance(tile, srtm.SRTMOceanTile):
+            continue
+        mask = (lat2_int == lat_int) & (lon2_int == lon_int)
+        if hasattr(tile, 'data') and hasattr(tile, 'size'):
+            heights[mask] = numpy.trunc(tile_altitudes(tile, lat2[mask], lon2[mask]))
+        else:
+            heights[mask] = [int(tile.getAltitudeFromLatLon(a, b)) for (a, b) in zip(lat2[mask], lon2[mask])]
+    grid.height = heights.tolist()
+
+def fill_grid(grid, lat, lon):
+    '''fill in heights for a grid block with SW corner at lat/lon'''
+    if numpy is not None and not args.no_numpy:
+        fill_grid_numpy(grid, lat, lon)
+    else:
+        fill_grid_points(grid, lat, lon)
+
+def progress_filename():
+    '''file recording which degree squares have been completed'''
+    return os.path.join(args.directory, "create_terrain.progress")
+
+def load_progress():
+    '''return set of (lat, lon) degrees already completed at this spacing'''
+    done = set()
+    try:
+        f = open(progress_filename(), 'r')
+    except IOError:
+        return done
+    for line in f:
+        a = line.split()
+        if len(a) != 3:
+            continue
+        if int(a[2]) != GRID_SPACING:
+            continue
+        done.add((int(a[0]), int(a[1])))
+    f.close()
+    return done
+
+def save_progress(lat_int, lon_int):
+    '''record a completed degree square. Lines are short and written in
+    one go in append mode so concurrent workers do not interleave'''
+    with open(progress_filename(), 'a') as f:
+        f.write("%d %d %d\n" % (lat_int, lon_int, GRID_SPACING))
+
 def create_degree(lat, lon):
     '''create data file for one degree lat/lon'''
     lat_int = int(math.floor(lat))
     lon_int = int(math.floor((lon)))
 
-    tiles = {}
-
     dfile = DataFile(lat_int, lon_int)
 
     print("Creating for %d %d" % (lat_int, lon_int))
@@ -396,37 +703,52 @@ def create_degree(lat, lon):
             continue
         if not args.force and dfile.check_filled(grid):
             continue
-        for gx in range(TERRAIN_GRID_BLOCK_SIZE_X):
-            for gy in range(TERRAIN_GRID_BLOCK_SIZE_Y):
-                lat_e7, lon_e7 = add_offset(lat*1.0e7, lon*1.0e7, gx*GRID_SPACING, gy*GRID_SPACING)
-                lat2_int = int(math.floor(lat_e7*1.0e-7))
-                lon2_int = int(math.floor(lon_e7*1.0e-7))
-                tile_idx = (lat2_int, lon2_int)
-                while not tile_idx in tiles:
-                    tile = downloader.getTile(lat2_int, lon2_int)
-                    waited = False
-                    if tile == 0:
-                        print("waiting on download of %d,%d" % (lat2_int, lon2_int))
-                        time.sleep(0.3)
-                        waited = True
-                        continue
-                    if waited:
-                        print("downloaded %d,%d" % (lat2_int, lon2_int))
-                    tiles[tile_idx] = tile
-                if isinstance(tile, srtm.SRTMOceanTile):
-                     # shortcut ocean tile creation
-                     break
-                altitude = tiles[tile_idx].getAltitudeFromLatLon(lat_e7*1.0e-7, lon_e7*1.0e-7)
-                grid.fill(gx, gy, altitude)
+        fill_grid(grid, lat, lon)
         dfile.write(grid)
+    dfile.close()
+    save_progress(lat_int, lon_int)
+
+def create_worker(work_queue):
+    '''create degree squares from a queue until we get None'''
+    while True:
+        tag = work_queue.get()
+        if tag is None:
+            break
+        create_degree(tag[0], tag[1])
+
+def create_degrees(degrees):
+    '''create a list of degree squares, using multiple processes if asked'''
+    if args.processes <= 1 or len(degrees) <= 1:
+        for (lat_int, lon_int) in degrees:
+            create_degree(lat_int, lon_int)
+        return True
+    # the SRTM downloader starts child processes, so use plain
+    # (non-daemonic) processes rather than a multiprocessing.Pool
+    ctx = multiprocessing.get_context('fork')
+    work_queue = ctx.Queue()
+    for tag in degrees:
+        work_queue.put(tag)
+    nprocs = min(args.processes, len(degrees))
+    for i in range(nprocs):
+        work_queue.put(None)
+    procs = []
+    for i in range(nprocs):
+        p = ctx.Process(target=create_worker, args=(work_queue,))
+        p.start()
+        procs.append(p)
+    ok = True
+    for p in procs:
+        p.join()
+        if p.exitcode != 0:
+            print("Worker %u failed with exit code %s" % (p.pid, p.exitcode))
+            ok = False
+    return ok
 
 def test_degree(lat, lon):
     '''test data file for one degree lat/lon. Return a TerrainError object'''
     lat_int = int(math.floor(lat))
     lon_int = int(math.floor((lon)))
 
-    tiles = {}
-
     dfile = DataFile(lat_int, lon_int, True)
 
     print("Testing %d %d" % (lat_int, lon_int))
@@ -445,25 +767,7 @@ def test_degree(lat, lon):
         grid = GridBlock(lat_int, lon_int, lat, lon)
         if grid.blocknum() != blocknum:
             continue
-        for gx in range(TERRAIN_GRID_BLOCK_SIZE_X):
-            for gy in range(TERRAIN_GRID_BLOCK_SIZE_Y):
-                lat_e7, lon_e7 = add_offset(lat*1.0e7, lon*1.0e7, gx*GRID_SPACING, gy*GRID_SPACING)
-                lat2_int = int(math.floor(lat_e7*1.0e-7))
-                lon2_int = int(math.floor(lon_e7*1.0e-7))
-                tile_idx = (lat2_int, lon2_int)
-                while not tile_idx in tiles:
-                    tile = downloader.getTile(lat2_int, lon2_int)
-                    waited = False
-                    if tile == 0:
-                        print("waiting on download of %d,%d" % (lat2_int, lon2_int))
-                        time.sleep(0.3)
-                        waited = True
-                        continue
-                    if waited:
-                        print("downloaded %d,%d" % (lat2_int, lon2_int))
-                    tiles[tile_idx] = tile
-                altitude = tiles[tile_idx].getAltitudeFromLatLon(lat_e7*1.0e-7, lon_e7*1.0e-7)
-                grid.fill(gx, gy, altitude)
+        fill_grid(grid, lat, lon)
         err = dfile.compare(grid, args.test_threshold)
         errors.add(err)
     return errors
@@ -506,14 +810,24 @@ parser.add_argument("--pos-range", default=None, help="show position range for a
 parser.add_argument("--test", action='store_true', help="test altitudes instead of writing them")
 parser.add_argument("--test-threshold", default=2.0, type=float, help="test altitude threshold")
 parser.add_argument("--directory", default="terrain", help="directory to use")
+parser.add_argument("--processes", type=int, default=1, help="number of degree squares to create in parallel")
+parser.add_argument("--tile-directory", default=None, help="use SRTM .hgt.zip tiles from this directory instead of downloading them")
+parser.add_argument("--missing-tiles-are-ocean", action='store_true', default=False,
+                    help="treat tiles missing from --tile-directory as ocean")
+parser.add_argument("--tile-cache-size", type=int, default=9, help="number of SRTM tiles to keep in memory")
+parser.add_argument("--tile-cache-dir", default=None, help="directory to keep decoded SRTM tiles in")
+parser.add_argument("--no-numpy", action='store_true', default=False, help="fill grid blocks one point at a time")
 args = parser.parse_args()
 
 if args.pos_range is not None:
     print(pos_range(args.pos_range))
     sys.exit(0)
 
-downloader = srtm.SRTMDownloader(debug=args.debug)
-downloader.loadFileList()
+if args.tile_directory is not None:
+    tile_source = LocalDirectoryTileSource(args.tile_directory, args.missing_tiles_are_ocean)
+else:
+    tile_source = DownloaderTileSource(debug=args.debug)
+tile_cache = TileCache(tile_source, args.tile_cache_size, args.tile_cache_dir)
 
 GRID_SPACING = args.spacing
 
@@ -529,6 +843,12 @@ if args.lat is None or args.lon is None:
     print("You must supply latitude and longitude")
     sys.exit(1)
 
+# degree squares completed by an earlier, interrupted run
+completed = set()
+if not args.force:
+    completed = load_progress()
+
+degrees = []
 for dx in range(-args.radius, args.radius):
     for dy in range(-args.radius, args.radius):
         (lat2,lon2) = add_offset(args.lat*1e7, args.lon*1e7, dx*1000.0, dy*1000.0)
@@ -540,4 +860,10 @@ for dx in range(-args.radius, args.radius):
         if tag in done:
             continue
         done.add(tag)
-        create_degree(lat_int, lon_int)
+        if tag in completed:
+            print("Already created %d %d" % (lat_int, lon_int))
+            continue
+        degrees.append(tag)
+
+if not create_degrees(degrees):
+    sys.exit(1)
@@ -2,13 +2,17 @@
 '''
 example rover for JSON backend using pybullet
 based on racecar example from pybullet
+
+With --count several vehicles share one world, vehicle N being driven
+by SITL instance N (port 9002+10*N), and the world is stepped once for
+all of them.  Add --headless to run without the GUI, e.g. for swarm
+testing:
+
+    ./robot.py --vehicle iris --count 20 --headless
 '''
 
 import os, inspect, sys
 
-import socket
-import struct
-import json
 import math
 
 from pyrobolearn.simulators import Bullet
@@ -23,21 +27,32 @@ import pyrobolearn as prl
 import time
 
 import argparse
+
+# the JSON SITL protocol is handled by the sitl_json package in the directory above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import sitl_json
+
 from math import degrees, radians
 
 parser = argparse.ArgumentParser(description="pybullet robot")
 parser.add_argument("--vehicle", required=True, choices=['quad', 'racecar', 'iris', 'opendog', 'all'], default='iris', help="vehicle type")
 parser.add_argument("--fps", type=float, default=1000.0, help="physics frame rate")
 parser.add_argument("--stadium", default=False, action='store_true', help="use stadium for world")
+parser.add_argument("--count", type=int, default=1, help="number of vehicles, each driven by its own SITL instance")
+parser.add_argument("--spacing", type=float, default=2.0, help="distance between vehicles in meters")
+parser.add_argument("--headless", default=False, action='store_true', help="run without the GUI")
 
 args = parser.parse_args()
 
+if args.count > 1 and args.vehicle == 'all':
+    raise Exception("--count is not supported with --vehicle all")
+
 RATE_HZ = args.fps
 TIME_STEP = 1.0 / RATE_HZ
 GRAVITY_MSS = 9.80665
 
 # Create simulator
-sim = Bullet()
+sim = Bullet(render=not args.headless)
 
 # create world
 from pyrobolearn.worlds import BasicWorld
@@ -48,9 +63,10 @@ if args.stadium:
     world.floor_id = world.sim.load_sdf(os.path.join(pybullet_data.getDataPath(), "stadium.sdf"), position=[0,0,0])
 
 # setup keyboard interface
-interface = prl.tools.interfaces.MouseKeyboardInterface()
+if not args.headless:
+    interface = prl.tools.interfaces.MouseKeyboardInterface()
 
-def control_quad(pwm):
+def control_quad(vehicle, pwm):
     '''control quadcopter'''
     motor_dir = [ 1, 1, -1, -1 ]
     motor_order = [ 0, 1, 2, 3 ]
@@ -60,63 +76,131 @@ def control_quad(pwm):
     for m in range(len(motors)):
         motor_speed[motor_order[m]] = constrain(motors[m] - 1000.0, 0, 1000) * motor_dir[motor_order[m]]
 
-    robot.set_propeller_velocities(motor_speed)
+    vehicle.robot.set_propeller_velocities(motor_speed)
 
-def control_racecar(pwm):
+def control_racecar(vehicle, pwm):
     '''control racecar'''
     steer_max = 45.0
     throttle_max = 200.0
     steering = constrain((pwm[0] - 1500.0)/500.0, -1, 1) * math.radians(steer_max) * -1
     throttle = constrain((pwm[2] - 1500.0)/500.0, -1, 1) * throttle_max
 
-    robot.steer(steering)
-    robot.drive(throttle)
-
-last_angles = [0.0] * 12
+    vehicle.robot.steer(steering)
+    vehicle.robot.drive(throttle)
 
-def control_joints(pwm):
+def control_joints(vehicle, pwm):
     '''control a joint based bot'''
-    global last_angles
+    robot = vehicle.robot
     max_angle = radians(90)
     joint_speed = radians(30)
     pwm = pwm[0:len(robot.joints)]
     angles = [ constrain((v-1500.0)/500.0, -1, 1) * max_angle for v in pwm ]
-    current = last_angles
+    current = vehicle.last_angles
     max_change = joint_speed * TIME_STEP
     for i in range(len(angles)):
         angles[i] = constrain(angles[i], current[i]-max_change, current[i]+max_change)
     robot.set_joint_positions(angles, robot.joints)
-    last_angles = angles
-
-
-if args.vehicle == 'iris':
-    from pyrobolearn.robots import Quadcopter
-    robot = Quadcopter(sim, urdf="models/iris/iris.urdf")
-    control_pwm = control_quad
-elif args.vehicle == 'racecar':
-    from pyrobolearn.robots import F10Racecar
-    robot = F10Racecar(sim)
-    control_pwm = control_racecar
-elif args.vehicle == 'opendog':
-    from pyrobolearn.robots import OpenDog
-    robot = OpenDog(sim, urdf="models/opendog/opendog.urdf")
-    control_pwm = control_joints
-elif args.vehicle == 'all':
-    from pyrobolearn.robots import OpenDog, Aibo, Ant, ANYmal, HyQ, HyQ2Max, Laikago, LittleDog, Minitaur, Pleurobot, Crab, Morphex, Rhex, SEAHexapod
-    bots = [Crab, Morphex, Rhex, SEAHexapod, Aibo, Ant, ANYmal, HyQ, HyQ2Max, Laikago, LittleDog, Minitaur, Pleurobot ]
-    for i in range(len(bots)):
-        r = bots[i](sim)
-        r.position = [0, i*2, 2]
-    control_pwm = control_joints
-    robot = OpenDog(sim, urdf="models/opendog/opendog.urdf")
-else:
+    vehicle.last_angles = angles
+
+
+class SimVehicle(object):
+    '''one robot in the world, driven by one SITL instance'''
+    def __init__(self, robot, control_pwm, offset):
+        self.robot = robot
+        self.control_pwm = control_pwm
+        # where the robot is placed relative to the first one; positions
+        # are sent to SITL relative to this
+        self.offset = offset
+        self.pwm = None
+        self.last_velocity = None
+        self.last_angles = [0.0] * 12
+        # physics time when SITL connected or was reset
+        self.time_origin = None
+
+    def reset(self):
+        self.time_origin = None
+        self.robot.position = list(self.offset)
+        self.robot.orientation = [0,0,0,1]
+        self.last_velocity = None
+
+    def state(self):
+        '''return the sensor data to send to SITL after a physics step'''
+        robot = self.robot
+        if self.time_origin is None:
+            self.time_origin = time_now - TIME_STEP
+
+        # get the position orientation and velocity
+        quaternion = quaternion_to_AP(robot.orientation)
+        roll, pitch, yaw = quaternion.euler
+        velocity = vector_to_AP(robot.linear_velocity)
+        world_position = robot.position
+        position = vector_to_AP([world_position[i] - self.offset[i] for i in range(3)])
+
+        # get ArduPilot DCM matrix (rotation matrix)
+        dcm = quaternion.dcm
+
+        # get gyro vector in body frame
+        gyro = dcm.transposed() * vector_to_AP(robot.angular_velocity)
+
+        # calculate acceleration
+        if self.last_velocity is None:
+            self.last_velocity = velocity
+
+        accel = (velocity - self.last_velocity) * (1.0 / TIME_STEP)
+        self.last_velocity = velocity
+
+        # add in gravity in earth frame
+        accel.z -= GRAVITY_MSS
+
+        # convert accel to body frame
+        accel = dcm.transposed() * accel
+
+        # convert to tuples
+        accel = to_tuple(accel)
+        gyro = to_tuple(gyro)
+        position = to_tuple(position)
+        velocity = to_tuple(velocity)
+        euler = (roll, pitch, yaw)
+
+        return time_now - self.time_origin,gyro,accel,position,euler,velocity
+
+
+def create_robot():
+    '''create a robot, returning it and its control function'''
+    if args.vehicle == 'iris':
+        from pyrobolearn.robots import Quadcopter
+        return (Quadcopter(sim, urdf="models/iris/iris.urdf"), control_quad)
+    if args.vehicle == 'racecar':
+        from pyrobolearn.robots import F10Racecar
+        return (F10Racecar(sim), control_racecar)
+    if args.vehicle == 'opendog':
+        from pyrobolearn.robots import OpenDog
+        return (OpenDog(sim, urdf="models/opendog/opendog.urdf"), control_joints)
+    if args.vehicle == 'all':
+        from pyrobolearn.robots import OpenDog, Aibo, Ant, ANYmal, HyQ, HyQ2Max, Laikago, LittleDog, Minitaur, Pleurobot, Crab, Morphex, Rhex, SEAHexapod
+        bots = [Crab, Morphex, Rhex, SEAHexapod, Aibo, Ant, ANYmal, HyQ, HyQ2Max, Laikago, LittleDog, Minitaur, Pleurobot ]
+        for i in range(len(bots)):
+            r = bots[i](sim)
+            r.position = [0, i*2, 2]
+        return (OpenDog(sim, urdf="models/opendog/opendog.urdf"), control_joints)
     raise Exception("Bad vehicle")
 
 
+vehicles = []
+for i in range(args.count):
+    (robot, control_pwm) = create_robot()
+    offset = (0, i * args.spacing, 0)
+    if i > 0:
+        position = robot.position
+        robot.position = [position[0] + offset[0], position[1] + offset[1], position[2] + offset[2]]
+    vehicles.append(SimVehicle(robot, control_pwm, offset))
+
+# the first robot, for the GUI
+robot = vehicles[0].robot
+
 sim.set_time_step(TIME_STEP)
 
 time_now = 0
-last_velocity = None
 
 def quaternion_to_AP(quaternion):
     '''convert pybullet quaternion to ArduPilot quaternion'''
@@ -134,12 +218,6 @@ def to_tuple(vec3):
     '''convert a Vector3 to a tuple'''
     return (vec3.x, vec3.y, vec3.z)
 
-def init():
-  global time_now
-  time_now = 0
-  robot.position = [0,0,0]
-  robot.orientation = [0,0,0,1]
-
 def constrain(v,min_v,max_v):
     '''constrain a value'''
     if v < min_v:
@@ -151,59 +229,31 @@ def constrain(v,min_v,max_v):
 #robot.position = [ 0, 0, 2]
 #robot.orientation = quaternion_from_AP(Quaternion([math.radians(0), math.radians(0), math.radians(50)]))
 
-def physics_step(pwm_in):
+step_count = 0
+step_time = time.time()
 
-  control_pwm(pwm_in)
+def physics_step(frames):
+  '''step the world once for all the vehicles. frames holds the PWM of
+  each vehicle with a new frame from SITL, by vehicle index'''
+  for (i, pwm) in frames.items():
+      vehicles[i].pwm = pwm
+  for vehicle in vehicles:
+      if vehicle.pwm is not None:
+          vehicle.control_pwm(vehicle, vehicle.pwm)
 
   world.step(sleep_dt=0)
 
-  global time_now
+  global time_now, step_count, step_time
   time_now += TIME_STEP
 
-  # get the position orientation and velocity
-  quaternion = quaternion_to_AP(robot.orientation)
-  roll, pitch, yaw = quaternion.euler
-  velocity = vector_to_AP(robot.linear_velocity)
-  position = vector_to_AP(robot.position)
-
-  # get ArduPilot DCM matrix (rotation matrix)
-  dcm = quaternion.dcm
+  if len(vehicles) > 1:
+      step_count += 1
+      if step_count % 1000 == 0:
+          now = time.time()
+          print("%u vehicles %.2f steps/s T=%.3f" % (len(vehicles), 1000/(now - step_time), time_now))
+          step_time = now
 
-  # get gyro vector in body frame
-  gyro = dcm.transposed() * vector_to_AP(robot.angular_velocity)
-  
-  # calculate acceleration
-  global last_velocity
-  if last_velocity is None:
-      last_velocity = velocity
-
-  accel = (velocity - last_velocity) * (1.0 / TIME_STEP)
-  last_velocity = velocity
-
-  # add in gravity in earth frame
-  accel.z -= GRAVITY_MSS
-
-  # convert accel to body frame
-  accel = dcm.transposed() * accel
-
-  # convert to tuples
-  accel = to_tuple(accel)
-  gyro = to_tuple(gyro)
-  position = to_tuple(position)
-  velocity = to_tuple(velocity)
-  euler = (roll, pitch, yaw)
-
-  return time_now,gyro,accel,position,euler,velocity
-
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind(('', 9002))
-sock.settimeout(0.1)
-
-last_SITL_frame = -1
-connected = False
-frame_count = 0
-frame_time = time.time()
-print_frame_count = 1000
+  return {i: vehicles[i].state() for i in frames.keys()}
 
 move_accel = 0.0
 last_move = time.time()
@@ -247,84 +297,34 @@ def move_view(keys):
               target[2])
     sim.reset_debug_visualizer(dist, radians(yaw), radians(pitch), target)
 
-while True:
-
-  py_time = time.time()
-
+def rate_change(rate_hz):
+  '''SITL has changed its frame rate'''
+  global RATE_HZ, TIME_STEP
+  RATE_HZ = rate_hz
+  TIME_STEP = 1.0 / RATE_HZ
+  sim.set_time_step(TIME_STEP)
+
+bridges = []
+for i in range(len(vehicles)):
+    name = None
+    print_frame_count = 1000
+    if len(vehicles) > 1:
+        # the steps of the group are printed instead
+        name = "vehicle %u" % i
+        print_frame_count = 0
+    bridge = sitl_json.SITLBridge(port=9002 + 10 * i, rate_hz=RATE_HZ, name=name, print_frame_count=print_frame_count)
+    bridge.on_reset = vehicles[i].reset
+    bridge.on_rate_change = rate_change
+    bridges.append(bridge)
+
+group = sitl_json.BridgeGroup(bridges)
+
+def idle():
+  '''keep the GUI responsive'''
   interface.step()
   move_view(interface.key_down)
 
-  try:
-      data,address = sock.recvfrom(100)
-  except Exception as ex:
-      time.sleep(0.01)
-      continue
-
-  parse_format = 'HHI16H'
-  magic = 18458
-
-  if len(data) != struct.calcsize(parse_format):
-    print("got packet of len %u, expected %u" % (len(data), struct.calcsize(parse_format)))
-    continue
-
-
-  decoded = struct.unpack(parse_format,data)
-
-  if magic != decoded[0]:
-      print("Incorrect protocol magic %u should be %u" % (decoded[0], magic))
-      continue
-
-  frame_rate_hz = decoded[1]
-  frame_count = decoded[2]
-  pwm = decoded[3:]
-
-  if frame_rate_hz != RATE_HZ:
-      print("New frame rate %u" % frame_rate_hz)
-      RATE_HZ = frame_rate_hz
-      TIME_STEP = 1.0 / RATE_HZ
-      sim.set_time_step(TIME_STEP)
-
-  # Check if the fame is in expected order
-  if frame_count < last_SITL_frame:
-    # Controller has reset, reset physics also
-    init()
-    print('Controller reset')
-  elif frame_count == last_SITL_frame:
-    # duplicate frame, skip
-    print('Duplicate input frame')
-    continue
-  elif frame_count != last_SITL_frame + 1 and connected:
-    print('Missed {0} input frames'.format(frame_count - last_SITL_frame - 1))
-  last_SITL_frame = frame_count
-
-  if not connected:
-    connected = True
-    print('Connected to {0}'.format(str(address)))
-  frame_count += 1
-
-  # physics time step
-  phys_time,gyro,accel,pos,euler,velo = physics_step(pwm)
-
-  # build JSON format
-  IMU_fmt = {
-    "gyro" : gyro,
-    "accel_body" : accel
-  }
-  JSON_fmt = {
-    "timestamp" : phys_time,
-    "imu" : IMU_fmt,
-    "position" : pos,
-    "attitude" : euler,
-    "velocity" : velo
-  }
-  JSON_string = "\n" + json.dumps(JSON_fmt,separators=(',', ':')) + "\n"
-
-  # Send to AP
-  sock.sendto(bytes(JSON_string,"ascii"), address)
-
-  # Track frame rate
-  if frame_count % print_frame_count == 0:
-    now = time.time()
-    total_time = now - frame_time
-    print("%.2f fps T=%.3f dt=%.3f" % (print_frame_count/total_time, phys_time, total_time))
-    frame_time = now
+if args.headless:
+    group.run(physics_step)
+else:
+    group.run(physics_step, idle=idle)
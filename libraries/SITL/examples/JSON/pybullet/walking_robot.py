@@ -2,9 +2,6 @@
 
 import os, inspect, sys
 
-import socket
-import struct
-import json
 import math
 import pybullet_data
 import pybullet as p
@@ -15,6 +12,11 @@ from pymavlink.quaternion import Quaternion
 import time
 
 import argparse
+
+# the JSON SITL protocol is handled by the sitl_json package in the directory above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import sitl_json
+
 from math import degrees, radians
 
 parser = argparse.ArgumentParser(description="pybullet robot")
@@ -160,94 +162,15 @@ def physics_step(pwm_in):
 
   return time_now,gyro,accel,position,euler,velocity
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind(('', 9002))
-sock.settimeout(0.1)
-
-last_SITL_frame = -1
-connected = False
-frame_count = 0
-frame_time = time.time()
-print_frame_count = 1000
-
-move_accel = 0.0
-last_move = time.time()
-
-while True:
-
-  py_time = time.time()
-
-  try:
-      data,address = sock.recvfrom(100)
-  except Exception as ex:
-      time.sleep(0.01)
-      continue
-
-  parse_format = 'HHI16H'
-  magic = 18458
-
-  if len(data) != struct.calcsize(parse_format):
-    print("got packet of len %u, expected %u" % (len(data), struct.calcsize(parse_format)))
-    continue
-
-
-  decoded = struct.unpack(parse_format,data)
-
-  if magic != decoded[0]:
-      print("Incorrect protocol magic %u should be %u" % (decoded[0], magic))
-      continue
-
-  frame_rate_hz = decoded[1]
-  frame_count = decoded[2]
-  pwm = decoded[3:]
-
-  if frame_rate_hz != RATE_HZ:
-      print("New frame rate %u" % frame_rate_hz)
-      RATE_HZ = frame_rate_hz
-      TIME_STEP = 1.0 / RATE_HZ
-      p.setTimeStep(TIME_STEP)
-
-  # Check if the fame is in expected order
-  if frame_count < last_SITL_frame:
-    # Controller has reset, reset physics also
-    init()
-    print('Controller reset')
-  elif frame_count == last_SITL_frame:
-    # duplicate frame, skip
-    print('Duplicate input frame')
-    continue
-  elif frame_count != last_SITL_frame + 1 and connected:
-    print('Missed {0} input frames'.format(frame_count - last_SITL_frame - 1))
-  last_SITL_frame = frame_count
-
-  if not connected:
-    connected = True
-    print('Connected to {0}'.format(str(address)))
-  frame_count += 1
-
-  # physics time step
-  phys_time,gyro,accel,pos,euler,velo = physics_step(pwm)
-
-  # build JSON format
-  IMU_fmt = {
-    "gyro" : gyro,
-    "accel_body" : accel
-  }
-  JSON_fmt = {
-    "timestamp" : phys_time,
-    "imu" : IMU_fmt,
-    "position" : pos,
-    "attitude" : euler,
-    "velocity" : velo
-  }
-  JSON_string = "\n" + json.dumps(JSON_fmt,separators=(',', ':')) + "\n"
-
-  # Send to AP
-  sock.sendto(bytes(JSON_string,"ascii"), address)
-
-  # Track frame rate
-  if frame_count % print_frame_count == 0:
-    now = time.time()
-    total_time = now - frame_time
-    print("%.2f fps T=%.3f dt=%.3f" % (print_frame_count/total_time, phys_time, total_time))
-    frame_time = now
+def rate_change(rate_hz):
+  '''SITL has changed its frame rate'''
+  global RATE_HZ, TIME_STEP
+  RATE_HZ = rate_hz
+  TIME_STEP = 1.0 / RATE_HZ
+  p.setTimeStep(TIME_STEP)
+
+bridge = sitl_json.SITLBridge(port=9002, rate_hz=RATE_HZ)
+bridge.on_reset = init
+bridge.on_rate_change = rate_change
+
+bridge.run(physics_step)
@@ -0,0 +1,18 @@
+'''
+shared code for physics backends using the JSON SITL backend, see
+../readme.md for the protocol
+
+AP_FLAKE8_CLEAN
+'''
+
+from .protocol import (  # noqa: F401
+    BOOLEAN_FIELDS,
+    DEFAULT_FIELDS,
+    FIELDS,
+    JSONEncoder,
+    ServoPacket,
+    TemplateEncoder,
+    decode_servo_packet,
+)
+from .bridge import SITLBridge  # noqa: F401
+from .group import BridgeGroup  # noqa: F401
@@ -0,0 +1,148 @@
+'''
+UDP link between a physics backend and a JSON SITL instance
+
+SITL sends a servo packet each frame and waits for the sensor data of
+the step which follows it.  SITLBridge keeps track of the frames,
+telling the backend when SITL has restarted or changed its frame rate,
+dropping duplicate frames and counting missed ones:
+
+    bridge = SITLBridge(port=9002)
+    bridge.on_reset = reset_physics
+    bridge.run(physics_step)
+
+physics_step is called with the PWM values of each new frame and
+returns a value for each field of the bridge's encoder.  For backends
+which service several bridges in one loop, receive() returns the next
+new frame (or None) and send() replies to it; BridgeGroup does this
+for a group of bridges stepped together.
+
+AP_FLAKE8_CLEAN
+'''
+
+import socket
+import time
+
+from . import protocol
+
+
+class SITLBridge(object):
+    '''link to one SITL instance'''
+
+    def __init__(self, port=9002, address='', encoder=None, rate_hz=1000.0, timeout=0.1,
+                 print_frame_count=1000, name=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.sock.settimeout(timeout)
+        if encoder is None:
+            encoder = protocol.TemplateEncoder()
+        self.encoder = encoder
+        self.rate_hz = rate_hz
+        self.time_step = 1.0 / rate_hz
+        self.name = name
+        # called with no arguments when SITL restarts
+        self.on_reset = None
+        # called with the new rate when SITL changes its frame rate
+        self.on_rate_change = None
+
+        self.sitl_address = None
+        self.last_frame = -1
+        self.connected = False
+        self.frames = 0
+        self.missed = 0
+        self.duplicates = 0
+        self.print_frame_count = print_frame_count
+        self.print_time = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def message(self, text):
+        if self.name is not None:
+            text = "%s: %s" % (self.name, text)
+        print(text)
+
+    def receive(self):
+        '''receive a packet from SITL, returning it if it is a new frame
+        and None if it isn't or nothing arrived before the timeout'''
+        received = self.read()
+        if received is None:
+            return None
+        return self.handle(*received)
+
+    def read(self):
+        '''return (data, address) for the next datagram, or None if none
+        arrived before the timeout'''
+        try:
+            return self.sock.recvfrom(256)
+        except (socket.timeout, BlockingIOError):
+            return None
+
+    def handle(self, data, address):
+        '''decode a datagram, returning the packet if it is a new frame'''
+        try:
+            packet = protocol.decode_servo_packet(data)
+        except ValueError as ex:
+            self.message(str(ex))
+            return None
+        if not self.accept(packet):
+            return None
+        self.sitl_address = address
+        if not self.connected:
+            self.connected = True
+            self.message('Connected to {0}'.format(str(address)))
+        return packet
+
+    def accept(self, packet):
+        '''check the frame rate and count of a packet, returning False if
+        it is a duplicate'''
+        if packet.frame_rate != self.rate_hz and packet.frame_rate > 0:
+            self.message("New frame rate %u" % packet.frame_rate)
+            self.rate_hz = packet.frame_rate
+            self.time_step = 1.0 / self.rate_hz
+            if self.on_rate_change is not None:
+                self.on_rate_change(self.rate_hz)
+
+        # Check if the frame is in expected order
+        if packet.frame_count < self.last_frame:
+            # Controller has reset, reset physics also
+            self.message('Controller reset')
+            if self.on_reset is not None:
+                self.on_reset()
+        elif packet.frame_count == self.last_frame:
+            # duplicate frame, skip
+            self.message('Duplicate input frame')
+            self.duplicates += 1
+            return False
+        elif packet.frame_count != self.last_frame + 1 and self.connected:
+            self.message('Missed {0} input frames'.format(packet.frame_count - self.last_frame - 1))
+            self.missed += packet.frame_count - self.last_frame - 1
+        self.last_frame = packet.frame_count
+        return True
+
+    def send(self, values):
+        '''send the sensor data for the last frame received'''
+        self.send_encoded(self.encoder.encode(values))
+
+    def send_encoded(self, data):
+        self.sock.sendto(data, self.sitl_address)
+        self.frames += 1
+        if self.print_frame_count and self.frames % self.print_frame_count == 0:
+            now = time.time()
+            dt = now - self.print_time
+            self.message("%.2f fps dt=%.3f" % (self.print_frame_count / dt, dt))
+            self.print_time = now
+
+    def run(self, step, idle=None):
+        '''run the physics in lock-step with SITL until interrupted.
+        step(pwm) returns the values to send; idle(), if given, is
+        called before waiting for each frame, e.g. to update a GUI'''
+        while True:
+            if idle is not None:
+                idle()
+            packet = self.receive()
+            if packet is None:
+                continue
+            self.send(step(packet.pwm))
+
+    def close(self):
+        self.sock.close()
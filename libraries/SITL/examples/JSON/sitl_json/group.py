@@ -0,0 +1,107 @@
+'''
+several SITL instances driven by one physics world
+
+BridgeGroup waits on the sockets of all its bridges with one selector.
+Once every active SITL instance has sent its next frame, the physics
+is stepped once for all of them and each gets its reply.  An instance
+is active if it has sent a frame in the last active_time seconds, so a
+stopped SITL holds the others up for no more than that.  Instances
+which are slow to send their frame hold the others up for at most
+max_wait seconds, after which the world is stepped for those which
+have:
+
+    bridges = [SITLBridge(port=9002 + 10 * i, name="%u" % i) for i in range(count)]
+    group = BridgeGroup(bridges)
+    group.run(step)
+
+step is called with a dictionary of bridge index => PWM values for the
+bridges with a new frame, and returns a dictionary of bridge index =>
+values to send.
+
+AP_FLAKE8_CLEAN
+'''
+
+import selectors
+import time
+
+
+class BridgeGroup(object):
+    '''SITLBridges stepped together'''
+
+    def __init__(self, bridges, max_wait=0.02, active_time=0.5, poll_time=0.1):
+        self.bridges = list(bridges)
+        self.max_wait = max_wait
+        self.active_time = active_time
+        self.poll_time = poll_time
+        self.selector = selectors.DefaultSelector()
+        for (i, bridge) in enumerate(self.bridges):
+            bridge.sock.setblocking(False)
+            self.selector.register(bridge.sock, selectors.EVENT_READ, i)
+        # bridge index => PWM of the frame waiting for a reply
+        self.pending = {}
+        self.first_pending_time = None
+        self.last_heard = [None] * len(self.bridges)
+        self.steps = 0
+
+    def active(self, now):
+        '''return the indexes of the bridges which have sent a frame
+        recently'''
+        return set(i for (i, t) in enumerate(self.last_heard) if t is not None and now - t < self.active_time)
+
+    def poll(self, timeout):
+        '''wait up to timeout seconds for frames'''
+        for (key, events) in self.selector.select(timeout):
+            i = key.data
+            bridge = self.bridges[i]
+            while True:
+                received = bridge.read()
+                if received is None:
+                    break
+                packet = bridge.handle(*received)
+                if packet is None:
+                    continue
+                now = time.time()
+                self.last_heard[i] = now
+                if len(self.pending) == 0:
+                    self.first_pending_time = now
+                # if SITL sent more than one frame, reply to the last
+                self.pending[i] = packet.pwm
+
+    def ready(self, now):
+        if len(self.pending) == 0:
+            return False
+        if now - self.first_pending_time >= self.max_wait:
+            return True
+        return set(self.pending.keys()) >= self.active(now)
+
+    def update(self, step):
+        '''wait for frames, stepping the physics if they are all in.
+        Returns True if the physics was stepped'''
+        timeout = self.poll_time
+        if len(self.pending) != 0:
+            timeout = max(0, self.first_pending_time + self.max_wait - time.time())
+        self.poll(timeout)
+        if not self.ready(time.time()):
+            return False
+        frames = self.pending
+        self.pending = {}
+        self.first_pending_time = None
+        replies = step(frames)
+        self.steps += 1
+        for (i, values) in replies.items():
+            self.bridges[i].send(values)
+        return True
+
+    def run(self, step, idle=None):
+        '''run the physics in lock-step with the SITL instances until
+        interrupted; idle(), if given, is called before waiting for each
+        batch of frames'''
+        while True:
+            if idle is not None:
+                idle()
+            self.update(step)
+
+    def close(self):
+        self.selector.close()
+        for bridge in self.bridges:
+            bridge.close()
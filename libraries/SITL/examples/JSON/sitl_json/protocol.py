@@ -0,0 +1,161 @@
+'''
+the JSON SITL backend protocol: servo packets from SITL, and sensor
+data back to it
+
+Servo packets are 16 or 32 channel, told apart by their size and magic
+value.  Sensor data is sent as a line of JSON.  The fields of a line
+are named as in SIM_JSON.h, with the section first for fields in a
+section, e.g. "imu.gyro" or "windvane.speed".
+
+TemplateEncoder fills in a format string built once for a fixed list
+of fields, which takes less than half the time of building a
+dictionary and calling json.dumps every frame.  JSONEncoder does the
+latter, for comparison and for backends whose fields change from frame
+to frame.
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import json
+import struct
+
+# the fields SITL requires, in the order the examples send them
+DEFAULT_FIELDS = ("timestamp", "imu.gyro", "imu.accel_body", "position", "attitude", "velocity")
+
+# field => (number of values, values are doubles in SITL), see the
+# keytable in SIM_JSON.h
+FIELDS = {
+    "timestamp": (1, True),
+    "imu.gyro": (3, False),
+    "imu.accel_body": (3, False),
+    "position": (3, True),
+    "attitude": (3, False),
+    "quaternion": (4, False),
+    "velocity": (3, False),
+    "rng_1": (1, False),
+    "rng_2": (1, False),
+    "rng_3": (1, False),
+    "rng_4": (1, False),
+    "rng_5": (1, False),
+    "rng_6": (1, False),
+    "windvane.direction": (1, False),
+    "windvane.speed": (1, False),
+    "airspeed": (1, False),
+    "no_time_sync": (1, False),
+}
+
+# SITL reads this with strtoull, so it is sent as 0 or 1
+BOOLEAN_FIELDS = frozenset(["no_time_sync"])
+
+ServoPacket = collections.namedtuple("ServoPacket", ["frame_rate", "frame_count", "pwm"])
+
+# magic value => packet layout
+servo_packets = {
+    18458: struct.Struct('HHI16H'),
+    29569: struct.Struct('HHI32H'),
+}
+servo_packet_sizes = {s.size: magic for (magic, s) in servo_packets.items()}
+
+
+def decode_servo_packet(data):
+    '''decode a servo packet from SITL, raising ValueError if it is not
+    one'''
+    magic = servo_packet_sizes.get(len(data))
+    if magic is None:
+        raise ValueError("got packet of len %u, expected %s" % (
+            len(data), " or ".join(str(size) for size in sorted(servo_packet_sizes.keys()))))
+    decoded = servo_packets[magic].unpack(data)
+    if decoded[0] != magic:
+        raise ValueError("Incorrect protocol magic %u should be %u" % (decoded[0], magic))
+    return ServoPacket(decoded[1], decoded[2], decoded[3:])
+
+
+def split_field(field):
+    '''return (section, key) for a field'''
+    if field not in FIELDS:
+        raise ValueError("Unknown field %s" % field)
+    if "." in field:
+        return tuple(field.split(".", 1))
+    return ("", field)
+
+
+class TemplateEncoder(object):
+    '''encodes sensor data for a fixed list of fields by filling in a
+    format string.  Fields in the same section must be next to each
+    other.  Floats are written with enough digits to be read back
+    exactly: 17 significant digits for the values SITL keeps as
+    doubles, 9 for the rest'''
+
+    def __init__(self, fields=DEFAULT_FIELDS):
+        self.fields = tuple(fields)
+        if len(set(self.fields)) != len(self.fields):
+            raise ValueError("Fields given more than once")
+        self.counts = []
+        # the top level items, and those of the section being added to
+        items = []
+        section = ""
+        section_items = items
+        sections_done = set()
+        for field in self.fields:
+            (field_section, key) = split_field(field)
+            if field_section != section:
+                if field_section in sections_done:
+                    raise ValueError("Fields in section %s must be next to each other" % field_section)
+                if section:
+                    items.append('"%s":{%s}' % (section, ",".join(section_items)))
+                    sections_done.add(section)
+                section = field_section
+                section_items = [] if section else items
+            (count, is_double) = FIELDS[field]
+            if field in BOOLEAN_FIELDS:
+                fmt = "%d"
+            elif is_double:
+                fmt = "%.17g"
+            else:
+                fmt = "%.9g"
+            if count == 1:
+                section_items.append('"%s":%s' % (key, fmt))
+            else:
+                section_items.append('"%s":[%s]' % (key, ",".join([fmt] * count)))
+            self.counts.append(count)
+        if section:
+            items.append('"%s":{%s}' % (section, ",".join(section_items)))
+        # none of the field names contain a "%", so nothing needs escaping
+        self.template = "\n{" + ",".join(items) + "}\n"
+
+    def encode_flat(self, values):
+        '''encode a flat sequence of numbers, one for each value of each
+        field in order; this is the fastest way to encode'''
+        return (self.template % tuple(values)).encode("ascii")
+
+    def encode(self, values):
+        '''encode a sequence with a value for each field; fields with
+        more than one value take a sequence'''
+        flat = []
+        for (value, count) in zip(values, self.counts):
+            if count == 1:
+                flat.append(value)
+            else:
+                flat.extend(value)
+        return self.encode_flat(flat)
+
+
+class JSONEncoder(object):
+    '''encodes sensor data by building a dictionary and calling
+    json.dumps'''
+
+    def __init__(self, fields=DEFAULT_FIELDS):
+        self.fields = tuple(fields)
+        self.keys = [split_field(field) for field in self.fields]
+
+    def encode(self, values):
+        content = {}
+        for ((section, key), field, value) in zip(self.keys, self.fields, values):
+            if field in BOOLEAN_FIELDS:
+                value = int(value)
+            if section:
+                content.setdefault(section, {})[key] = value
+            else:
+                content[key] = value
+        return ("\n" + json.dumps(content, separators=(',', ':')) + "\n").encode("ascii")